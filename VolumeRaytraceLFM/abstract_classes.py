@@ -2,8 +2,10 @@
 # Third party libraries imports
 from enum import Enum
 import pickle
+import json
 from os.path import exists
 import numpy as np
+import h5py
 import matplotlib.pyplot as plt
 
 # Packages needed for siddon algorithm calculations
@@ -25,6 +27,31 @@ except:
         ):
             pass
 
+# Version of the files written by RayTraceLFM.save_geometry
+GEOMETRY_FORMAT_VERSION = 1
+
+def memmap_hdf5_dataset(h5_file_path, dataset):
+    '''Memory-maps an HDF5 dataset if it's stored contiguously and uncompressed, otherwise returns None'''
+    offset = dataset.id.get_offset()
+    if dataset.chunks is not None or offset is None or dataset.dtype.byteorder not in '=|<':
+        return None
+    return np.memmap(h5_file_path, dtype=dataset.dtype, mode='c', offset=offset, shape=dataset.shape)
+
+def pad_ragged(lists, fill_shape=()):
+    '''Stores a list of lists as an array [n_lists,max_length,*fill_shape] padded with -1, and the lengths'''
+    lengths = np.array([len(l) for l in lists], dtype=np.int64)
+    padded = np.full([len(lists), int(lengths.max(initial=0))] + list(fill_shape), -1, dtype=np.int64)
+    for n,l in enumerate(lists):
+        padded[n,:len(l)] = l
+    return padded, lengths
+
+def unpad_ragged(padded, lengths, as_tuples=False):
+    '''Inverse of pad_ragged, returns a list of lists (of tuples if as_tuples)'''
+    rows = padded.tolist()
+    if as_tuples:
+        return [[tuple(x) for x in row[:n]] for row,n in zip(rows, lengths.tolist())]
+    return [row[:n] for row,n in zip(rows, lengths.tolist())]
+
 class SimulType(Enum):
     ''' Defines which types of volumes we can have, as each type has a
     different ray-voxel interaction'''
@@ -402,13 +429,35 @@ class RayTraceLFM(OpticalElement):
         ray_diff = ray_diff / np.linalg.norm(ray_diff, axis=0)
         return ray_enter, ray_exit, ray_diff
 
+    @staticmethod
+    def calc_voxel_span_per_ml(ray_diff, n_voxels_z):
+        '''Maximum lateral reach, in voxels, of the rays of a micro-lens from the center voxel
+        Parameters:
+            ray_diff (np.array): (3, X, X) ray directions from rays_through_vol
+            n_voxels_z (int): axial size of the volume in voxels
+        '''
+        # The maximum voxel-span is with respect to the middle voxel, let's shift that to the origin
+        # find first valid ray from one of the borders
+        half_ml_shape = ray_diff.shape[1] // 2
+        valid_ray_coord = 0
+        while np.isnan(ray_diff[0, valid_ray_coord, half_ml_shape]):
+            valid_ray_coord += 1
+        # Compute how long is the ray laterally
+        voxel_span_per_ml = n_voxels_z * \
+            ray_diff[2,valid_ray_coord,half_ml_shape] / ray_diff[0,valid_ray_coord,half_ml_shape]
+        # Compensate for different voxel sizes axially vs laterally
+        # voxel_span_per_ml *= (self.optical_info['voxel_size_um'][1]
+        #                       / self.optical_info['voxel_size_um'][0])
+        # Compute what's the maximum reach of a ray from the center voxel
+        return np.ceil(voxel_span_per_ml / 2)
+
     def compute_rays_geometry(self, filename=None):
         '''Computes the ray-voxel collision based on the Siddon algorithm.
         Requires:
             calling self.rays_through_volumes to compute ray entry, exit and directions.
         Parameters:
-            filename (str) optional: Saves the geometry to a pickle file, and loads the geometry
-                                    from a file if the file exists.
+            filename (str) optional: Saves the geometry to a file (see save_geometry), and loads the geometry
+                                    from the file if it exists.
         Returns:
             None
         Computes:
@@ -424,10 +473,11 @@ class RayTraceLFM(OpticalElement):
             self.ray_valid_direction  (list [n_valid_rays, 3]):
                 Stores the direction of ray n.
         '''
-        # If a filename is provided, check if it exists and load the whole ray tracer class from it.
+        # If a filename is provided, check if it exists and load the ray tracer geometry from it.
         if filename is not None and exists(filename):
-            data = self.unpickle(filename)
-            print(f'Loaded RayTraceLFM object from {filename}')
+            data = type(self).load_geometry(filename)
+            assert data.backend == self.backend, f'The geometry in {filename} was computed with the {data.backend} back-end'
+            print(f'Loaded RayTraceLFM geometry from {filename}')
             return data
 
         # todo: We treat differently numpy and torch rays, as some rays go outside the volume of
@@ -466,20 +516,7 @@ class RayTraceLFM(OpticalElement):
             self.ray_exit = ray_exit
             self.ray_direction = ray_diff
 
-        # The maximum voxel-span is with respect to the middle voxel, let's shift that to the origin
-        # find first valid ray from one of the borders
-        half_ml_shape = ray_diff.shape[1] // 2
-        valid_ray_coord = 0
-        while np.isnan(ray_diff[0, valid_ray_coord, half_ml_shape]):
-            valid_ray_coord += 1
-        # Compute how long is the ray laterally
-        self.voxel_span_per_ml = vol_shape[0] * \
-            ray_diff[2,valid_ray_coord,half_ml_shape] / ray_diff[0,valid_ray_coord,half_ml_shape]
-        # Compensate for different voxel sizes axially vs laterally
-        # self.voxel_span_per_ml *= (self.optical_info['voxel_size_um'][1]
-        #                            / self.optical_info['voxel_size_um'][0])
-        # Compute what's the maximum reach of a ray from the center voxel
-        self.voxel_span_per_ml = np.ceil(self.voxel_span_per_ml / 2)
+        self.voxel_span_per_ml = RayTraceLFM.calc_voxel_span_per_ml(ray_diff, vol_shape[0])
 
         # Pre-comute things for torch and store in tensors
         i_range,j_range = self.ray_entry.shape[1:]
@@ -563,10 +600,6 @@ class RayTraceLFM(OpticalElement):
         self.vox_ctr_idx = vox_ctr_idx.astype(int)
         self.volume_ctr_um = vox_ctr_idx * voxel_size_um
 
-        if filename is not None:
-            self.pickle(filename)
-            print(f'Saved RayTraceLFM object from {filename}')
-
         # Calculate the ray's direction with the two normalized perpendicular directions
         # Returns a list size 3, where each element is a torch tensor shaped [n_rays, 3]
         if self.backend == BackEnds.NUMPY:
@@ -578,8 +611,95 @@ class RayTraceLFM(OpticalElement):
                 RayTraceLFM.calc_ray_direction_torch(self.ray_valid_direction)
                 )
 
+        if filename is not None:
+            self.save_geometry(filename)
+            print(f'Saved RayTraceLFM geometry to {filename}')
+
         return self
 
+    # Helper functions to load/save the geometry as arrays
+    def get_geometry_arrays(self):
+        '''Returns the computed geometry as a dict of numpy arrays, see save_geometry'''
+        to_numpy = lambda data: data.detach().cpu().numpy() if hasattr(data, 'detach') else np.asarray(data)
+        ray_vol_colli_indices, ray_vol_colli_n_steps = pad_ragged(self.ray_vol_colli_indices, [3])
+        return {'vox_ctr_idx' : np.asarray(self.vox_ctr_idx),
+                'volume_ctr_um' : np.asarray(self.volume_ctr_um),
+                'voxel_span_per_ml' : np.asarray(self.voxel_span_per_ml),
+                'ray_entry' : to_numpy(self.ray_entry),
+                'ray_exit' : to_numpy(self.ray_exit),
+                'ray_direction' : to_numpy(self.ray_direction),
+                'ray_valid_indices' : to_numpy(self.ray_valid_indices),
+                'ray_vol_colli_indices' : ray_vol_colli_indices,
+                'ray_vol_colli_n_steps' : ray_vol_colli_n_steps,
+                'ray_vol_colli_lengths' : to_numpy(self.ray_vol_colli_lengths),
+                'ray_valid_direction' : to_numpy(self.ray_valid_direction),
+                'ray_direction_basis' : to_numpy(self.ray_direction_basis)}
+
+    def set_geometry_arrays(self, arrays):
+        '''Sets the geometry from a dict of arrays from get_geometry_arrays.
+            With the PYTORCH back-end the tensors share the memory of the arrays, which can be memory-mapped.'''
+        self.vox_ctr_idx = np.array(arrays['vox_ctr_idx'])
+        self.volume_ctr_um = np.array(arrays['volume_ctr_um'])
+        self.voxel_span_per_ml = float(arrays['voxel_span_per_ml'][()])
+        self.ray_vol_colli_indices = unpad_ragged(arrays['ray_vol_colli_indices'], arrays['ray_vol_colli_n_steps'], as_tuples=True)
+        if self.backend == BackEnds.NUMPY:
+            self.ray_entry = arrays['ray_entry']
+            self.ray_exit = arrays['ray_exit']
+            self.ray_direction = arrays['ray_direction']
+            self.ray_valid_indices = arrays['ray_valid_indices']
+            self.ray_vol_colli_lengths = arrays['ray_vol_colli_lengths']
+            self.ray_valid_direction = arrays['ray_valid_direction']
+            self.ray_direction_basis = [list(basis) for basis in arrays['ray_direction_basis']]
+        elif self.backend == BackEnds.PYTORCH:
+            self.ray_entry = torch.from_numpy(arrays['ray_entry'])
+            self.ray_exit = torch.from_numpy(arrays['ray_exit'])
+            self.ray_direction = torch.from_numpy(arrays['ray_direction'])
+            self.ray_valid_indices = torch.from_numpy(arrays['ray_valid_indices'])
+            self.ray_vol_colli_lengths = nn.Parameter(torch.from_numpy(arrays['ray_vol_colli_lengths']), requires_grad=False)
+            self.ray_valid_direction = nn.Parameter(torch.from_numpy(arrays['ray_valid_direction']), requires_grad=False)
+            self.ray_direction_basis = nn.Parameter(torch.from_numpy(arrays['ray_direction_basis']), requires_grad=False)
+
+    def save_geometry(self, filename):
+        '''Saves the ray geometry, computed by compute_rays_geometry, to an HDF5 file with only arrays:
+                optical_info: group with the arrays as datasets, and the other entries as json attributes
+                geometry/*: contiguous uncompressed datasets, see get_geometry_arrays
+            Unlike pickle, the file doesn't depend on the classes of this version of the code,
+            and load_geometry memory-maps the arrays instead of reading them.'''
+        with h5py.File(filename, 'w') as f:
+            f.attrs['geometry_format_version'] = GEOMETRY_FORMAT_VERSION
+            f.attrs['backend'] = self.backend.name
+            oc_grp = f.create_group('optical_info')
+            for k,v in self.optical_info.items():
+                if isinstance(v, np.ndarray):
+                    oc_grp.create_dataset(k, data=v)
+                else:
+                    oc_grp.attrs[k] = json.dumps(v)
+            geometry_grp = f.create_group('geometry')
+            for name,array in self.get_geometry_arrays().items():
+                geometry_grp.create_dataset(name, data=array)
+
+    @classmethod
+    def load_geometry(cls, filename, mmap=True):
+        '''Creates a ray-tracer, with the back-end it was saved with, from a file written by save_geometry,
+            without recomputing the geometry.
+            Args:
+                mmap (bool): memory-map the arrays, so only the parts in use are read from disk.
+                                With the PYTORCH back-end, the tensors are copy-on-write views of the file.'''
+        with h5py.File(filename, 'r') as f:
+            version = f.attrs.get('geometry_format_version', 0)
+            assert version == GEOMETRY_FORMAT_VERSION, \
+                f'{filename} has geometry format version {version}, expected {GEOMETRY_FORMAT_VERSION}'
+            backend = BackEnds[f.attrs['backend']]
+            optical_info = {k : json.loads(v) for k,v in f['optical_info'].attrs.items()}
+            optical_info.update({k : dataset[()] for k,dataset in f['optical_info'].items()})
+            arrays = {}
+            for name,dataset in f['geometry'].items():
+                array = memmap_hdf5_dataset(filename, dataset) if mmap else None
+                arrays[name] = dataset[()] if array is None else array
+        rays = cls(backend=backend, optical_info=optical_info)
+        rays.set_geometry_arrays(arrays)
+        return rays
+
     # Helper functions to load/save the whole class to disk
     def pickle(self, filename):
         with open(filename, 'wb') as file:
@@ -4,6 +4,9 @@ from tqdm import tqdm
 import re
 from math import floor
 
+# Version of the files written by BirefringentVolume.save_as_file
+VOLUME_FORMAT_VERSION = 2
+
 class BirefringentElement(OpticalElement):
     ''' Birefringent element, such as voxel, raytracer, etc, extending optical element, so it has a back-end and optical information'''
     def __init__(self, backend : BackEnds = BackEnds.NUMPY, torch_args={},
@@ -135,6 +138,22 @@ class BirefringentVolume(BirefringentElement):
         else:
             return self.optic_axis
 
+    @staticmethod
+    def optic_axis_to_angles(optic_axis):
+        ''' Spherical angles of unit optic axes, shaped [3,...] as (axial, y, x) components.
+            Returns a [2,...] tensor with the polar angle theta, measured from the axial direction,
+            and the azimuthal angle phi, measured from the x axis in the transverse plane.'''
+        theta = torch.arccos(optic_axis[0].clamp(-1, 1))
+        phi = torch.atan2(optic_axis[1], optic_axis[2])
+        return torch.stack((theta, phi), 0)
+
+    @staticmethod
+    def angles_to_optic_axis(angles):
+        ''' Inverse of optic_axis_to_angles, the returned optic axes always have unit length,
+            so optimizing the angles keeps them on the unit sphere without a regularizer.'''
+        theta, phi = angles[0], angles[1]
+        return torch.stack((torch.cos(theta), torch.sin(theta) * torch.sin(phi), torch.sin(theta) * torch.cos(phi)), 0)
+
     def __iadd__(self, other):
         ''' Overload the += operator to be able to sum volumes'''
         # Check that shapes are the same
@@ -326,43 +345,38 @@ class BirefringentVolume(BirefringentElement):
 
 
 ########### Generate different birefringent volumes 
-    def save_as_file(self, h5_file_path, description="Temporary description", optical_all=False):
-        '''Store this volume into an h5 file'''
+    def save_as_file(self, h5_file_path, description="Temporary description", optical_all=False,
+                        dtype=np.float32, compression='gzip', chunk_shape=None, layout='dense'):
+        '''Store this volume into an h5 file, with chunked and compressed datasets:
+                data/delta_n [nz,ny,nx]
+                data/optic_axis [3,nz,ny,nx]
+            or, with the 'coo' layout, only the n nonzero voxels, for mostly empty volumes:
+                data/indices [n,3]: [z,y,x] index of each voxel, the volume shape is stored in the data/shape attribute
+                data/delta_n [n]
+                data/optic_axis [3,n]
+            Args:
+                optical_all (bool): store the whole optical_info, instead of volume_shape and voxel_size_um.
+                dtype: type of the stored data, float32 by default, float16 halves the files, None keeps the volume dtype.
+                compression (str): h5py compression filter, or None.
+                chunk_shape ([3]): shape of the chunks in voxels, the lateral tiles allow reading regions of interest
+                                    without decompressing the whole volume (see init_from_file).
+                layout (str): 'dense' or 'coo'. The optic axis of the empty voxels isn't stored in the 'coo' layout.'''
         print(f'Saving volume to h5 file: {h5_file_path}')
 
         # Create file
         with h5py.File(h5_file_path, "w") as f:
+            f.attrs['volume_format_version'] = VOLUME_FORMAT_VERSION
             # Save optical_info
             oc_grp = f.create_group('optical_info')
-            try:
-                oc_grp.create_dataset('description',
-                    [1],
-                    data=description
-                    )
-                vol_shape = self.optical_info['volume_shape']
-                voxel_size_um = self.optical_info['voxel_size_um']
-            except:
-                pass
-
+            oc_grp.create_dataset('description', [1], data=description)
             if optical_all == False:
-                try:
-                    oc_grp.create_dataset('volume_shape',
-                        np.array(vol_shape).shape if isinstance(vol_shape, list) else [1],
-                        data=vol_shape
-                        )
-                    oc_grp.create_dataset('voxel_size_um',
-                        np.array(voxel_size_um).shape if isinstance(voxel_size_um, list) else [1],
-                        data=voxel_size_um
-                        )
-                except:
-                    pass
+                optical_info = {key : self.optical_info[key] for key in ['volume_shape', 'voxel_size_um'] if key in self.optical_info}
             else:
-                for k,v in self.optical_info.items():
-                    try:
-                        oc_grp.create_dataset(k, np.array(v).shape if isinstance(v,list) else [1], data=v)
-                        # print(f'Added optical_info/{k} to {h5_file_path}')
-                    except:
-                        pass
+                optical_info = self.optical_info
+            for k,v in optical_info.items():
+                if v is None:
+                    continue
+                oc_grp.create_dataset(k, np.array(v).shape if isinstance(v, (list, np.ndarray)) else [1], data=v)
 
             # Save data (birefringence and optic_axis)
             delta_n = self.get_delta_n()
@@ -371,48 +385,94 @@ class BirefringentVolume(BirefringentElement):
             if self.backend == BackEnds.PYTORCH:
                 delta_n = delta_n.detach().cpu().numpy()
                 optic_axis = optic_axis.detach().cpu().numpy()
+            if dtype is not None:
+                delta_n = delta_n.astype(dtype, copy=False)
+                optic_axis = optic_axis.astype(dtype, copy=False)
 
             data_grp = f.create_group('data')
-            data_grp.create_dataset("delta_n", delta_n.shape, data=delta_n.astype(np.float32))
-            data_grp.create_dataset("optic_axis", optic_axis.shape, data=optic_axis.astype(np.float32))
+            data_grp.attrs['layout'] = layout
+            if layout == 'dense':
+                chunk_shape = [min(n, 32) for n in delta_n.shape] if chunk_shape is None else \
+                                [min(n, c) for n,c in zip(delta_n.shape, chunk_shape)]
+                data_grp.create_dataset("delta_n", data=delta_n, chunks=tuple(chunk_shape), compression=compression)
+                data_grp.create_dataset("optic_axis", data=optic_axis, chunks=tuple([3] + chunk_shape), compression=compression)
+            elif layout == 'coo':
+                data_grp.attrs['shape'] = delta_n.shape
+                nonzero = delta_n != 0
+                indices = np.argwhere(nonzero).astype(np.min_scalar_type(max(delta_n.shape)))
+                data_grp.create_dataset("indices", data=indices)
+                data_grp.create_dataset("delta_n", data=delta_n[nonzero])
+                data_grp.create_dataset("optic_axis", data=optic_axis[:,nonzero])
+            else:
+                raise NotImplementedError
 
     @staticmethod
-    def init_from_file(h5_file_path, backend=BackEnds.NUMPY, optical_info=None):
+    def init_from_file(h5_file_path, backend=BackEnds.NUMPY, optical_info=None, roi=None, dtype=None):
         ''' Loads a birefringent volume from an h5 file and places it in the center of the volume
             It requires to have:
                 optical_info/volume_shape [3]: shape of the volume in voxels [nz,ny,nx]
                 data/delta_n [nz,ny,nx]: Birefringence volumetric information.
-                data/optic_axis [3,nz,ny,nx]: Optical axis per voxel.'''
-
+                data/optic_axis [3,nz,ny,nx]: Optical axis per voxel.
+            or the nonzero voxels of the 'coo' layout, see save_as_file.
+            Only the region of interest is read, directly into the workspace defined by optical_info['volume_shape'],
+            so no full size copies of the file data are made.
+            Args:
+                roi ([3] slices or [start,stop] pairs): region of the stored volume to load, the whole volume by default.
+                dtype: type of the loaded volume. By default the torch default dtype with the PYTORCH back-end,
+                        and the stored type (at least float32) with the NUMPY back-end.'''
+        if dtype is None and backend == BackEnds.PYTORCH:
+            dtype = torch.empty(0).numpy().dtype
         # Load volume
-        volume_file = h5py.File(h5_file_path, "r")
-
-        # Fetch birefringence
-        delta_n = np.array(volume_file['data/delta_n'])
-        # Fetch optic_axis
-        optic_axis = np.array(volume_file['data/optic_axis'])
-
-        # Compute padding to match optica_info['volume_shape]
-        z_,y_, x_ = delta_n.shape
-        z, y, x = optical_info['volume_shape']
-        assert z_<=z and y_<=y and x_<=x, f"Input volume is to large ({delta_n.shape}) for optical_info defined volume_shape {optical_info['volume_shape']}"
-
-        z_pad = abs(z_-z)
-        y_pad = abs(y_-y)
-        x_pad = abs(x_-x)
-
-        # Pad
-        delta_n = np.pad(delta_n,(
-                        (z_pad//2, z_pad//2 + z_pad%2),
-                        (y_pad//2, y_pad//2 + y_pad%2), 
-                        (x_pad//2, x_pad//2 + x_pad%2)),
-                    mode = 'constant').astype(np.float64)
-
-        optic_axis = np.pad(optic_axis,((0,0),
-                        (z_pad//2, z_pad//2 + z_pad%2),
-                        (y_pad//2, y_pad//2 + y_pad%2), 
-                        (x_pad//2, x_pad//2 + x_pad%2)),
-                    mode = 'constant', constant_values=np.sqrt(3)).astype(np.float64)
+        with h5py.File(h5_file_path, "r") as volume_file:
+            data_grp = volume_file['data']
+            layout = data_grp.attrs.get('layout', 'dense')
+            stored_shape = data_grp.attrs['shape'] if layout == 'coo' else data_grp['delta_n'].shape
+            dtype = np.promote_types(data_grp['delta_n'].dtype, np.float32) if dtype is None else np.dtype(dtype)
+
+            # Region to read
+            if roi is None:
+                roi = [slice(None)] * 3
+            roi = tuple(r if isinstance(r, slice) else slice(*r) for r in roi)
+            assert all(r.step in [None, 1] for r in roi), 'Regions of interest with steps are not supported'
+            region_shape = [len(range(*r.indices(n))) for r,n in zip(roi, stored_shape)]
+
+            # Compute padding to match optica_info['volume_shape]
+            z_,y_, x_ = region_shape
+            z, y, x = optical_info['volume_shape']
+            assert z_<=z and y_<=y and x_<=x, f"Input volume is to large ({region_shape}) for optical_info defined volume_shape {optical_info['volume_shape']}"
+            placement = tuple(slice(abs(n_-n)//2, abs(n_-n)//2 + n_) for n_,n in zip(region_shape, [z, y, x]))
+
+            if layout == 'dense':
+                # Read the region directly into the padded volume, the optic_axis is padded with [1,1,1]
+                delta_n = np.zeros([z, y, x], dtype=dtype)
+                optic_axis = np.full([3, z, y, x], np.sqrt(3), dtype=dtype)
+                if all(n > 0 for n in region_shape):
+                    data_grp['delta_n'].read_direct(delta_n, source_sel=roi, dest_sel=placement)
+                    data_grp['optic_axis'].read_direct(optic_axis, source_sel=(slice(None),) + roi, dest_sel=(slice(None),) + placement)
+            elif layout == 'coo':
+                # Nonzero voxels inside the region, moved to their place in the volume
+                start = np.array([r.indices(n)[0] for r,n in zip(roi, stored_shape)])
+                indices = data_grp['indices'][()].astype(np.int64) - start
+                inside = np.all((indices >= 0) & (indices < region_shape), axis=1)
+                indices = indices[inside] + [p.start for p in placement]
+                delta_n_values = data_grp['delta_n'][()][inside].astype(dtype)
+                optic_axis_values = data_grp['optic_axis'][()][:,inside].astype(dtype)
+                # The voxels are scattered into a volume created on the back-end
+                if backend == BackEnds.PYTORCH:
+                    torch_dtype = torch.from_numpy(delta_n_values).dtype
+                    delta_n = torch.zeros([z, y, x], dtype=torch_dtype)
+                    optic_axis = torch.full([3, z, y, x], np.sqrt(3), dtype=torch_dtype)
+                    voxels = tuple(torch.from_numpy(indices.T))
+                    delta_n[voxels] = torch.from_numpy(delta_n_values)
+                    optic_axis[(slice(None),) + voxels] = torch.from_numpy(optic_axis_values)
+                else:
+                    delta_n = np.zeros([z, y, x], dtype=dtype)
+                    optic_axis = np.full([3, z, y, x], np.sqrt(3), dtype=dtype)
+                    voxels = tuple(indices.T)
+                    delta_n[voxels] = delta_n_values
+                    optic_axis[(slice(None),) + voxels] = optic_axis_values
+            else:
+                raise NotImplementedError
 
         # Create volume
         volume_out = BirefringentVolume(backend=backend, optical_info=optical_info, Delta_n=delta_n, optic_axis=optic_axis)
@@ -587,9 +647,29 @@ class BirefringentRaytraceLFM(RayTraceLFM, BirefringentElement):
 
         # Ray-voxel colisions for different micro-lenses, this dictionary gets filled in: calc_cummulative_JM_of_ray_torch
         self.vox_indices_ml_shifted = {}
-        self.vox_indices_ml_shifted_all = []
+        self._vox_indices_ml_shifted_all = []
         self.ray_valid_indices_all = None
         self.MLA_volume_geometry_ready = False
+        # Dense version of vox_indices_ml_shifted_all [n_rays,n_steps] (padded with -1), used by the shifted volume forward
+        self.vox_indices_ml_shifted_all_dense = None
+        # Terms of voxRayJM that only depend on a frozen parameter, per step, see get_frozen_voxRayJM_terms
+        self.frozen_terms_key = None
+        self.frozen_terms_tensor = None
+        self.frozen_terms = {}
+
+    @property
+    def vox_indices_ml_shifted_all(self):
+        '''1D voxel indices traversed by every MLA ray, a list of lists. When the geometry is loaded from a file,
+            they are only stored as vox_indices_ml_shifted_all_dense, and the lists are built the first time they're used.'''
+        if self._vox_indices_ml_shifted_all is None:
+            dense = self.vox_indices_ml_shifted_all_dense.cpu().numpy()
+            self._vox_indices_ml_shifted_all = unpad_ragged(dense, (dense >= 0).sum(1))
+        return self._vox_indices_ml_shifted_all
+
+    @vox_indices_ml_shifted_all.setter
+    def vox_indices_ml_shifted_all(self, vox_indices):
+        self._vox_indices_ml_shifted_all = vox_indices
+
     def get_volume_reachable_region(self):
         ''' Returns a binary mask where the MLA's can reach into the volume'''
 
@@ -655,15 +735,49 @@ class BirefringentRaytraceLFM(RayTraceLFM, BirefringentElement):
 
         self.MLA_volume_geometry_ready = True
         return
+
+    def get_geometry_arrays(self):
+        '''Adds the MLA ray-voxel interactions, if they were precomputed, to the arrays of RayTraceLFM.get_geometry_arrays'''
+        arrays = super(BirefringentRaytraceLFM, self).get_geometry_arrays()
+        if self.MLA_volume_geometry_ready:
+            arrays['vox_indices_ml_shifted_all'] = self.get_dense_vox_indices_torch()[0].cpu().numpy()
+            arrays['ray_valid_indices_all'] = self.ray_valid_indices_all.detach().cpu().numpy()
+        return arrays
+
+    def set_geometry_arrays(self, arrays):
+        '''Sets the arrays of RayTraceLFM.set_geometry_arrays, and the MLA ray-voxel interactions if they were saved'''
+        super(BirefringentRaytraceLFM, self).set_geometry_arrays(arrays)
+        if 'vox_indices_ml_shifted_all' in arrays:
+            # The lists of vox_indices_ml_shifted_all are built from this when needed
+            self.vox_indices_ml_shifted_all_dense = torch.from_numpy(arrays['vox_indices_ml_shifted_all'])
+            self.vox_indices_ml_shifted_all = None
+            self.ray_valid_indices_all = torch.from_numpy(arrays['ray_valid_indices_all'])
+            self.MLA_volume_geometry_ready = True
  
-    def ray_trace_through_volume(self, volume_in : BirefringentVolume = None, all_rays_at_once=True):
+    def ray_trace_through_volume(self, volume_in : BirefringentVolume = None, all_rays_at_once=True,
+                                polarizers=None, analyzers=None, wavelengths=None, dispersion=None):
         """ This function forward projects a whole volume, by iterating through the volume in front of each micro-lens in the system.
             By computing an offset (current_offset) that shifts the volume indices reached by each ray.
-            Then we accumulate the images generated by each micro-lens, and concatenate in a final image"""
+            Then we accumulate the images generated by each micro-lens, and concatenate in a final image.
+            Optionally, with the pytorch back-end a stack of polarizer/analyzer pairs ([n_settings,2,2] each)
+            can be provided, the material Jones matrices are then computed once and the retardance and
+            azimuth images are returned for every setting, shaped [n_settings,pixels_per_mla,pixels_per_mla]
+            Similarly, a vector of wavelengths can be provided to simulate all of them sharing the ray geometry,
+            with an optional dispersion (Delta_n scale for each wavelength). The images then have an extra
+            dimension: [n_wavelengths,pixels_per_mla,pixels_per_mla], or [n_settings,n_wavelengths,...] with stacks.
+            A dispersion without wavelengths scales Delta_n at optical_info['wavelength']."""
 
         if self.backend == BackEnds.PYTORCH and all_rays_at_once:
             self.precompute_MLA_volume_geometry()
-            return self.ret_and_azim_images_mla_torch(volume_in)
+            material_JM = None
+            if dispersion is not None and wavelengths is None:
+                wavelengths = [self.optical_info['wavelength']] * len(dispersion)
+            if wavelengths is not None:
+                material_JM = self.calc_material_JM_of_ray_torch(volume_in, all_rays_at_once=True,
+                                                                wavelengths=wavelengths, dispersion=dispersion)
+            return self.ret_and_azim_images_mla_torch(volume_in, material_JM=material_JM, polarizers=polarizers, analyzers=analyzers)
+        assert polarizers is None and analyzers is None, 'Polarizer/analyzer stacks require the PYTORCH back-end with all_rays_at_once'
+        assert wavelengths is None and dispersion is None, 'Multiple wavelengths require the PYTORCH back-end with all_rays_at_once'
 
         # volume_shape defines the size of the workspace
         # the number of micro lenses defines the valid volume inside the workspace
@@ -723,6 +837,22 @@ class BirefringentRaytraceLFM(RayTraceLFM, BirefringentElement):
                     full_img_a = torch.cat((full_img_a, full_img_row_a), 1)
         return full_img_r, full_img_a
  
+    def ray_trace_through_volume_shifts(self, volume_in : BirefringentVolume, shifts, polarizers=None, analyzers=None):
+        """ Forward projects the volume displaced by a list of integer voxel shifts, sharing the MLA geometry.
+            This is equivalent to creating the volume at different volume_axial_offset (and lateral positions),
+            and projecting each of them. Instead, the volume is zero-padded once and the shifts are applied
+            as offsets on the flat ray-voxel collision indices.
+            Args:
+                shifts ([n_shifts] or [n_shifts,3]): integer axial shifts, or (z,y,x) shifts in voxels.
+                    A positive shift moves the sample towards higher indices.
+            Returns:
+                ret_image, azim_image ([n_shifts,pixels_per_mla,pixels_per_mla], with a leading n_settings
+                                        dimension if stacks of polarizers/analyzers are provided)"""
+        assert self.backend == BackEnds.PYTORCH, 'Shifted volume forward projection requires the PYTORCH back-end'
+        self.precompute_MLA_volume_geometry()
+        material_JM = self.calc_material_JM_of_ray_shifts_torch(volume_in, shifts)
+        return self.ret_and_azim_images_mla_torch(volume_in, material_JM=material_JM, polarizers=polarizers, analyzers=analyzers)
+
     def retardance(self, JM):
         '''Phase delay introduced between the fast and slow axis in a Jones Matrix'''
         if self.backend == BackEnds.NUMPY:
@@ -731,7 +861,7 @@ class BirefringentRaytraceLFM(RayTraceLFM, BirefringentElement):
             retardance = np.abs(phase_diff)
         elif self.backend == BackEnds.PYTORCH:
             x = torch.linalg.eigvals(JM)
-            retardance = (torch.angle(x[:,1]) - torch.angle(x[:,0])).abs()
+            retardance = (torch.angle(x[...,1]) - torch.angle(x[...,0])).abs()
         else:
             raise NotImplementedError
         return retardance
@@ -752,9 +882,9 @@ class BirefringentRaytraceLFM(RayTraceLFM, BirefringentElement):
             # if np.isclose(azimuth,np.pi):
             #     azimuth = 0.0
         elif self.backend == BackEnds.PYTORCH: 
-            diag_sum = (JM[:, 0, 0] + JM[:, 1, 1])
-            diag_diff = (JM[:, 1, 1] - JM[: ,0, 0])
-            off_diag_sum = JM[:, 0, 1] + JM[:, 1, 0]
+            diag_sum = (JM[..., 0, 0] + JM[..., 1, 1])
+            diag_diff = (JM[..., 1, 1] - JM[... ,0, 0])
+            off_diag_sum = JM[..., 0, 1] + JM[..., 1, 0]
             a = (diag_diff / diag_sum).imag
             b = (off_diag_sum / diag_sum).imag
             # atan2 with zero entries causes nan in backward, so let's filter them out
@@ -778,19 +908,15 @@ class BirefringentRaytraceLFM(RayTraceLFM, BirefringentElement):
         elif self.backend==BackEnds.PYTORCH:
             return self.calc_cummulative_JM_of_ray_torch(volume_in, micro_lens_offset)
 
-    def calc_cummulative_JM_of_ray_numpy(self, i, j, volume_in : BirefringentVolume, micro_lens_offset=[0,0]):
-        '''For the (i,j) pixel behind a single microlens'''
+    def calc_material_JM_of_ray_numpy(self, i, j, volume_in : BirefringentVolume, micro_lens_offset=[0,0]):
+        '''Jones Matrix of the volume alone (without polarizer and analyzer) for the (i,j) pixel behind a single microlens'''
         # Fetch precomputed Siddon parameters
         voxels_of_segs, ell_in_voxels = self.ray_vol_colli_indices, self.ray_vol_colli_lengths
         # rays are stored in a 1D array, let's look for index i,j
         n_ray = j + i *  self.optical_info['pixels_per_ml']
         rayDir = self.ray_direction_basis[n_ray][:]
 
-        polarizer = self.optical_info['polarizer']
-        analyzer = self.optical_info['analyzer']
-
         JM_list = []
-        JM_list.append(polarizer)
         for m in range(len(voxels_of_segs[n_ray])):
             ell = ell_in_voxels[n_ray][m]
             vox = voxels_of_segs[n_ray][m]
@@ -798,67 +924,361 @@ class BirefringentRaytraceLFM(RayTraceLFM, BirefringentElement):
             opticAxis = volume_in.optic_axis[:, vox[0], vox[1]+micro_lens_offset[0], vox[2]+micro_lens_offset[1]]
             JM = self.voxRayJM(Delta_n, opticAxis, rayDir, ell, self.optical_info['wavelength'])
             JM_list.append(JM)
-        JM_list.append(analyzer)
-        effective_JM = BirefringentRaytraceLFM.rayJM_numpy(JM_list)
+        material_JM = BirefringentRaytraceLFM.rayJM_numpy(JM_list)
+        return material_JM
+
+    def calc_cummulative_JM_of_ray_numpy(self, i, j, volume_in : BirefringentVolume, micro_lens_offset=[0,0]):
+        '''For the (i,j) pixel behind a single microlens'''
+        polarizer = self.optical_info['polarizer']
+        analyzer = self.optical_info['analyzer']
+        material_JM = self.calc_material_JM_of_ray_numpy(i, j, volume_in, micro_lens_offset)
+        effective_JM = BirefringentRaytraceLFM.rayJM_numpy([polarizer, material_JM, analyzer])
         return effective_JM
 
-    def calc_cummulative_JM_of_ray_torch(self, volume_in : BirefringentVolume, micro_lens_offset=[0,0], all_rays_at_once=False):
+    def calc_cummulative_JM_of_ray_torch(self, volume_in : BirefringentVolume, micro_lens_offset=[0,0], all_rays_at_once=False,
+                                        material_JM=None, polarizers=None, analyzers=None):
         '''This function computes the Jones Matrices of all rays defined in this object.
-            It uses pytorch's batch dimension to store each ray, and process them in parallel'''
+            It uses pytorch's batch dimension to store each ray, and process them in parallel.
+            Args:
+                material_JM ([n_rays,2,2] or [n_wavelengths,n_rays,2,2]): precomputed output of calc_material_JM_of_ray_torch,
+                                            to reuse it with different polarizers and analyzers.
+                polarizers, analyzers ([2,2] or [n_settings,2,2]): default to optical_info polarizer/analyzer.
+            Returns:
+                effective_JM ([n_rays,2,2] or [n_settings,n_rays,2,2] if a stack of settings is provided,
+                                with an n_wavelengths dimension before n_rays if material_JM has it)'''
+        if material_JM is None:
+            material_JM = self.calc_material_JM_of_ray_torch(volume_in, micro_lens_offset, all_rays_at_once)
+        polarizers, analyzers = self.get_polarizer_analyzer_torch(polarizers, analyzers, material_JM.device)
+        return self.apply_polarizer_analyzer_torch(material_JM, polarizers, analyzers)
+
+    def get_polarizer_analyzer_torch(self, polarizers=None, analyzers=None, device='cpu'):
+        '''Converts polarizers and analyzers to complex torch tensors.
+            The default ones from optical_info are converted once and cached per device.'''
+        if not hasattr(self, 'polarizer_analyzer_cache'):
+            self.polarizer_analyzer_cache = {}
+        converted = []
+        for name,elements in [('polarizer', polarizers), ('analyzer', analyzers)]:
+            if elements is None:
+                elements = self.optical_info[name]
+                key = (name, str(device))
+                cached = self.polarizer_analyzer_cache.get(key, None)
+                # Only reuse if optical_info still holds the same values
+                if cached is None or not np.array_equal(cached[0], elements):
+                    cached = (np.array(elements), torch.from_numpy(np.array(elements)).type(torch.complex64).to(device))
+                    self.polarizer_analyzer_cache[key] = cached
+                converted.append(cached[1])
+            elif torch.is_tensor(elements):
+                converted.append(elements.type(torch.complex64).to(device))
+            else:
+                converted.append(torch.from_numpy(np.array(elements)).type(torch.complex64).to(device))
+        return converted
 
-        # Fetch the voxels traversed per ray and the lengths that each ray travels through every voxel
-        ell_in_voxels = self.ray_vol_colli_lengths
-        if all_rays_at_once:
-            voxels_of_segs = self.vox_indices_ml_shifted_all
-        else:
-            # Compute the 1D index of each micro-lens.
-            # compute once and store for later.
-            # accessing 1D arrays increases training speed by 25%
-            key = str(micro_lens_offset)
-            if key not in self.vox_indices_ml_shifted.keys():
-                self.vox_indices_ml_shifted[key] = [[RayTraceLFM.ravel_index((vox[ix][0], vox[ix][1]+micro_lens_offset[0], vox[ix][2]+micro_lens_offset[1]), self.optical_info['volume_shape']) for ix in range(len(vox))] for vox in self.ray_vol_colli_indices]
-            voxels_of_segs = self.vox_indices_ml_shifted[key]
+    @staticmethod
+    def apply_polarizer_analyzer_torch(material_JM, polarizers, analyzers):
+        '''Sandwiches the material Jones Matrices between polarizers and analyzers: analyzer @ material_JM @ polarizer
+            Args:
+                material_JM ([n_rays,2,2] or [n_wavelengths,n_rays,2,2])
+                polarizers, analyzers ([2,2] or [n_settings,2,2]): stacks are broadcasted against each other.
+            Returns:
+                effective_JM (material_JM shape, or [n_settings,] + material_JM shape)'''
+        if polarizers.ndim == 2 and analyzers.ndim == 2:
+            return analyzers @ material_JM @ polarizers
+        if polarizers.ndim == 2:
+            polarizers = polarizers.unsqueeze(0)
+        if analyzers.ndim == 2:
+            analyzers = analyzers.unsqueeze(0)
+        # Add the ray (and wavelength) dimensions, so every setting is applied to all rays in a single batched product
+        material_dims = [1,] * (material_JM.ndim - 2)
+        polarizers = polarizers.reshape([polarizers.shape[0],] + material_dims + [2,2])
+        analyzers = analyzers.reshape([analyzers.shape[0],] + material_dims + [2,2])
+        return analyzers @ material_JM.unsqueeze(0) @ polarizers
+
+    def calc_material_JM_of_ray_torch(self, volume_in : BirefringentVolume, micro_lens_offset=[0,0], all_rays_at_once=False,
+                                        wavelengths=None, dispersion=None, ray_subset=None):
+        '''This function computes the Jones Matrices of the volume alone (without polarizer and analyzer) of all rays
+            defined in this object. It uses pytorch's batch dimension to store each ray, and process them in parallel.
+            The result is independent of the polarization settings and can be reused for all of them.
+            Args:
+                wavelengths ([n_wavelengths]): optional, computes the Jones Matrices for all wavelengths at once.
+                dispersion ([n_wavelengths]): optional, scale of Delta_n at each wavelength.
+                ray_subset ([n_rays_subset]): optional indices of the rays to compute, for example from get_rays_of_lenslets.
+            Returns:
+                material_JM ([n_rays,2,2] or [n_wavelengths,n_rays,2,2] if wavelengths are provided)'''
+        voxels_of_segs = self.get_voxels_of_segs(micro_lens_offset, all_rays_at_once)
+        n_steps = self.ray_vol_colli_lengths.shape[1]
+        if ray_subset is not None:
+            voxels_of_segs = [voxels_of_segs[n_ray] for n_ray in ray_subset.tolist()]
+            n_steps = max([len(vx) for vx in voxels_of_segs])
 
         assert self.optical_info == volume_in.optical_info, 'Optical info between ray-tracer and volume mismatch. This might cause issues on the border micro-lenses.'
         # Iterate the interactions of all rays with the m-th voxel
         # Some rays interact with less voxels, so we mask the rays valid
         # for this step with rays_with_voxels
-        for m in range(self.ray_vol_colli_lengths.shape[1]):
-            # Check which rays still have voxels to traverse
-            rays_with_voxels = [len(vx)>m for vx in voxels_of_segs]
-            # How many rays at this step
-            # n_rays_with_voxels = sum(rays_with_voxels)
-            # The lengths these rays traveled through the current voxels
-            ell = ell_in_voxels[rays_with_voxels,m]
-            # The voxel coordinates each ray collides with
-            vox = [vx[m] for ix,vx in enumerate(voxels_of_segs) if rays_with_voxels[ix]]
+        for m in range(n_steps):
+            rays_with_voxels, JM = self.calc_voxRayJM_at_step_torch(volume_in, voxels_of_segs, m, wavelengths, dispersion, ray_subset)
             
-            # Extract the information from the volume
-            # Birefringence 
-            Delta_n = volume_in.Delta_n[vox]
-
-            # And axis
-            opticAxis = volume_in.optic_axis[:,vox].permute(1,0)
-            # Grab the subset of precomputed ray directions that have voxels in this step
-            filtered_rayDir = self.ray_direction_basis[:,rays_with_voxels,:]
-
-            # Compute the interaction from the rays with their corresponding voxels
-            JM = self.voxRayJM( Delta_n = Delta_n,
-                                opticAxis = opticAxis, 
-                                rayDir = filtered_rayDir,
-                                ell = ell,
+            if m==0:
+                material_JM = JM
+            else:
+                material_JM[...,rays_with_voxels,:,:] = material_JM[...,rays_with_voxels,:,:] @ JM
+
+        return material_JM
+
+    def calc_material_JM_of_ray_shifts_torch(self, volume_in : BirefringentVolume, shifts):
+        '''Computes the material Jones Matrices of all rays of the MLA, for the volume displaced by each of the shifts.
+            Args:
+                shifts ([n_shifts] or [n_shifts,3]): integer axial shifts, or (z,y,x) shifts in voxels.
+            Returns:
+                material_JM ([n_shifts,n_rays,2,2])'''
+        assert self.optical_info == volume_in.optical_info, 'Optical info between ray-tracer and volume mismatch. This might cause issues on the border micro-lenses.'
+        self.precompute_MLA_volume_geometry()
+        device = self.ray_vol_colli_lengths.device
+        shifts = np.array(shifts, dtype=np.int64)
+        if shifts.ndim == 1:
+            shifts = np.stack([shifts, np.zeros_like(shifts), np.zeros_like(shifts)], 1)
+        assert shifts.ndim == 2 and shifts.shape[1] == 3, 'Shifts should be shaped [n_shifts] or [n_shifts,3]'
+        volume_shape = self.optical_info['volume_shape']
+
+        # Pad the volume once with the largest shift in each direction
+        padding = np.abs(shifts).max(0)
+        padded_shape = [int(volume_shape[ix] + 2 * padding[ix]) for ix in range(3)]
+        torch_padding = (int(padding[2]), int(padding[2]), int(padding[1]), int(padding[1]), int(padding[0]), int(padding[0]))
+        Delta_n = torch.nn.functional.pad(volume_in.Delta_n.reshape(volume_shape), torch_padding).reshape(-1)
+        optic_axis = torch.nn.functional.pad(volume_in.optic_axis.reshape([3,] + list(volume_shape)), torch_padding).reshape(3, -1)
+
+        # Collision indices in the padded volume, the shifted sample voxel at p is read from p - shift
+        vox_indices, rays_steps_valid = self.get_dense_vox_indices_torch()
+        vox_z, vox_y, vox_x = np.unravel_index(vox_indices.clamp(min=0).cpu().numpy(), volume_shape)
+        vox_indices_padded = torch.from_numpy(np.ravel_multi_index((vox_z + padding[0], vox_y + padding[1], vox_x + padding[2]),
+                                                padded_shape)).to(device)
+        shift_offsets = torch.from_numpy(np.ravel_multi_index((padding - shifts).T, padded_shape)
+                                        - np.ravel_multi_index(padding, padded_shape)).to(device)
+
+        for m in range(self.ray_vol_colli_lengths.shape[1]):
+            rays_with_voxels = rays_steps_valid[:,m]
+            # Voxel of every shift and ray: [n_shifts,n_rays_with_voxels]
+            vox = vox_indices_padded[rays_with_voxels,m].unsqueeze(0) + shift_offsets.unsqueeze(1)
+            JM = self.voxRayJM( Delta_n = Delta_n[vox],
+                                opticAxis = optic_axis[:,vox].permute(1,2,0).unsqueeze(1),
+                                rayDir = self.ray_direction_basis[:,rays_with_voxels,:],
+                                ell = self.ray_vol_colli_lengths[rays_with_voxels,m],
                                 wavelength=self.optical_info['wavelength'])
-            
             if m==0:
                 material_JM = JM
             else:
-                material_JM[rays_with_voxels,...] = material_JM[rays_with_voxels,...] @ JM
+                material_JM[:,rays_with_voxels,...] = material_JM[:,rays_with_voxels,...] @ JM
+        return material_JM
 
-        polarizer = torch.from_numpy(self.optical_info['polarizer']).type(torch.complex64).to(Delta_n.device)
-        analyzer = torch.from_numpy(self.optical_info['analyzer']).type(torch.complex64).to(Delta_n.device)
-        effective_JM = analyzer @ material_JM @ polarizer
+    def calc_material_JM_of_steps_torch(self, volume_in : BirefringentVolume, steps_mask):
+        '''Product, in the order of each ray, of the Jones Matrices of a subset of the ray-voxel steps of the MLA.
+            Only the steps with some ray in steps_mask are computed.
+            Args:
+                steps_mask ([n_rays,n_steps]): boolean mask of the steps to include, from get_dense_vox_indices_torch.
+            Returns:
+                material_JM ([n_rays,2,2]): identity for the rays without steps in the mask.'''
+        self.precompute_MLA_volume_geometry()
+        vox_indices, rays_steps_valid = self.get_dense_vox_indices_torch()
+        steps_mask = steps_mask.to(vox_indices.device) & rays_steps_valid
+        material_JM = torch.eye(2, dtype=torch.complex64, device=vox_indices.device).repeat(vox_indices.shape[0], 1, 1)
+        for m in torch.nonzero(steps_mask.any(0))[:,0].tolist():
+            rays_with_voxels = steps_mask[:,m]
+            vox = vox_indices[rays_with_voxels,m]
+            JM = self.voxRayJM( Delta_n = volume_in.Delta_n[vox],
+                                opticAxis = volume_in.optic_axis[:,vox].permute(1,0),
+                                rayDir = self.ray_direction_basis[:,rays_with_voxels,:],
+                                ell = self.ray_vol_colli_lengths[rays_with_voxels,m],
+                                wavelength=self.optical_info['wavelength'])
+            material_JM[rays_with_voxels,...] = material_JM[rays_with_voxels,...] @ JM
+        return material_JM
 
-        return effective_JM
+    def precompute_slab_JM_torch(self, volume_in : BirefringentVolume, z_range):
+        '''Splits the steps of every ray into the ones before, inside and after an axial slab of the volume,
+            and computes the Jones Matrices before and after the slab, which don't depend on its voxels.
+            The rays traverse the volume monotonically in z, so the steps inside the slab are consecutive.
+            Args:
+                z_range ([2]): first and last (excluded) voxel planes of the slab.
+            Returns:
+                slab_cache (dict): z_range, slab_steps ([n_rays,n_steps] mask), JM_before and JM_after ([n_rays,2,2])'''
+        self.precompute_MLA_volume_geometry()
+        volume_shape = self.optical_info['volume_shape']
+        vox_indices, rays_steps_valid = self.get_dense_vox_indices_torch()
+        vox_z = vox_indices.clamp(min=0) // (volume_shape[1] * volume_shape[2])
+        slab_steps = rays_steps_valid & (vox_z >= z_range[0]) & (vox_z < z_range[1])
+
+        n_steps = slab_steps.shape[1]
+        step_index = torch.arange(n_steps, device=slab_steps.device).unsqueeze(0).expand_as(slab_steps)
+        first_step = torch.where(slab_steps, step_index, n_steps).min(1).values.unsqueeze(1)
+        last_step = torch.where(slab_steps, step_index, -1).max(1).values.unsqueeze(1)
+        assert (slab_steps.sum(1, keepdim=True) == (last_step - first_step + 1).clamp(min=0)).all(), \
+            'The steps of a ray inside the slab are not consecutive'
+        # Rays that don't cross the slab only have steps before it
+        steps_before = rays_steps_valid & (step_index < first_step)
+        steps_after = rays_steps_valid & (step_index > last_step) & slab_steps.any(1, keepdim=True)
+
+        with torch.no_grad():
+            JM_before = self.calc_material_JM_of_steps_torch(volume_in, steps_before)
+            JM_after = self.calc_material_JM_of_steps_torch(volume_in, steps_after)
+        return {'z_range' : list(z_range), 'slab_steps' : slab_steps, 'JM_before' : JM_before, 'JM_after' : JM_after}
+
+    def calc_material_JM_of_slab_torch(self, volume_in : BirefringentVolume, slab_cache):
+        '''Material Jones Matrices of all the rays of the MLA, where only the voxels of the slab in slab_cache
+            (from precompute_slab_JM_torch) are read from volume_in: JM_before @ JM_slab @ JM_after.
+            Returns:
+                material_JM ([n_rays,2,2])'''
+        JM_slab = self.calc_material_JM_of_steps_torch(volume_in, slab_cache['slab_steps'])
+        return slab_cache['JM_before'] @ JM_slab @ slab_cache['JM_after']
+
+    def compute_voxel_ray_coverage(self, power=2):
+        '''Sum of the ray-voxel intersection lengths (to the given power) of all the MLA rays crossing each voxel.
+            With power=2, this is proportional to the diagonal of J^T J, where J is the Jacobian of the retardance
+            with respect to Delta_n, and it's used as a preconditioner for the reconstruction.
+            Returns:
+                coverage ([n_voxels]): zero for voxels that no ray reaches.'''
+        self.precompute_MLA_volume_geometry()
+        vox_indices, rays_steps_valid = self.get_dense_vox_indices_torch()
+        lengths = self.ray_vol_colli_lengths.detach()
+        n_voxels = int(np.prod(self.optical_info['volume_shape']))
+        return torch.bincount(vox_indices[rays_steps_valid], weights=lengths[rays_steps_valid]**power, minlength=n_voxels)
+
+    def get_volume_ray_coverage_mask(self):
+        ''' Returns a boolean mask, shaped as the volume, of the voxels crossed by at least one ray of the MLA.
+            Unlike get_volume_reachable_region, this is exact: the voxels outside it don't affect the images.'''
+        coverage = self.compute_voxel_ray_coverage(power=1)
+        return (coverage > 0).view(self.optical_info['volume_shape'])
+
+    def get_dense_vox_indices_torch(self):
+        '''Returns vox_indices_ml_shifted_all as a [n_rays,n_steps] tensor padded with -1,
+            and a boolean mask of the valid entries. Computed once and stored.'''
+        device = self.ray_vol_colli_lengths.device
+        if self.vox_indices_ml_shifted_all_dense is None:
+            n_steps = self.ray_vol_colli_lengths.shape[1]
+            dense = np.full([len(self.vox_indices_ml_shifted_all), n_steps], -1, dtype=np.int64)
+            for n_ray,vox in enumerate(self.vox_indices_ml_shifted_all):
+                dense[n_ray,:len(vox)] = vox
+            self.vox_indices_ml_shifted_all_dense = torch.from_numpy(dense)
+        dense = self.vox_indices_ml_shifted_all_dense.to(device)
+        return dense, dense >= 0
+
+    def calc_jones_vectors_of_ray_torch(self, volume_in : BirefringentVolume, input_vectors, micro_lens_offset=[0,0], all_rays_at_once=False):
+        '''Propagates Jones vectors through the volume for all rays defined in this object.
+            Instead of accumulating the full 2x2 Jones Matrix of every ray, only the 2 components of the
+            electric field are propagated, which halves the operations per ray and voxel for each input state.
+            The result is equivalent to material_JM @ input_vectors.
+            Args:
+                input_vectors ([2] or [n_states,2]): Jones vectors entering the volume, for example
+                                                    polarizer @ JonesVectorGenerators.horizonal()
+            Returns:
+                output_vectors ([n_rays,2] or [n_states,n_rays,2])'''
+        voxels_of_segs = self.get_voxels_of_segs(micro_lens_offset, all_rays_at_once)
+        assert self.optical_info == volume_in.optical_info, 'Optical info between ray-tracer and volume mismatch. This might cause issues on the border micro-lenses.'
+
+        if not torch.is_tensor(input_vectors):
+            input_vectors = torch.from_numpy(np.array(input_vectors))
+        input_vectors = input_vectors.type(torch.complex64).to(self.ray_vol_colli_lengths.device)
+        single_state = input_vectors.ndim == 1
+        # Replicate the input states for every ray: [n_states,n_rays,2,1]
+        n_rays = len(voxels_of_segs)
+        vectors = input_vectors.reshape(-1, 1, 2, 1).repeat(1, n_rays, 1, 1)
+
+        # The material Jones Matrix is JM_0 @ JM_1 @ ... @ JM_m,
+        # so the light goes through the voxels in reverse order
+        for m in reversed(range(self.ray_vol_colli_lengths.shape[1])):
+            rays_with_voxels, JM = self.calc_voxRayJM_at_step_torch(volume_in, voxels_of_segs, m)
+            vectors[:,rays_with_voxels,...] = JM.unsqueeze(0) @ vectors[:,rays_with_voxels,...]
+
+        vectors = vectors.squeeze(-1)
+        return vectors[0] if single_state else vectors
+
+    def get_voxels_of_segs(self, micro_lens_offset=[0,0], all_rays_at_once=False):
+        '''Returns the 1D voxel indices traversed by each ray, either for every micro-lens at once, or
+            for the micro-lens at micro_lens_offset'''
+        if all_rays_at_once:
+            return self.vox_indices_ml_shifted_all
+        # Compute the 1D index of each micro-lens.
+        # compute once and store for later.
+        # accessing 1D arrays increases training speed by 25%
+        key = str(micro_lens_offset)
+        if key not in self.vox_indices_ml_shifted.keys():
+            self.vox_indices_ml_shifted[key] = [[RayTraceLFM.ravel_index((vox[ix][0], vox[ix][1]+micro_lens_offset[0], vox[ix][2]+micro_lens_offset[1]), self.optical_info['volume_shape']) for ix in range(len(vox))] for vox in self.ray_vol_colli_indices]
+        return self.vox_indices_ml_shifted[key]
+
+    def calc_voxRayJM_at_step_torch(self, volume_in : BirefringentVolume, voxels_of_segs, m, wavelengths=None, dispersion=None,
+                                    ray_subset=None):
+        '''Computes the Jones Matrices of the m-th voxel traversed by each ray.
+            If ray_subset is provided, voxels_of_segs only contains the rays of the subset.
+            Returns:
+                rays_with_voxels (list of bool): which rays still have voxels to traverse at this step
+                JM ([n_rays_with_voxels,2,2] or [n_wavelengths,n_rays_with_voxels,2,2])'''
+        # Fetch the lengths that each ray travels through every voxel, and their directions
+        ell_in_voxels = self.ray_vol_colli_lengths
+        ray_direction_basis = self.ray_direction_basis
+        if ray_subset is not None:
+            ell_in_voxels = ell_in_voxels[ray_subset]
+            ray_direction_basis = ray_direction_basis[:,ray_subset]
+        # Check which rays still have voxels to traverse
+        rays_with_voxels = [len(vx)>m for vx in voxels_of_segs]
+        # The lengths these rays traveled through the current voxels
+        ell = ell_in_voxels[rays_with_voxels,m]
+        # The voxel coordinates each ray collides with
+        vox = [vx[m] for ix,vx in enumerate(voxels_of_segs) if rays_with_voxels[ix]]
+
+        # Extract the information from the volume
+        # Birefringence 
+        Delta_n = volume_in.Delta_n[vox]
+
+        # And axis
+        opticAxis = volume_in.optic_axis[:,vox].permute(1,0)
+        # Grab the subset of precomputed ray directions that have voxels in this step
+        filtered_rayDir = ray_direction_basis[:,rays_with_voxels,:]
+
+        # When only one of Delta_n and optic_axis is learned, the terms of the other one are reused
+        frozen_terms = {}
+        if ray_subset is None:
+            frozen_terms = self.get_frozen_voxRayJM_terms(volume_in, voxels_of_segs, m, Delta_n, opticAxis, filtered_rayDir, ell)
+
+        # Compute the interaction from the rays with their corresponding voxels
+        JM = self.voxRayJM( Delta_n = Delta_n,
+                            opticAxis = opticAxis, 
+                            rayDir = filtered_rayDir,
+                            ell = ell,
+                            wavelength=self.optical_info['wavelength'] if wavelengths is None else wavelengths,
+                            dispersion=dispersion,
+                            **frozen_terms)
+        return rays_with_voxels, JM
+
+    def get_frozen_voxRayJM_terms(self, volume_in : BirefringentVolume, voxels_of_segs, m, Delta_n, opticAxis, rayDir, ell):
+        '''If volume_in learns only one of Delta_n and optic_axis (members_to_learn), returns the voxRayJM terms
+            of the m-th step that only depend on the other one, computed once and stored:
+                axis_terms (optic axis fixed): cos and sin of the azimuth, and (1 - (a.r)^2) pi ell
+                delta_n_terms (Delta_n fixed): |Delta_n| pi ell
+            They are recomputed when the frozen tensor changes (a different tensor, or modified in-place).
+            Returns:
+                frozen_terms (dict): keyword arguments for voxRayJM, empty if both or none of the parameters are learned'''
+        members_to_learn = getattr(volume_in, 'members_to_learn', [])
+        if len(members_to_learn) != 1:
+            return {}
+        frozen_name = 'optic_axis' if 'Delta_n' in members_to_learn else 'Delta_n'
+        frozen_tensor = getattr(volume_in, frozen_name)
+        key = (frozen_name, frozen_tensor._version, id(voxels_of_segs))
+        if key != self.frozen_terms_key or frozen_tensor is not self.frozen_terms_tensor:
+            self.frozen_terms_key = key
+            self.frozen_terms_tensor = frozen_tensor
+            self.frozen_terms = {}
+        if m not in self.frozen_terms:
+            with torch.no_grad():
+                if frozen_name == 'optic_axis':
+                    self.frozen_terms[m] = {'axis_terms' : self.voxRayJM_axis_terms(opticAxis, rayDir, ell)}
+                else:
+                    self.frozen_terms[m] = {'delta_n_terms' : abs(Delta_n) * torch.pi * ell}
+        return self.frozen_terms[m]
+
+    @staticmethod
+    def voxRayJM_axis_terms(opticAxis, rayDir, ell):
+        '''Terms of voxRayJM (pytorch back-end) that only depend on the optic axis and the ray geometry:
+            cos and sin of the (doubled) azimuth, and the retardance per unit Delta_n and inverse wavelength'''
+        OA_dot_rayDir = torch.linalg.vecdot(opticAxis, rayDir)
+        azim = 2 * torch.arctan2(OA_dot_rayDir[...,1,:], OA_dot_rayDir[...,2,:])
+        return torch.cos(azim), torch.sin(azim), (1 - OA_dot_rayDir[...,0,:] ** 2) * torch.pi * ell
 
     def ret_and_azim_images(self, volume_in : BirefringentVolume, micro_lens_offset=[0,0]):
         '''Calculate retardance and azimuth values for a ray with a Jones Matrix'''
@@ -887,33 +1307,157 @@ class BirefringentRaytraceLFM(RayTraceLFM, BirefringentElement):
                         azim_image[i, j] = self.azimuth(effective_JM)
         return ret_image, azim_image
 
-    def ret_and_azim_images_mla_torch(self, volume_in : BirefringentVolume):
-        '''This function computes the retardance and azimuth images of the precomputed rays going through a volume for all rays at once'''
+    def ret_and_azim_images_mla_torch(self, volume_in : BirefringentVolume, material_JM=None, polarizers=None, analyzers=None):
+        '''This function computes the retardance and azimuth images of the precomputed rays going through a volume for all rays at once.
+            If a stack of polarizers and/or analyzers is provided, the images are shaped [n_settings,pixels_per_mla,pixels_per_mla]'''
 
         # Fetch needed variables
         pixels_per_mla = self.optical_info['pixels_per_ml'] * self.optical_info['n_micro_lenses']
         
         # Calculate Jones Matrices for all rays
-        effective_JM = self.calc_cummulative_JM_of_ray_torch(volume_in, all_rays_at_once=True)
+        effective_JM = self.calc_cummulative_JM_of_ray_torch(volume_in, all_rays_at_once=True, material_JM=material_JM,
+                                                            polarizers=polarizers, analyzers=analyzers)
         # Calculate retardance and azimuth
         retardance = self.retardance(effective_JM)
         azimuth = self.azimuth(effective_JM)
 
-        # Create output images
-        ret_image = torch.zeros((pixels_per_mla, pixels_per_mla), dtype=torch.float32, requires_grad=True, device=self.get_device())
-        azim_image = torch.zeros((pixels_per_mla, pixels_per_mla), dtype=torch.float32, requires_grad=True, device=self.get_device())
+        # Create output images, with a leading dimension if there are multiple polarization settings
+        images_shape = list(effective_JM.shape[:-3]) + [pixels_per_mla, pixels_per_mla]
+        ret_image = torch.zeros(images_shape, dtype=torch.float32, requires_grad=True, device=self.get_device())
+        azim_image = torch.zeros(images_shape, dtype=torch.float32, requires_grad=True, device=self.get_device())
         ret_image.requires_grad = False
         azim_image.requires_grad = False
 
         # Fill the values in the images
-        ret_image[self.ray_valid_indices_all[0,:],self.ray_valid_indices_all[1,:]] = retardance
-        azim_image[self.ray_valid_indices_all[0,:],self.ray_valid_indices_all[1,:]] = azimuth
+        ret_image[...,self.ray_valid_indices_all[0,:],self.ray_valid_indices_all[1,:]] = retardance
+        azim_image[...,self.ray_valid_indices_all[0,:],self.ray_valid_indices_all[1,:]] = azimuth
         # Alternative version
         # ret_image = torch.sparse_coo_tensor(indices = self.ray_valid_indices, values = retardance, size=(pixels_per_ml, pixels_per_ml)).to_dense()
         # azim_image = torch.sparse_coo_tensor(indices = self.ray_valid_indices, values = azimuth, size=(pixels_per_ml, pixels_per_ml)).to_dense()
 
         return ret_image, azim_image
 
+    def get_rays_of_lenslets(self, lenslets):
+        '''Returns the indices, in the MLA ray arrays (vox_indices_ml_shifted_all, ray_valid_indices_all),
+            of all the rays behind the given lenslets.
+            Args:
+                lenslets ([n_lenslets]): flat lenslet indices, from 0 to n_micro_lenses**2-1, in the same order
+                                        as precompute_MLA_volume_geometry.'''
+        self.precompute_MLA_volume_geometry()
+        n_rays_per_ml = len(self.ray_vol_colli_indices)
+        lenslets = torch.as_tensor(lenslets, dtype=torch.long).reshape(-1, 1)
+        return (lenslets * n_rays_per_ml + torch.arange(n_rays_per_ml).unsqueeze(0)).reshape(-1)
+
+    def ret_and_azim_of_rays_torch(self, volume_in : BirefringentVolume, ray_subset):
+        '''Computes the retardance and azimuth of a subset of the MLA rays, for stochastic optimization.
+            Returns:
+                retardance, azimuth ([n_rays_subset])
+                pixel_indices ([2,n_rays_subset]): where these values go in the images of ret_and_azim_images_mla_torch'''
+        self.precompute_MLA_volume_geometry()
+        ray_subset = torch.as_tensor(ray_subset, dtype=torch.long)
+        material_JM = self.calc_material_JM_of_ray_torch(volume_in, all_rays_at_once=True, ray_subset=ray_subset.to(self.get_device()))
+        effective_JM = self.calc_cummulative_JM_of_ray_torch(volume_in, all_rays_at_once=True, material_JM=material_JM)
+        pixel_indices = self.ray_valid_indices_all[:,ray_subset]
+        return self.retardance(effective_JM).float(), self.azimuth(effective_JM).float(), pixel_indices
+
+    def intensity_images_mla_torch(self, volume_in : BirefringentVolume, polarizers=None, analyzer=None, input_vector=None,
+                                    method=None):
+        '''Computes the intensity images |analyzer @ material_JM @ polarizer @ input_vector|^2 of the precomputed rays
+            going through a volume for all rays at once, for one or a stack of polarizers.
+            Args:
+                polarizers ([2,2] or [n_settings,2,2]): defaults to optical_info polarizer.
+                analyzer ([2,2]): defaults to optical_info analyzer.
+                input_vector ([2]): Jones vector of the illumination, defaults to horizontal polarization.
+                method (str):   'vectors' propagates a Jones vector per setting through the voxels,
+                                'matrices' computes the material Jones Matrices once and applies every setting to them,
+                                which is cheaper when there are more than two settings.
+                                By default, the cheaper one for the number of settings.
+            Returns:
+                intensity ([pixels_per_mla,pixels_per_mla] or [n_settings,pixels_per_mla,pixels_per_mla])'''
+        self.precompute_MLA_volume_geometry()
+        pixels_per_mla = self.optical_info['pixels_per_ml'] * self.optical_info['n_micro_lenses']
+        device = self.ray_vol_colli_lengths.device
+        polarizers, analyzer = self.get_polarizer_analyzer_torch(polarizers, analyzer, device)
+        if input_vector is None:
+            input_vector = JonesVectorGenerators.horizonal()
+        input_vector = torch.from_numpy(np.array(input_vector)).type(torch.complex64).to(device) \
+                            if not torch.is_tensor(input_vector) else input_vector.type(torch.complex64).to(device)
+
+        if method is None:
+            # Per voxel, a 2x2 product costs as much as propagating two Jones vectors
+            n_settings = polarizers.shape[0] if polarizers.ndim == 3 else 1
+            method = 'vectors' if n_settings <= 2 else 'matrices'
+        if method == 'vectors':
+            # Polarization states entering the volume: [n_settings,2]
+            input_states = (polarizers @ input_vector.unsqueeze(-1)).squeeze(-1)
+            output_vectors = self.calc_jones_vectors_of_ray_torch(volume_in, input_states, all_rays_at_once=True)
+            output_vectors = (analyzer @ output_vectors.unsqueeze(-1)).squeeze(-1)
+        elif method == 'matrices':
+            material_JM = self.calc_material_JM_of_ray_torch(volume_in, all_rays_at_once=True)
+            effective_JM = self.apply_polarizer_analyzer_torch(material_JM, polarizers, analyzer)
+            output_vectors = (effective_JM @ input_vector.unsqueeze(-1)).squeeze(-1)
+        else:
+            raise NotImplementedError
+        intensity = (output_vectors.abs()**2).sum(-1)
+
+        # Create output images, with a leading dimension if there are multiple polarization settings
+        images_shape = list(intensity.shape[:-1]) + [pixels_per_mla, pixels_per_mla]
+        intensity_image = torch.zeros(images_shape, dtype=torch.float32, device=self.get_device())
+        intensity_image[...,self.ray_valid_indices_all[0,:],self.ray_valid_indices_all[1,:]] = intensity.type(torch.float32)
+        return intensity_image
+
+    def lc_polscope_frames(self, volume_in : BirefringentVolume, swing=0.03, n_frames=5, method=None):
+        '''Simulates the raw intensity frames of an LC-PolScope acquisition, with the universal compensator
+            settings 0 to n_frames-1 and a circular analyzer crossed with the extinction setting.
+            The method of intensity_images_mla_torch defaults to 'matrices' for the 4 or 5 frames.
+            Returns:
+                frames ([n_frames,pixels_per_mla,pixels_per_mla])'''
+        polarizers = JonesMatrixGenerators.universal_compensator_stack(swing, n_frames)
+        analyzer = JonesMatrixGenerators.polscope_crossed_analyzer()
+        return self.intensity_images_mla_torch(volume_in, polarizers, analyzer, method=method)
+
+    @staticmethod
+    def ret_and_azim_from_polscope_frames(frames, swing=0.03):
+        '''Computes the retardance and azimuth from LC-PolScope frames, with the 4 or 5 frame algorithm
+            (Shribak and Oldenbourg, 2003) adapted to the settings of universal_compensator_modes,
+            where settings 1 and 4 change the retardance of LC-A, and settings 2 and 3 the retardance of LC-B.
+            Args:
+                frames ([n_frames,...]): numpy array or torch tensor with 4 or 5 frames, all pixels are processed at once.
+                swing (float): proportion of wavelength used in the acquisition.
+            Returns:
+                retardance, azimuth ([...]): in radians, with the azimuth convention of the azimuth function,
+                                            zero where the frames carry no information.'''
+        lib = torch if torch.is_tensor(frames) else np
+        n_frames = frames.shape[0]
+        tan_half_swing = np.tan(swing * np.pi)
+        I0, I1, I2, I3 = frames[0], frames[1], frames[2], frames[3]
+        if n_frames == 5:
+            I4 = frames[4]
+            denom_a = I1 + I4 - 2 * I0
+            denom_b = I2 + I3 - 2 * I0
+            diff_a = I1 - I4
+        elif n_frames == 4:
+            # The sum of the intensities for opposite swings is the same for both liquid crystals
+            denom_a = I2 + I3 - 2 * I0
+            denom_b = denom_a
+            diff_a = 2 * I1 - I2 - I3
+        else:
+            raise NotImplementedError
+        diff_b = I2 - I3
+
+        valid = (denom_a != 0) & (denom_b != 0)
+        A = diff_a / lib.where(valid, denom_a, 1 + 0 * denom_a) * tan_half_swing
+        B = diff_b / lib.where(valid, denom_b, 1 + 0 * denom_b) * tan_half_swing
+        # Retardances above pi/2 flip the sign of the denominators
+        sign = lib.where(denom_a < 0, -1 + 0 * denom_a, 1 + 0 * denom_a)
+        retardance = lib.arctan(lib.sqrt(A**2 + B**2))
+        retardance = lib.where(sign < 0, np.pi - retardance, retardance)
+        # Express the azimuth with the same convention as BirefringentRaytraceLFM.azimuth
+        azimuth = lib.remainder(np.pi / 2 - lib.arctan2(sign * A, sign * B) / 2, np.pi)
+        retardance = lib.where(valid, retardance, 0 * retardance)
+        azimuth = lib.where(valid, azimuth, 0 * azimuth)
+        return retardance, azimuth
+
     def ret_and_azim_images_torch(self, volume_in : BirefringentVolume, micro_lens_offset=[0,0]):
         '''This function computes the retardance and azimuth images of the precomputed rays going through a volume'''
         # Include offset to move to the center of the volume, as the ray collisions are computed only for a single micro-lens
@@ -946,9 +1490,16 @@ class BirefringentRaytraceLFM(RayTraceLFM, BirefringentElement):
 
     # todo: once validated merge this with numpy function
     # todo: these are re-implemented in abstract_classes in OpticalElement
-    def voxRayJM(self, Delta_n, opticAxis, rayDir, ell, wavelength):
-        '''Compute Jones matrix associated with a particular ray and voxel combination'''
+    def voxRayJM(self, Delta_n, opticAxis, rayDir, ell, wavelength, dispersion=None, axis_terms=None, delta_n_terms=None):
+        '''Compute Jones matrix associated with a particular ray and voxel combination.
+            With the pytorch back-end, wavelength can be a vector of n_wavelengths, and dispersion
+            an optional vector with the Delta_n scale at each wavelength. The ray geometry is shared
+            and the Jones Matrices are returned shaped [n_wavelengths,n_voxels,2,2]
+            The terms of a fixed parameter can be provided to skip their computation (pytorch back-end):
+                axis_terms: from voxRayJM_axis_terms, then opticAxis is not used.
+                delta_n_terms: |Delta_n| pi ell, then Delta_n is not used.'''
         if self.backend == BackEnds.NUMPY:
+            assert np.ndim(wavelength) == 0 and dispersion is None, 'Multiple wavelengths require the PYTORCH back-end'
             # Azimuth is the angle of the slow axis of retardance.
             azim = np.arctan2(np.dot(opticAxis, rayDir[1]), np.dot(opticAxis, rayDir[2]))
             if Delta_n == 0:
@@ -975,25 +1526,38 @@ class BirefringentRaytraceLFM(RayTraceLFM, BirefringentElement):
             if not torch.is_tensor(opticAxis):
                 opticAxis = torch.from_numpy(opticAxis).to(Delta_n.device)
 
-            # Dot product of optical axis and 3 ray-direction vectors
-            OA_dot_rayDir = torch.linalg.vecdot(opticAxis, rayDir)
-
-            # Azimuth is the angle of the sloq axis of retardance.
-            azim = 2 * torch.arctan2(OA_dot_rayDir[1,:], OA_dot_rayDir[2,:])
-            ret = abs(Delta_n) * (1 - OA_dot_rayDir[0,:] ** 2) * torch.pi * ell / wavelength
-
-            if True: # old method
-                offdiag = 1j * torch.sin(azim) * torch.sin(ret)
-                diag1 = torch.cos(ret) + 1j * torch.cos(azim) * torch.sin(ret)
-                diag2 = torch.conj(diag1)
-                # Construct Jones Matrix
-                JM = torch.zeros([Delta_n.shape[0], 2, 2], dtype=torch.complex64, device=Delta_n.device)
-                JM[:,0,0] = diag1
-                JM[:,0,1] = offdiag
-                JM[:,1,0] = offdiag
-                JM[:,1,1] = diag2
-            else: # Much more operations in this method
-                JM = JonesMatrixGenerators.linear_retarder(ret, azim, self.backend)
+            if axis_terms is None:
+                # Dot product of optical axis and 3 ray-direction vectors
+                OA_dot_rayDir = torch.linalg.vecdot(opticAxis, rayDir)
+
+                # Azimuth is the angle of the sloq axis of retardance.
+                azim = 2 * torch.arctan2(OA_dot_rayDir[...,1,:], OA_dot_rayDir[...,2,:])
+                cos_azim, sin_azim = torch.cos(azim), torch.sin(azim)
+                ret_geometry = 1 - OA_dot_rayDir[...,0,:] ** 2
+                ret = (abs(Delta_n) * torch.pi * ell if delta_n_terms is None else delta_n_terms) * ret_geometry
+            else:
+                cos_azim, sin_azim, ret_geometry = axis_terms
+                ret = abs(Delta_n) * ret_geometry
+            multi_wavelength = not np.isscalar(wavelength) or dispersion is not None
+            if multi_wavelength:
+                # The geometry above is wavelength independent, only the retardance gets a wavelength dimension
+                wavelength = torch.as_tensor(wavelength, dtype=ret.dtype, device=ret.device).reshape(-1, 1)
+                if dispersion is not None:
+                    ret = ret * torch.as_tensor(dispersion, dtype=ret.dtype, device=ret.device).reshape(-1, 1)
+                cos_azim, sin_azim = cos_azim.unsqueeze(0), sin_azim.unsqueeze(0)
+            ret = ret / wavelength
+
+            # Linear retarder from the cosine and sine of the azimuth, fewer operations than
+            #   JonesMatrixGenerators.linear_retarder, and the azimuth itself is not needed
+            offdiag = 1j * sin_azim * torch.sin(ret)
+            diag1 = torch.cos(ret) + 1j * cos_azim * torch.sin(ret)
+            diag2 = torch.conj(diag1)
+            # Construct Jones Matrix
+            JM = torch.zeros(list(ret.shape) + [2, 2], dtype=torch.complex64, device=Delta_n.device)
+            JM[...,0,0] = diag1
+            JM[...,0,1] = offdiag
+            JM[...,1,0] = offdiag
+            JM[...,1,1] = diag2
         return JM
 
     @staticmethod
@@ -1154,6 +1718,13 @@ class JonesMatrixGenerators(BirefringentElement):
         LCB = JonesMatrixGenerators.linear_retarder_azim0(retB)
         return LCB @ LCA @ LP
 
+    @staticmethod
+    def polscope_crossed_analyzer():
+        '''Circular analyzer that extinguishes the light of the universal compensator in the extinction setting.
+        With the conventions of this class, the extinction setting outputs left circular light, which
+        polscope_analyzer transmits, so this is its complex conjugate: linear_polarizer(-pi/4) @ quarter_waveplate(0)'''
+        return JonesMatrixGenerators.polscope_analyzer().conj()
+
     @staticmethod
     def universal_compensator_modes(setting=0, swing=0):
         '''Settings for the LC-PolScope polarizer
@@ -1180,6 +1751,13 @@ class JonesMatrixGenerators(BirefringentElement):
             retB = np.pi
         return JonesMatrixGenerators.universal_compensator(retA, retB)
 
+    @staticmethod
+    def universal_compensator_stack(swing=0, n_frames=5):
+        '''Stack of the LC-PolScope polarizer settings 0 to n_frames-1
+        Returns:
+            Jones matrices [n_frames,2,2]'''
+        return np.stack([JonesMatrixGenerators.universal_compensator_modes(setting, swing) for setting in range(n_frames)])
+
 
 class JonesVectorGenerators(BirefringentElement):
     def __init__(self, backend : BackEnds = BackEnds.NUMPY):
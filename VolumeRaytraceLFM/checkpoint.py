@@ -0,0 +1,113 @@
+'''Checkpoints of reconstructions, appended to a single HDF5 file by a background thread, to resume long runs.
+    File layout, where n is the number of checkpoints:
+        epoch [n]: next epoch to run from each checkpoint
+        volume/delta_n [n,nz,ny,nx], volume/optic_axis [n,3,nz,ny,nx]: volume estimate, chunked per checkpoint
+        state [n]: serialized trainable tensors, optimizer and random number generators states
+        losses, data_term_losses, regularization_term_losses [n_epochs]: loss history of the last checkpoint
+    The epoch dataset is extended last, so a checkpoint interrupted while being written is ignored,
+    and its entries are discarded by the next write.'''
+import io
+import os
+import h5py
+import numpy as np
+import torch
+from VolumeRaytraceLFM.telemetry import BackgroundWorker
+
+CHECKPOINT_VERSION = 1
+LOSS_NAMES = ['losses', 'data_term_losses', 'regularization_term_losses']
+
+
+def append_to_dataset(f, name, data, **kwargs):
+    '''Appends data along the first dimension of a resizable dataset, which is created if needed'''
+    if name not in f:
+        f.create_dataset(name, shape=(0,) + data.shape[1:], maxshape=(None,) + data.shape[1:],
+                         chunks=(1,) + data.shape[1:], dtype=data.dtype, **kwargs)
+    dataset = f[name]
+    n = dataset.shape[0]
+    dataset.resize(n + data.shape[0], axis=0)
+    dataset[n:] = data
+
+def write_checkpoint(filename, state):
+    '''Appends a state from Reconstructor.get_checkpoint_state to the checkpoint file'''
+    Delta_n, optic_axis = state['Delta_n'], state['optic_axis']
+    volume_shape = list(state['volume_shape'])
+    buffer = io.BytesIO()
+    torch.save({key : value for key,value in state.items() if key not in ['Delta_n', 'optic_axis'] + LOSS_NAMES}, buffer)
+    with h5py.File(filename, 'a') as f:
+        f.attrs['checkpoint_version'] = CHECKPOINT_VERSION
+        # Drop the entries of an interrupted write, so the new checkpoint has the same index in every dataset
+        n_checkpoints = f['epoch'].shape[0] if 'epoch' in f else 0
+        for name in ['volume/delta_n', 'volume/optic_axis', 'state']:
+            if name in f and f[name].shape[0] > n_checkpoints:
+                f[name].resize(n_checkpoints, axis=0)
+        append_to_dataset(f, 'volume/delta_n', Delta_n.cpu().numpy().reshape([1] + volume_shape), compression='gzip')
+        append_to_dataset(f, 'volume/optic_axis', optic_axis.cpu().numpy().reshape([1, 3] + volume_shape), compression='gzip')
+        if 'state' not in f:
+            f.create_dataset('state', shape=(0,), maxshape=(None,), chunks=(16,), dtype=h5py.vlen_dtype(np.uint8))
+        f['state'].resize(f['state'].shape[0] + 1, axis=0)
+        f['state'][-1] = np.frombuffer(buffer.getvalue(), dtype=np.uint8)
+        for name in LOSS_NAMES:
+            losses = np.array(state[name], dtype=np.float64)
+            if name not in f:
+                f.create_dataset(name, shape=(0,), maxshape=(None,), chunks=(1024,), dtype=np.float64)
+            f[name].resize(len(losses), axis=0)
+            f[name][:] = losses
+        # Last, this validates the checkpoint
+        append_to_dataset(f, 'epoch', np.array([state['ep']], dtype=np.int64))
+
+def read_checkpoint(filename, index=-1):
+    '''Reads a checkpoint from the file, the latest one by default, as a state for
+        Reconstructor.load_checkpoint_state. Returns None if the file has no checkpoints.'''
+    if not os.path.exists(filename):
+        return None
+    with h5py.File(filename, 'r') as f:
+        assert f.attrs.get('checkpoint_version', CHECKPOINT_VERSION) <= CHECKPOINT_VERSION, \
+            f'{filename} was written by a newer version'
+        if 'epoch' not in f or f['epoch'].shape[0] == 0:
+            return None
+        n_checkpoints = f['epoch'].shape[0]
+        index = index % n_checkpoints
+        # Unpickling is needed for the optimizer and random number generator states, only load trusted files
+        state = torch.load(io.BytesIO(f['state'][index].tobytes()), weights_only=False)
+        state['ep'] = int(f['epoch'][index])
+        state['Delta_n'] = torch.from_numpy(f['volume/delta_n'][index]).reshape(-1)
+        state['optic_axis'] = torch.from_numpy(f['volume/optic_axis'][index]).reshape(3, -1)
+        for name in LOSS_NAMES:
+            state[name] = f[name][:state['ep']].tolist()
+    return state
+
+def resume_from_checkpoint(reconstructor, filename):
+    '''Loads the latest checkpoint in filename into the reconstructor, if there is any.
+        Returns the epoch to continue from.'''
+    state = read_checkpoint(filename)
+    if state is not None:
+        reconstructor.load_checkpoint_state(state)
+    return reconstructor.ep
+
+
+class CheckpointCallback:
+    '''Reconstructor callback that appends a checkpoint to an HDF5 file every interval epochs.
+        The state is copied on the optimizer thread, and written by a background thread. For example:
+            checkpoints = CheckpointCallback('checkpoints.h5', interval=100)
+            reconstructor = Reconstructor(..., callbacks=[checkpoints])
+            start_ep = resume_from_checkpoint(reconstructor, 'checkpoints.h5')
+            reconstructor.reconstruct(n_epochs=n_epochs - start_ep)
+            checkpoints.close()'''
+    def __init__(self, filename, interval=100, max_pending=2):
+        self.filename = filename
+        self.interval = interval
+        self.worker = BackgroundWorker(max_pending=max_pending, name='checkpoint')
+
+    def __call__(self, reconstructor, ep):
+        if (ep + 1) % self.interval != 0:
+            return
+        state = reconstructor.get_checkpoint_state()
+        # The callbacks are called before the epoch counter is increased
+        state['ep'] = ep + 1
+        state['volume_shape'] = reconstructor.optical_info['volume_shape']
+        # Checkpoints are never dropped, this only waits if the writer is max_pending checkpoints behind
+        self.worker.submit(write_checkpoint, self.filename, state, block=True)
+
+    def close(self):
+        '''Waits for the pending checkpoints to be written'''
+        self.worker.close()
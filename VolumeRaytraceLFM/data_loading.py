@@ -0,0 +1,152 @@
+'''Loading of experimental light field measurements: rectified retardance and azimuth images or stacks of frames
+    (PNG, TIFF, HDF5 or npy), cropped to the lenslet grid described by the napari-lf metadata.
+    Stacks are memory-mapped when the file layout allows it, so only the frames (and the crop) in use are read,
+    and the upcoming frames are read by a background thread while the current one is reconstructed.'''
+import os
+import json
+import math
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import h5py
+import numpy as np
+import torch
+from PIL import Image, ImageSequence
+from VolumeRaytraceLFM.abstract_classes import memmap_hdf5_dataset
+
+# Optional imports: tifffile memory-maps uncompressed TIFF stacks, without it they are read with PIL
+try:
+    import tifffile
+except ImportError:
+    tifffile = None
+
+
+############ Metadata
+def read_lf_metadata(data_path, filename='metadata_napari-lf.txt'):
+    '''Reads the napari-lf metadata (json) stored next to the rectified images'''
+    with open(os.path.join(data_path, filename), 'r') as stream:
+        return json.loads(stream.read())
+
+def optical_info_from_metadata(metadata, optical_info):
+    '''Fills the microscope parameters of optical_info from the napari-lf calibration metadata.
+        The wavelength is stored in nm in the metadata, and in um in optical_info.'''
+    calibration = metadata['calibrate']
+    optical_info['pixels_per_ml']    = math.ceil(calibration['ulens_pitch'] / calibration['pixel_size'])
+    optical_info['M_obj']            = calibration['objective_magnification']
+    optical_info['na_obj']           = calibration['objective_na']
+    optical_info['n_medium']         = calibration['medium_index']
+    optical_info['wavelength']       = calibration['center_wavelength'] / 1000
+    optical_info['camera_pix_pitch'] = calibration['pixel_size']
+    return optical_info
+
+def lenslet_grid_crop(image_shape, pixels_per_ml, n_micro_lenses, start_ml=None):
+    '''Slices of the n_micro_lenses x n_micro_lenses lenslets starting at lenslet start_ml [row,col] of an image,
+        or at the center of the image if not provided'''
+    n_lenslets = [size // pixels_per_ml for size in image_shape[-2:]]
+    if start_ml is None:
+        start_ml = [(n - n_micro_lenses) // 2 for n in n_lenslets]
+    assert all(0 <= start and start + n_micro_lenses <= n for start,n in zip(start_ml, n_lenslets)), \
+        f'The {n_micro_lenses}x{n_micro_lenses} lenslets from {start_ml} do not fit in the {n_lenslets} lenslets of the image'
+    return tuple(slice(start * pixels_per_ml, (start + n_micro_lenses) * pixels_per_ml) for start in start_ml)
+
+
+############ Image stacks
+def open_image_stack(file_path, dataset='data'):
+    '''Opens an image or a stack of images as an array shaped [n_frames,height,width], reading as little as possible:
+        npy: memory-mapped.
+        HDF5: the dataset is memory-mapped if it's contiguous and uncompressed, otherwise it's read lazily by h5py.
+        TIFF: memory-mapped with tifffile when possible, otherwise read with PIL.
+        other formats (PNG...): read with PIL.
+        The memory-mapped arrays are copy-on-write, so they can be wrapped by torch without copies.'''
+    extension = os.path.splitext(file_path)[1].lower()
+    if extension == '.npy':
+        stack = np.load(file_path, mmap_mode='c')
+    elif extension in ['.h5', '.hdf5']:
+        h5_file = h5py.File(file_path, 'r')
+        stack = memmap_hdf5_dataset(file_path, h5_file[dataset])
+        if stack is None:
+            # The file stays open while the dataset is used
+            stack = h5_file[dataset]
+        else:
+            h5_file.close()
+    elif extension in ['.tif', '.tiff'] and tifffile is not None:
+        try:
+            stack = tifffile.memmap(file_path, mode='c')
+        except ValueError:
+            # Compressed or tiled files can't be memory-mapped
+            stack = tifffile.imread(file_path)
+    else:
+        with Image.open(file_path) as image:
+            stack = np.stack([np.array(frame) for frame in ImageSequence.Iterator(image)])
+    if len(stack.shape) == 2:
+        stack = stack[np.newaxis] if isinstance(stack, np.ndarray) else stack[()][np.newaxis]
+    assert len(stack.shape) == 3, f'Expected images shaped [n_frames,height,width], got {stack.shape} from {file_path}'
+    return stack
+
+
+class BirefringenceFrames:
+    '''Retardance and azimuth frames of an experimental acquisition, cropped to the lenslet grid.
+        Indexing returns a (retardance, azimuth) pair of float32 tensors shaped [pixels_per_mla,pixels_per_mla],
+        and iterating reads the next prefetch frames in a background thread. The pairs can be passed directly to
+        the Reconstructor, or as the frames of sequence.reconstruct_sequence. For example:
+            metadata = read_lf_metadata(data_path)
+            optical_info = optical_info_from_metadata(metadata, optical_info)
+            frames = BirefringenceFrames(f'{data_path}/Rectified_Retardance.png', f'{data_path}/Rectified_Azimuth.png',
+                                            optical_info['pixels_per_ml'], optical_info['n_micro_lenses'], start_ml=[54,50],
+                                            retardance_max=0.01, azimuth_max=math.pi)
+            ret_image_measured, azim_image_measured = frames[0]
+        Without retardance_max and azimuth_max, the memory-mapped float32 frames are returned without copies,
+        and they should not be modified in-place.'''
+    def __init__(self, retardance_path, azimuth_path, pixels_per_ml, n_micro_lenses, start_ml=None,
+                    retardance_max=None, azimuth_max=None, dataset='data', prefetch=2, device='cpu'):
+        '''Args:
+            retardance_path, azimuth_path (str): images or stacks, see open_image_stack.
+            pixels_per_ml, n_micro_lenses (int): lenslet grid, see optical_info_from_metadata.
+            start_ml (list): first lenslet [row,col] of the crop, centered by default.
+            retardance_max, azimuth_max (float): optional values the maximum of each frame is scaled to.
+            dataset (str): name of the dataset in HDF5 files.
+            prefetch (int): frames read ahead when iterating.
+            device: where the tensors are moved to, by the loader thread.'''
+        self.retardance = open_image_stack(retardance_path, dataset)
+        self.azimuth = open_image_stack(azimuth_path, dataset)
+        assert self.retardance.shape == self.azimuth.shape, \
+            f'Retardance {self.retardance.shape} and azimuth {self.azimuth.shape} stacks have different shapes'
+        self.crop = lenslet_grid_crop(self.retardance.shape, pixels_per_ml, n_micro_lenses, start_ml)
+        self.retardance_max = retardance_max
+        self.azimuth_max = azimuth_max
+        self.prefetch = prefetch
+        self.device = device
+
+    def __len__(self):
+        return self.retardance.shape[0]
+
+    @staticmethod
+    def load_image(stack, n_frame, crop, max_value):
+        '''Reads the crop of a frame as float32, scaled so its maximum is max_value if provided.
+            A memory-mapped float32 frame without scaling is a view, and becomes a tensor without copies.'''
+        image = stack[n_frame, crop[0], crop[1]]
+        if max_value is None:
+            image = image if image.dtype == np.float32 else image.astype(np.float32)
+        else:
+            image = np.multiply(image, max_value / float(image.max()), dtype=np.float32)
+        return torch.from_numpy(image)
+
+    def __getitem__(self, n_frame):
+        ret_image = self.load_image(self.retardance, n_frame, self.crop, self.retardance_max)
+        azim_image = self.load_image(self.azimuth, n_frame, self.crop, self.azimuth_max)
+        return ret_image.to(self.device), azim_image.to(self.device)
+
+    def load_frame(self, n_frame):
+        '''Frame read by the loader thread, the pages of memory-mapped frames are read here too'''
+        frame = self[n_frame]
+        for image in frame:
+            image.sum()
+        return frame
+
+    def __iter__(self):
+        with ThreadPoolExecutor(max_workers=1, thread_name_prefix='frame-loader') as loader:
+            pending = deque(loader.submit(self.load_frame, n_frame) for n_frame in range(min(self.prefetch, len(self))))
+            for n_frame in range(len(self)):
+                frame = pending.popleft().result()
+                if n_frame + self.prefetch < len(self):
+                    pending.append(loader.submit(self.load_frame, n_frame + self.prefetch))
+                yield frame
@@ -0,0 +1,204 @@
+from VolumeRaytraceLFM.abstract_classes import *
+from math import floor
+
+class FluorescentElement(OpticalElement):
+    ''' Fluorescent element, such as a raytracer, extending optical element, so it has a back-end and optical information'''
+    def __init__(self, backend : BackEnds = BackEnds.NUMPY, torch_args={},
+                optical_info=None):
+        super(FluorescentElement, self).__init__(backend=backend, torch_args=torch_args, optical_info=optical_info)
+
+        self.simul_type = SimulType.FLUOR_INTENS
+
+
+############ Implementations
+class FluorescentRaytraceLFM(RayTraceLFM, FluorescentElement):
+    """This class extends RayTraceLFM, and implements the forward function for fluorescence intensity.
+    As voxels add intensity to the rays in a commutative manner, the whole MLA forward projection
+    is a linear operator. We store it as a sparse matrix with the ray-voxel intersection lengths,
+    shaped [n_pixels_mla, n_voxels], and perform the forward projection and its adjoint
+    as sparse matrix-vector products."""
+    def __init__(
+            self, backend : BackEnds = BackEnds.NUMPY, torch_args={},
+            optical_info={}):
+        super(FluorescentRaytraceLFM, self).__init__(
+            backend=backend, torch_args=torch_args, optical_info=optical_info
+        )
+
+        # Sparse projection matrix in coordinate format, this gets filled in: precompute_projection_matrix
+        self.projection_rows = None
+        self.projection_cols = None
+        self.projection_values = None
+        # Sparse torch matrices built from the coordinates above, cached per device and dtype
+        self.projection_matrix = None
+        self.projection_matrix_T = None
+        self.projection_matrix_ready = False
+
+    def get_image_shape(self):
+        pixels_per_mla = self.optical_info['pixels_per_ml'] * self.optical_info['n_micro_lenses']
+        return [pixels_per_mla, pixels_per_mla]
+
+    def precompute_projection_matrix(self):
+        """ Expand the ray-voxel interactions from a single micro-lens to an nxn MLA,
+            and store them as a sparse matrix where each entry is the length of a ray (row)
+            inside a voxel (column)."""
+        if self.projection_matrix_ready:
+            return
+
+        volume_shape = self.optical_info['volume_shape']
+        n_micro_lenses = self.optical_info['n_micro_lenses']
+        n_voxels_per_ml = self.optical_info['n_voxels_per_ml']
+        n_pixels_per_ml = self.optical_info['pixels_per_ml']
+        n_ml_half = floor(n_micro_lenses / 2.0)
+        n_voxels_per_ml_half = floor(n_voxels_per_ml * n_micro_lenses / 2.0)
+        pixels_per_mla = n_pixels_per_ml * n_micro_lenses
+
+        # Check if the volume_size can fit these micro_lenses.
+        min_needed_volume_size = int(self.voxel_span_per_ml + (n_micro_lenses*n_voxels_per_ml))
+        assert min_needed_volume_size <= volume_shape[1] and min_needed_volume_size <= volume_shape[2], f"The volume in front of the microlenses" + \
+             f"({n_micro_lenses},{n_micro_lenses}) is to large for a volume_shape: {self.optical_info['volume_shape'][1:]}. " + \
+                f"Increase the volume_shape to at least [{min_needed_volume_size+1},{min_needed_volume_size+1}]"
+
+        # Flatten the ray-voxel collisions of a single micro-lens into 1D arrays
+        n_rays = len(self.ray_vol_colli_indices)
+        n_collisions = np.array([len(vox) for vox in self.ray_vol_colli_indices])
+        ray_of_collision = np.repeat(np.arange(n_rays), n_collisions)
+        vox_zyx = np.array([v for vox in self.ray_vol_colli_indices for v in vox], dtype=np.int64).reshape(-1, 3)
+        ray_lengths = np.asarray(self.ray_vol_colli_lengths.detach().cpu().numpy()
+                                    if self.backend == BackEnds.PYTORCH else self.ray_vol_colli_lengths)
+        lengths = np.concatenate([ray_lengths[n_ray, :n_collisions[n_ray]] for n_ray in range(n_rays)]) \
+                    if n_rays > 0 else np.zeros([0])
+        ray_valid_indices = np.asarray(self.ray_valid_indices)
+        pix_i = ray_valid_indices[0, ray_of_collision]
+        pix_j = ray_valid_indices[1, ray_of_collision]
+
+        # Offsets of every micro-lens, following the same convention as BirefringentRaytraceLFM
+        odd_mla_shift = np.mod(n_micro_lenses, 2)
+        ml_range = np.arange(-n_ml_half, n_ml_half+odd_mla_shift)
+        ml_ii, ml_jj = np.meshgrid(ml_range, ml_range, indexing='ij')
+        iix, jjx = np.meshgrid(np.arange(len(ml_range)), np.arange(len(ml_range)), indexing='ij')
+        vox_offset_y = (n_voxels_per_ml * ml_ii + self.vox_ctr_idx[1] - n_voxels_per_ml_half).reshape(-1, 1)
+        vox_offset_x = (n_voxels_per_ml * ml_jj + self.vox_ctr_idx[2] - n_voxels_per_ml_half).reshape(-1, 1)
+
+        # Rows: pixel index in the MLA image, cols: voxel index in the volume
+        rows = (pix_i + (jjx.reshape(-1, 1) * n_pixels_per_ml)) * pixels_per_mla \
+                + (pix_j + (iix.reshape(-1, 1) * n_pixels_per_ml))
+        cols = np.ravel_multi_index((np.broadcast_to(vox_zyx[:,0], rows.shape),
+                                    vox_zyx[:,1] + vox_offset_y,
+                                    vox_zyx[:,2] + vox_offset_x), volume_shape)
+        values = np.broadcast_to(lengths, rows.shape)
+
+        # Discard zero length intersections
+        valid = values.reshape(-1) > 0
+        rows, cols, values = rows.reshape(-1)[valid], cols.reshape(-1)[valid], values.reshape(-1)[valid]
+
+        if self.backend == BackEnds.NUMPY:
+            self.projection_rows = rows
+            self.projection_cols = cols
+            self.projection_values = values.astype(np.float64)
+        elif self.backend == BackEnds.PYTORCH:
+            # Save as nn.Parameters so Pytorch can handle them correctly,
+            #   for things like moving this whole class to GPU.
+            self.projection_rows = nn.Parameter(torch.from_numpy(rows), requires_grad=False)
+            self.projection_cols = nn.Parameter(torch.from_numpy(cols), requires_grad=False)
+            self.projection_values = nn.Parameter(torch.from_numpy(values.astype(np.float64)).type(torch.get_default_dtype()),
+                                                    requires_grad=False)
+
+        self.projection_matrix_ready = True
+        return
+
+    def get_projection_matrix(self, dtype=None):
+        ''' Returns the sparse projection matrix and its transpose as torch CSR tensors.
+            They are rebuilt only when the device or dtype changes.'''
+        self.precompute_projection_matrix()
+        device = self.projection_values.device
+        dtype = self.projection_values.dtype if dtype is None else dtype
+        if self.projection_matrix is None or self.projection_matrix.device != device \
+                or self.projection_matrix.dtype != dtype:
+            n_pixels = int(np.prod(self.get_image_shape()))
+            n_voxels = int(np.prod(self.optical_info['volume_shape']))
+            indices = torch.stack((self.projection_rows.data, self.projection_cols.data), 0)
+            A = torch.sparse_coo_tensor(indices, self.projection_values.data.to(dtype),
+                                        size=(n_pixels, n_voxels)).coalesce()
+            self.projection_matrix = A.to_sparse_csr()
+            self.projection_matrix_T = A.t().coalesce().to_sparse_csr()
+        return self.projection_matrix, self.projection_matrix_T
+
+    def init_volume(self, volume_in=None, init_mode='zeros'):
+        ''' Returns a fluorescence volume with the internal structure needed by this ray-tracer:
+            a single intensity value per voxel, shaped [nz,ny,nx], or [n_volumes,nz,ny,nx] for a batch.
+            Args:
+                volume_in (array or tensor): optional intensities to convert to the current back-end.
+                init_mode (str): zeros or random, used when no volume_in is provided.'''
+        volume_shape = self.optical_info['volume_shape']
+        if volume_in is None:
+            if init_mode == 'zeros':
+                volume_in = np.zeros(volume_shape)
+            elif init_mode == 'random':
+                volume_in = np.random.uniform(0, 1, volume_shape)
+            else:
+                raise NotImplementedError
+        assert list(volume_in.shape[-3:]) == list(volume_shape), \
+            f'Volume shape {list(volume_in.shape)} does not match optical_info volume_shape {volume_shape}'
+
+        if self.backend == BackEnds.NUMPY:
+            if torch.is_tensor(volume_in):
+                volume_in = volume_in.detach().cpu().numpy()
+            return np.asarray(volume_in, dtype=np.float64)
+        elif self.backend == BackEnds.PYTORCH:
+            if not torch.is_tensor(volume_in):
+                volume_in = torch.from_numpy(np.asarray(volume_in)).type(torch.get_default_dtype())
+            return volume_in.to(self.get_device())
+
+    def ray_trace_through_volume(self, volume_in=None):
+        """ Forward projects a fluorescence volume, or a batch of volumes, into the light field image.
+            Args:
+                volume_in ([nz,ny,nx] or [n_volumes,nz,ny,nx]): voxel intensities.
+            Returns:
+                image ([pixels_per_mla,pixels_per_mla] or [n_volumes,pixels_per_mla,pixels_per_mla])"""
+        self.precompute_projection_matrix()
+        image_shape = self.get_image_shape()
+        is_batched = len(volume_in.shape) == 4
+        n_pixels = int(np.prod(image_shape))
+        n_voxels = int(np.prod(self.optical_info['volume_shape']))
+
+        if self.backend == BackEnds.NUMPY:
+            volumes = np.asarray(volume_in).reshape(-1, n_voxels)
+            images = np.zeros([volumes.shape[0], n_pixels])
+            for n_vol in range(volumes.shape[0]):
+                images[n_vol] = np.bincount(self.projection_rows,
+                                            weights=self.projection_values * volumes[n_vol, self.projection_cols],
+                                            minlength=n_pixels)
+        elif self.backend == BackEnds.PYTORCH:
+            volumes = volume_in.reshape(-1, n_voxels)
+            A,_ = self.get_projection_matrix(volumes.dtype)
+            # Volumes are stored in the columns, so all of them are projected in a single product
+            images = (A @ volumes.t()).t()
+        images = images.reshape([-1,] + image_shape)
+        return images if is_batched else images[0]
+
+    def backproject(self, image_in):
+        """ Adjoint of ray_trace_through_volume: distributes the values of an image, or a batch
+            of images, along the rays into the volume.
+            Args:
+                image_in ([pixels_per_mla,pixels_per_mla] or [n_images,pixels_per_mla,pixels_per_mla])
+            Returns:
+                volume ([nz,ny,nx] or [n_images,nz,ny,nx])"""
+        self.precompute_projection_matrix()
+        volume_shape = self.optical_info['volume_shape']
+        is_batched = len(image_in.shape) == 3
+        n_pixels = int(np.prod(self.get_image_shape()))
+        n_voxels = int(np.prod(volume_shape))
+
+        if self.backend == BackEnds.NUMPY:
+            images = np.asarray(image_in).reshape(-1, n_pixels)
+            volumes = np.zeros([images.shape[0], n_voxels])
+            for n_img in range(images.shape[0]):
+                volumes[n_img] = np.bincount(self.projection_cols,
+                                            weights=self.projection_values * images[n_img, self.projection_rows],
+                                            minlength=n_voxels)
+        elif self.backend == BackEnds.PYTORCH:
+            images = image_in.reshape(-1, n_pixels)
+            _,A_T = self.get_projection_matrix(images.dtype)
+            volumes = (A_T @ images.t()).t()
+        volumes = volumes.reshape([-1,] + list(volume_shape))
+        return volumes if is_batched else volumes[0]
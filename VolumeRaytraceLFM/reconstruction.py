@@ -0,0 +1,918 @@
+'''Iterative reconstruction of birefringent volumes from retardance and azimuth images'''
+import os
+import copy
+import numpy as np
+import torch
+from tqdm import tqdm
+from VolumeRaytraceLFM.abstract_classes import BackEnds
+from VolumeRaytraceLFM.birefringence_implementations import BirefringentVolume, BirefringentRaytraceLFM
+
+
+############ Data terms
+# They compare the current forward projection against the measurements stored in the Reconstructor.
+#   Averages over the pixels go through pixel_mean, so in the stochastic mode they're estimated from the sampled pixels
+def pixel_mean(reconstructor, values):
+    '''Mean of values [...,pixels_per_mla,pixels_per_mla] over the images, or its unbiased estimate
+        from the sampled lenslets in the stochastic mode, see Reconstructor.pixel_weights'''
+    if reconstructor.pixel_weights is None:
+        return values.mean()
+    return (values * reconstructor.pixel_weights).sum() / values.numel()
+
+def vector_data_term(reconstructor, ret_image_current, azim_image_current):
+    '''Squared difference of the (retardance, azimuth) images represented as 2D vectors'''
+    co_pred, ca_pred = ret_image_current*torch.cos(azim_image_current), ret_image_current*torch.sin(azim_image_current)
+    return pixel_mean(reconstructor, (reconstructor.co_gt-co_pred)**2 + (reconstructor.ca_gt-ca_pred)**2)
+
+def stokes_data_term(reconstructor, ret_image_current, azim_image_current):
+    '''Squared difference of the (retardance, 2 azimuth) images represented as 2D vectors. The azimuth has a period of pi,
+        so unlike vector_data_term this is continuous when the azimuth wraps, as needed by the lbfgs and gauss_newton optimizers'''
+    return (stokes_residual(reconstructor, ret_image_current, azim_image_current)**2).sum()
+
+def L1_cos_data_term(reconstructor, ret_image_current, azim_image_current):
+    '''L1 on the retardance and absolute cosine of the azimuth difference'''
+    return pixel_mean(reconstructor, (reconstructor.ret_image_measured - ret_image_current).abs()) + \
+        reconstructor.training_params['azimuth_weight'] * pixel_mean(reconstructor, torch.cos(reconstructor.azim_image_measured - azim_image_current).abs())
+
+def L1all_data_term(reconstructor, ret_image_current, azim_image_current):
+    '''L1 on the retardance and on the angular difference, damped where the retardance is low'''
+    return pixel_mean(reconstructor, (reconstructor.ret_image_measured - ret_image_current).abs()) + \
+        pixel_mean(reconstructor, 2 * (1 - torch.cos(reconstructor.azim_image_measured - azim_image_current)) * reconstructor.azimuth_damp_mask)
+
+
+############ Residuals
+# Least-squares form of a data term, data_term = (residual**2).sum(), used by the Gauss-Newton solver
+def pixel_residual(reconstructor, residual):
+    '''Flattens residuals [n_channels,pixels_per_mla,pixels_per_mla], scaled so the sum of their squares
+        is a sum over the channels of pixel_mean'''
+    if reconstructor.pixel_weights is not None:
+        residual = residual * reconstructor.pixel_weights.sqrt()
+    return residual.reshape(-1) / np.sqrt(residual[0].numel())
+
+def vector_residual(reconstructor, ret_image_current, azim_image_current):
+    '''Residuals of vector_data_term, flattened'''
+    co_pred, ca_pred = ret_image_current*torch.cos(azim_image_current), ret_image_current*torch.sin(azim_image_current)
+    residual = torch.stack((reconstructor.co_gt-co_pred, reconstructor.ca_gt-ca_pred), 0)
+    return pixel_residual(reconstructor, residual)
+
+def stokes_residual(reconstructor, ret_image_current, azim_image_current):
+    '''Residuals of stokes_data_term, flattened'''
+    ret_image_measured, azim_image_measured = reconstructor.ret_image_measured, reconstructor.azim_image_measured
+    residual = torch.stack((ret_image_measured*torch.cos(2*azim_image_measured) - ret_image_current*torch.cos(2*azim_image_current),
+                            ret_image_measured*torch.sin(2*azim_image_measured) - ret_image_current*torch.sin(2*azim_image_current)), 0)
+    return pixel_residual(reconstructor, residual)
+
+
+############ Regularizers
+# They only depend on the volume being reconstructed
+def L1_regularizer(volume):
+    '''L1 or sparsity'''
+    return volume.Delta_n.abs().mean()
+
+def L2_regularizer(volume):
+    '''L2 or sparsity'''
+    return (volume.Delta_n**2).mean()
+
+def unit_regularizer(volume):
+    '''Unit length of the optic axis'''
+    return (1-(volume.optic_axis[0,...]**2+volume.optic_axis[1,...]**2+volume.optic_axis[2,...]**2)).abs().mean()
+
+DATA_TERMS = {'vector' : vector_data_term, 'stokes' : stokes_data_term, 'L1_cos' : L1_cos_data_term, 'L1all' : L1all_data_term}
+REGULARIZERS = {'L1' : L1_regularizer, 'L2' : L2_regularizer, 'unit' : unit_regularizer}
+RESIDUALS = {'vector' : vector_residual, 'stokes' : stokes_residual}
+
+
+############ Proximal operators
+# Non-smooth penalties weight * mean(h(Delta_n)) are applied through their proximal operators
+#   prox(Delta_n, threshold) = argmin_x 1/2 |x - Delta_n|^2 + threshold * h(x), with Delta_n shaped [nz,ny,nx]
+def gradient_3d(volume):
+    '''Forward differences along z, y and x with conv3d, shaped [3,nz,ny,nx], zero at the last voxel of each axis'''
+    kernel = torch.zeros([3,1,2,2,2], dtype=volume.dtype, device=volume.device)
+    kernel[:,0,0,0,0] = -1
+    kernel[0,0,1,0,0] = kernel[1,0,0,1,0] = kernel[2,0,0,0,1] = 1
+    padded = torch.nn.functional.pad(volume[None,None], (0,1,0,1,0,1), mode='replicate')
+    return torch.nn.functional.conv3d(padded, kernel)[0]
+
+def divergence_3d(field):
+    '''Negative adjoint of gradient_3d, for a field shaped [3,nz,ny,nx]'''
+    kernel = torch.zeros([3,1,2,2,2], dtype=field.dtype, device=field.device)
+    kernel[:,0,0,0,0] = -1
+    kernel[0,0,1,0,0] = kernel[1,0,0,1,0] = kernel[2,0,0,0,1] = 1
+    adjoint = torch.nn.functional.conv_transpose3d(field[None], kernel)[0,0]
+    # Adjoint of the replicate padding, the padded voxels are added to the last ones
+    adjoint[-2,:,:] += adjoint[-1,:,:]
+    adjoint[:,-2,:] += adjoint[:,-1,:]
+    adjoint[:,:,-2] += adjoint[:,:,-1]
+    return -adjoint[:-1,:-1,:-1]
+
+def total_variation_3d(volume):
+    '''Isotropic total variation, summed over the voxels'''
+    return gradient_3d(volume).norm(dim=0).sum()
+
+def L1_prox(delta_n, threshold):
+    '''Soft thresholding, threshold can be a float or a tensor shaped as delta_n'''
+    return delta_n.sign() * (delta_n.abs() - threshold).clamp(min=0)
+
+def TV_prox(delta_n, threshold, n_iterations=20):
+    '''Proximal operator of the isotropic 3D total variation, with Chambolle's dual projection algorithm:
+        delta_n - threshold * div(p), where the dual field p (|p|<=1) is found by projected gradient steps.
+        threshold can be a float or a tensor shaped as delta_n, then the prox is taken in that diagonal metric.'''
+    threshold = torch.as_tensor(threshold, dtype=delta_n.dtype, device=delta_n.device).expand_as(delta_n)
+    if threshold.max() <= 0:
+        return delta_n
+    # The dual step operator is gradient_3d threshold gradient_3d^T, the squared norm of the gradient operator
+    #   is at most 12 in 3D, so its Lipschitz constant is L = 12 threshold.max(). The iterations converge with
+    #   steps strictly below 2 / L = 1 / (6 threshold.max()), and tau = 1 / (8 threshold.max()) is below it
+    tau = 1.0 / (8 * threshold.max())
+    p = torch.zeros([3,] + list(delta_n.shape), dtype=delta_n.dtype, device=delta_n.device)
+    for _ in range(n_iterations):
+        p = p + tau * gradient_3d(threshold * divergence_3d(p) - delta_n)
+        p = p / p.norm(dim=0, keepdim=True).clamp(min=1)
+    return delta_n - threshold * divergence_3d(p)
+
+PROXIMAL_OPERATORS = {'L1' : L1_prox, 'TV' : TV_prox}
+
+
+class DenseVolumeView:
+    '''Stands for a BirefringentVolume in the forward projection, holding dense Delta_n [n_voxels] and
+        optic_axis [3,n_voxels] tensors that are not leaves, for example scattered from the compact parameters
+        of a Reconstructor. Only the attributes used by the ray-tracer and the regularizers are provided.'''
+    def __init__(self, optical_info, Delta_n, optic_axis, members_to_learn=None):
+        self.optical_info = optical_info
+        self.Delta_n = Delta_n
+        self.optic_axis = optic_axis
+        self.members_to_learn = [] if members_to_learn is None else members_to_learn
+
+    def get_delta_n(self):
+        return self.Delta_n.view(self.optical_info['volume_shape'])
+
+    def get_optic_axis(self):
+        return self.optic_axis.view([3,] + list(self.optical_info['volume_shape']))
+
+class Reconstructor:
+    '''This class owns everything needed to reconstruct a birefringent volume from a pair of retardance and azimuth images:
+        the ray-tracer, the volume estimate, the optimizer, the loss terms and the callbacks.
+        The inner loop does no plotting nor saving, those are left to the callbacks, so it can run headless
+        from scripts, notebooks or the streamlit pages.'''
+
+    @staticmethod
+    def get_training_params_template():
+        return {'n_epochs' : 51,                    # How long to train for
+                'azimuth_weight' : .5,              # Azimuth loss weight
+                'regularization_weight' : 1.0,      # Regularization weight
+                'lr' : 1e-3,                        # Learning rate
+                'azimuth_lr_multiplier' : 1,        # Learning rate multiplier for the optic axis
+                'init_delta_n_scale' : 0.0001,      # Scale of the random initial Delta_n
+                'minibatch_lenslets' : None,        # Lenslets sampled per iteration, None to use all of them
+                'minibatch_sampling' : 'uniform',   # How to sample the lenslets: uniform or retardance
+                'preconditioner' : None,            # None, or geometry to scale the gradients per voxel
+                'preconditioner_damping' : 1e-2,    # Added to the preconditioner, relative to its mean
+                'preconditioner_lr' : 0.3,          # Learning rate of SGD with a preconditioner, used instead of lr
+                'compact_parameters' : False,       # Optimize only the voxels crossed by the rays
+                'optic_axis_constraint' : None,     # None, sphere (projected steps) or angles (spherical angles)
+                'optimizer' : 'adam',               # adam (SGD with a preconditioner), lbfgs or gauss_newton
+                'lbfgs_history_size' : 10,          # Number of updates stored by L-BFGS
+                'gauss_newton_damping' : 1e-2,      # Initial Levenberg-Marquardt damping, adapted every iteration
+                'cg_iterations' : 10,               # Conjugate gradient iterations per Gauss-Newton step
+                'proximal_mode' : 'gradient',       # How to apply the proximal_terms: gradient or admm
+                'admm_rho' : 1.0,                   # ADMM penalty, relative to the weights of the proximal_terms
+                'admm_interval' : 5,                # Optimizer steps between ADMM updates
+                'block_slab_thickness' : None,      # Voxel planes optimized at a time, None to optimize the whole volume
+                'block_iterations' : 5}             # Optimizer steps per slab
+
+    def __init__(self, rays : BirefringentRaytraceLFM, ret_image_measured, azim_image_measured,
+                volume_estimation : BirefringentVolume = None, training_params=None,
+                data_term='vector', regularizers=None, callbacks=None, proximal_terms=None):
+        '''Reconstructor
+        Args:
+            rays (BirefringentRaytraceLFM): ray-tracer with the geometry already computed, with the PYTORCH back-end.
+            ret_image_measured, azim_image_measured (tensors): measured images, shaped [pixels_per_mla,pixels_per_mla]
+            volume_estimation (BirefringentVolume): initial guess, a random one is created if not provided.
+            training_params (dict): see get_training_params_template, missing entries take the template values.
+            data_term (str or function): key of DATA_TERMS, or function(reconstructor, ret_image, azim_image)
+            regularizers (list): pairs (regularizer, weight), where regularizer is a key of REGULARIZERS or function(volume).
+                                    Defaults to [('unit', training_params['regularization_weight'])],
+                                    or no regularizers if the optic axes are constrained to unit length.
+            callbacks (list): functions(reconstructor, ep) called after every iteration, for plotting or saving.
+                                    The last images are stored in ret_image_current and azim_image_current.
+                                    In the stochastic mode (minibatch_lenslets) only the sampled pixels are projected,
+                                    the rest of these images contain the measurements, and pixel_weights holds
+                                    the weights of the pixels in the data terms (see pixel_mean).
+            proximal_terms (list): pairs (operator, weight) of non-smooth penalties weight * mean(h(Delta_n)),
+                                    where operator is a key of PROXIMAL_OPERATORS or function(Delta_n, threshold).
+                                    They are applied with proximal steps or ADMM, see apply_proximal_terms.
+            '''
+        assert rays.backend == BackEnds.PYTORCH, 'Reconstructor requires the PYTORCH back-end to compute gradients'
+        self.rays = rays
+        self.optical_info = rays.optical_info
+        self.training_params = self.get_training_params_template()
+        if training_params is not None:
+            self.training_params.update(training_params)
+        self.device = rays.get_device()
+
+        # Weights of the pixels in the data terms, None to average all of them, see forward_minibatch
+        self.pixel_weights = None
+        self.set_measurements(ret_image_measured, azim_image_measured)
+
+        # Loss terms
+        self.data_term = DATA_TERMS[data_term] if isinstance(data_term, str) else data_term
+        self.residual_term = RESIDUALS.get(data_term) if isinstance(data_term, str) else None
+        if regularizers is None:
+            regularizers = [] if self.training_params['optic_axis_constraint'] is not None \
+                            else [('unit', self.training_params['regularization_weight'])]
+        self.regularizers = [(REGULARIZERS[reg] if isinstance(reg, str) else reg, weight) for reg,weight in regularizers]
+        self.callbacks = [] if callbacks is None else list(callbacks)
+        proximal_terms = [] if proximal_terms is None else proximal_terms
+        self.proximal_terms = [(PROXIMAL_OPERATORS[prox] if isinstance(prox, str) else prox, weight) for prox,weight in proximal_terms]
+
+        if volume_estimation is None:
+            volume_estimation = self.init_volume_estimation()
+        self.volume_estimation = volume_estimation.to(self.device)
+        self.active_voxels = None
+        if self.training_params['compact_parameters']:
+            self.create_compact_parameters()
+        self.optic_axis_angles = None
+        self.optic_axis_hooks = []
+        if self.training_params['optic_axis_constraint'] is not None:
+            self.create_optic_axis_constraint()
+        self.preconditioner_hooks = []
+        self.delta_n_curvature = None
+        if self.training_params['preconditioner'] is not None:
+            self.create_preconditioner()
+        self.optimizer = self.create_optimizer()
+        self.gauss_newton_damping = self.training_params['gauss_newton_damping']
+        self.slab_cache = None
+        if self.training_params['block_slab_thickness'] is not None:
+            assert self.training_params['optimizer'] == 'adam' and self.training_params['minibatch_lenslets'] is None, \
+                'Block-coordinate reconstruction requires the adam optimizer and the full images'
+        # ADMM splitting variable and scaled dual variable of Delta_n, shaped [n_voxels]
+        self.admm_z = None
+        self.admm_u = None
+        if len(self.proximal_terms) > 0:
+            assert self.training_params['proximal_mode'] in ['gradient', 'admm'], f"Unknown proximal_mode {self.training_params['proximal_mode']}"
+            if self.training_params['proximal_mode'] == 'gradient':
+                assert self.training_params['optimizer'] == 'adam', 'Proximal gradient steps require the adam (or preconditioned SGD) optimizer, use admm instead'
+            else:
+                self.admm_z = self.volume_estimation.Delta_n.detach().clone()
+                self.admm_u = torch.zeros_like(self.admm_z)
+
+        # History
+        self.losses = []
+        self.data_term_losses = []
+        self.regularization_term_losses = []
+        self.ret_image_current = None
+        self.azim_image_current = None
+        self.ep = 0
+
+    def set_measurements(self, ret_image_measured, azim_image_measured):
+        '''Stores the measurements and the derived quantities used by the data terms.
+            Calling it again replaces the measurements, the optimization continues from the current estimate,
+            for example with the next frame of a time-lapse (see sequence.py).'''
+        self.ret_image_measured = ret_image_measured.detach().to(self.device)
+        self.azim_image_measured = azim_image_measured.detach().to(self.device)
+        self.co_gt = self.ret_image_measured*torch.cos(self.azim_image_measured)
+        self.ca_gt = self.ret_image_measured*torch.sin(self.azim_image_measured)
+        # As the azimuth is irrelevant when the retardance is low, lets scale error with a mask
+        self.azimuth_damp_mask = (self.ret_image_measured / self.ret_image_measured.max())
+        self.lenslet_sampling_weights = self.compute_lenslet_sampling_weights(self.training_params['minibatch_sampling'])
+
+    def init_volume_estimation(self):
+        '''Random initial guess, the range of random voxels should be close to the expected birefringence.
+            The volume outside the FOV of the microscope is masked out.'''
+        volume_estimation = BirefringentVolume(backend=BackEnds.PYTORCH, optical_info=self.optical_info, \
+                                                volume_creation_args = {'init_mode' : 'random'})
+        # Let's rescale the random to initialize the volume
+        with torch.no_grad():
+            volume_estimation.Delta_n *= self.training_params['init_delta_n_scale']
+            mask = self.rays.get_volume_reachable_region()
+            volume_estimation.Delta_n[mask.view(-1)==0] = 0
+        # Indicate to this object that we are going to optimize Delta_n and optic_axis
+        volume_estimation.members_to_learn.append('Delta_n')
+        volume_estimation.members_to_learn.append('optic_axis')
+        return volume_estimation
+
+    def create_compact_parameters(self):
+        '''Creates the parameters for the voxels crossed by at least one ray only (active_voxels), shaped
+            [n_active] for Delta_n and [3,n_active] for the optic axis. They are scattered into a dense volume
+            for every forward projection (get_forward_volume), and copied into volume_estimation after every step.
+            The voxels outside the rays are set to zero, as they don't affect the images.'''
+        volume = self.volume_estimation
+        mask = self.rays.get_volume_ray_coverage_mask().to(self.device).view(-1)
+        self.active_voxels = mask.nonzero()[:,0]
+        with torch.no_grad():
+            volume.Delta_n[~mask] = 0
+        self.Delta_n_compact = torch.nn.Parameter(volume.Delta_n.detach()[self.active_voxels].clone(),
+                                                    requires_grad='Delta_n' in volume.members_to_learn)
+        self.optic_axis_compact = torch.nn.Parameter(volume.optic_axis.detach()[:,self.active_voxels].clone(),
+                                                    requires_grad='optic_axis' in volume.members_to_learn)
+        # The dense volume is only updated through the compact parameters
+        volume.Delta_n.requires_grad_(False)
+        volume.optic_axis.requires_grad_(False)
+
+    def create_optic_axis_constraint(self):
+        '''Keeps the optic axes on the unit sphere, instead of penalizing their length with the unit regularizer.
+            sphere: Riemannian steps, the gradients are projected onto the plane tangent to each optic axis,
+                    and the optic axes are normalized after every step (retraction), see retract_optic_axis.
+            angles: the optic axes are replaced by their spherical angles [2,n_voxels] (optic_axis_angles),
+                    see BirefringentVolume.angles_to_optic_axis.'''
+        constraint = self.training_params['optic_axis_constraint']
+        optic_axis = self.get_trainable_tensors()[1]
+        with torch.no_grad():
+            optic_axis /= optic_axis.norm(dim=0, keepdim=True).clamp(min=1e-12)
+        if constraint == 'sphere':
+            def project_to_tangent(grad):
+                with torch.no_grad():
+                    return grad - (grad * optic_axis).sum(0, keepdim=True) * optic_axis
+            for hook in self.optic_axis_hooks:
+                hook.remove()
+            self.optic_axis_hooks = [optic_axis.register_hook(project_to_tangent)]
+        elif constraint == 'angles':
+            self.optic_axis_angles = torch.nn.Parameter(BirefringentVolume.optic_axis_to_angles(optic_axis.detach()),
+                                                        requires_grad=optic_axis.requires_grad)
+            # The optic axes are only updated through the angles
+            optic_axis.requires_grad_(False)
+        else:
+            raise NotImplementedError
+
+    def retract_optic_axis(self):
+        '''Normalizes the optic axes after a projected step, with the sphere optic_axis_constraint'''
+        if self.training_params['optic_axis_constraint'] != 'sphere':
+            return
+        optic_axis = self.get_trainable_tensors()[1]
+        with torch.no_grad():
+            optic_axis /= optic_axis.norm(dim=0, keepdim=True).clamp(min=1e-12)
+
+    def get_trainable_tensors(self):
+        '''Returns the Delta_n and optic_axis tensors seen by the optimizer: the dense ones from volume_estimation,
+            or the compact ones with compact_parameters. With the angles optic_axis_constraint,
+            the second one is optic_axis_angles instead.'''
+        if self.active_voxels is None:
+            Delta_n, optic_axis = self.volume_estimation.Delta_n, self.volume_estimation.optic_axis
+        else:
+            Delta_n, optic_axis = self.Delta_n_compact, self.optic_axis_compact
+        if self.optic_axis_angles is not None:
+            optic_axis = self.optic_axis_angles
+        return Delta_n, optic_axis
+
+    def get_forward_volume(self, trainable_tensors=None):
+        '''Volume to forward project and regularize. With compact_parameters or optic axis angles, a DenseVolumeView
+            built from the trainable tensors, with the compact ones scattered into copies of the dense tensors,
+            so the gradients reach the trainable tensors.
+            Other values of the trainable tensors (Delta_n, optic_axis) can be provided, as done by the Gauss-Newton solver.
+            A member not in members_to_learn is taken from volume_estimation as is, so the ray-tracer can reuse
+            the terms computed from it (see BirefringentRaytraceLFM.get_frozen_voxRayJM_terms).'''
+        if trainable_tensors is None:
+            if self.active_voxels is None and self.optic_axis_angles is None:
+                return self.volume_estimation
+            trainable_tensors = self.get_trainable_tensors()
+        Delta_n, optic_axis = trainable_tensors
+        if self.optic_axis_angles is not None:
+            optic_axis = BirefringentVolume.angles_to_optic_axis(optic_axis)
+        if self.active_voxels is not None:
+            Delta_n_compact, optic_axis_compact = Delta_n, optic_axis
+            Delta_n = self.volume_estimation.Delta_n.detach().clone()
+            Delta_n[self.active_voxels] = Delta_n_compact
+            optic_axis = self.volume_estimation.optic_axis.detach().clone()
+            optic_axis[:,self.active_voxels] = optic_axis_compact
+        members_to_learn = self.volume_estimation.members_to_learn
+        if 'Delta_n' not in members_to_learn:
+            Delta_n = self.volume_estimation.Delta_n
+        if 'optic_axis' not in members_to_learn:
+            optic_axis = self.volume_estimation.optic_axis
+        return DenseVolumeView(self.optical_info, Delta_n, optic_axis, members_to_learn)
+
+    def update_volume_estimation(self):
+        '''Copies the compact parameters, or the optic axes from their angles,
+            into volume_estimation, which the callbacks and the caller see'''
+        if self.active_voxels is None and self.optic_axis_angles is None:
+            return
+        # Frozen members are left untouched, so their version doesn't change
+        members_to_learn = self.volume_estimation.members_to_learn
+        with torch.no_grad():
+            if self.optic_axis_angles is not None and 'optic_axis' in members_to_learn:
+                optic_axis = BirefringentVolume.angles_to_optic_axis(self.optic_axis_angles)
+                (self.volume_estimation.optic_axis if self.active_voxels is None else self.optic_axis_compact).copy_(optic_axis)
+            if self.active_voxels is not None:
+                if 'Delta_n' in members_to_learn:
+                    self.volume_estimation.Delta_n[self.active_voxels] = self.Delta_n_compact
+                if 'optic_axis' in members_to_learn:
+                    self.volume_estimation.optic_axis[:,self.active_voxels] = self.optic_axis_compact
+
+    def compute_geometry_curvature(self):
+        '''Computes the geometry part of the diagonal curvature of the data term (delta_n_curvature),
+            for the trainable voxels, see create_preconditioner and get_geometry_curvature.'''
+        coverage = self.rays.compute_voxel_ray_coverage(power=2).to(self.device)
+        if self.active_voxels is not None:
+            coverage = coverage[self.active_voxels]
+        # The data terms are averaged over the image pixels
+        scale = 2 * (2 * torch.pi / self.optical_info['wavelength'])**2 / self.ret_image_measured.numel()
+        self.delta_n_curvature = scale * coverage
+        self.covered_voxels = coverage > 0
+        # Smallest Delta_n that explains the measured retardance along the longest ray, to bound the optic axis steps
+        ray_lengths = self.rays.ray_vol_colli_lengths.detach().sum(1)
+        self.delta_n_reference = float(self.ret_image_measured.abs().max() / (2 * torch.pi / self.optical_info['wavelength'] * ray_lengths.max()))
+
+    def get_geometry_curvature(self):
+        '''Returns the damped diagonal curvature for Delta_n and for the optic axis of every trainable voxel,
+            the latter depends on the current Delta_n. The damping (preconditioner_damping) is relative
+            to the mean curvature of the voxels crossed by rays.'''
+        damping = self.training_params['preconditioner_damping']
+        covered = self.covered_voxels
+        with torch.no_grad():
+            delta_n_squared = self.get_trainable_tensors()[0].detach()**2
+            delta_n_squared = delta_n_squared.clamp(min=self.delta_n_reference**2)
+            delta_n_curvature = self.delta_n_curvature
+            optic_axis_curvature = 4 * self.delta_n_curvature * delta_n_squared
+            return delta_n_curvature + damping * delta_n_curvature[covered].mean(), \
+                optic_axis_curvature + damping * optic_axis_curvature[covered].mean()
+
+    def create_preconditioner(self):
+        '''Diagonal (Gauss-Newton) preconditioner derived from the ray geometry, applied to the gradients with hooks.
+            The retardance of a ray is about the sum of |Delta_n| 2 pi ell / wavelength over its voxels, so the sensitivity of
+            the data term to the Delta_n of a voxel is proportional to the sum of the squared lengths of the rays crossing it.
+            The sensitivity to the optic axis is also proportional to the current Delta_n of the voxel squared,
+            which gives Delta_n and optic_axis their own scales without an azimuth_lr_multiplier.'''
+        assert self.training_params['preconditioner'] == 'geometry', f"Unknown preconditioner {self.training_params['preconditioner']}"
+        self.compute_geometry_curvature()
+        Delta_n, optic_axis = self.get_trainable_tensors()
+
+        def precondition_delta_n(grad):
+            curvature = self.get_geometry_curvature()[0].type(grad.dtype)
+            return grad / curvature
+        def precondition_optic_axis(grad):
+            curvature = self.get_geometry_curvature()[1].type(grad.dtype)
+            return grad / curvature.unsqueeze(0)
+
+        for hook in self.preconditioner_hooks:
+            hook.remove()
+        self.preconditioner_hooks = [Delta_n.register_hook(precondition_delta_n),
+                                    optic_axis.register_hook(precondition_optic_axis)]
+
+    def get_lr(self):
+        '''Learning rate of Delta_n: preconditioner_lr with a preconditioner, as the preconditioned gradients
+            have a different scale than the ones Adam normalizes, lr otherwise'''
+        if self.training_params['preconditioner'] is not None:
+            return self.training_params['preconditioner_lr']
+        return self.training_params['lr']
+
+    def create_optimizer(self):
+        '''Adam optimizer, as Delta_n has much lower values than optic_axis, the optic axis can have its own learning rate.
+            With a preconditioner the gradients already have the right scale per voxel, and SGD with momentum
+            is used instead, with preconditioner_lr (below 1) instead of lr for both tensors, see get_lr.
+            The preconditioner replaces the hand-tuned azimuth_lr_multiplier, which must be left to 1.
+            With the lbfgs optimizer, L-BFGS with a strong Wolfe line search, where lr is the initial step (usually 1).
+            The gauss_newton optimizer doesn't use a torch optimizer, see gauss_newton_iteration.'''
+        optimizer = self.training_params['optimizer']
+        assert optimizer in ['adam', 'lbfgs', 'gauss_newton'], f'Unknown optimizer {optimizer}'
+        if optimizer != 'adam':
+            assert self.training_params['minibatch_lenslets'] is None, f'The {optimizer} optimizer requires the full images'
+            assert self.training_params['preconditioner'] is None, f'The {optimizer} optimizer requires unmodified gradients'
+        if optimizer == 'gauss_newton':
+            assert self.residual_term is not None, 'The gauss_newton optimizer requires a data term from RESIDUALS'
+            return None
+        lr = self.get_lr()
+        azimuth_lr_multiplier = self.training_params['azimuth_lr_multiplier']
+        if self.training_params['preconditioner'] is not None:
+            assert azimuth_lr_multiplier == 1, \
+                f'The preconditioner scales the optic axis steps, remove azimuth_lr_multiplier={azimuth_lr_multiplier}'
+        trainable_names = self.volume_estimation.members_to_learn
+        Delta_n, optic_axis = self.get_trainable_tensors()
+        parameters = []
+        if 'optic_axis' in trainable_names:
+            parameters.append({'params' : [optic_axis], 'lr' : lr * azimuth_lr_multiplier})
+        if 'Delta_n' in trainable_names:
+            parameters.append({'params' : [Delta_n], 'lr' : lr})
+        if optimizer == 'lbfgs':
+            # One L-BFGS iteration per epoch, with up to 25 evaluations for the line search.
+            #   The gradients of the retardance losses are tiny, the default tolerances would stop the iterations
+            return torch.optim.LBFGS([group['params'][0] for group in parameters], lr=lr, max_iter=1, max_eval=25,
+                                    tolerance_grad=0, tolerance_change=0,
+                                    history_size=self.training_params['lbfgs_history_size'], line_search_fn='strong_wolfe')
+        if self.training_params['preconditioner'] is not None:
+            return torch.optim.SGD(parameters, lr=lr, momentum=0.9)
+        return torch.optim.Adam(parameters, lr=lr)
+
+    def get_optimized_tensors(self):
+        '''Trainable tensors listed in members_to_learn, in the order (Delta_n, optic_axis)'''
+        trainable_names = self.volume_estimation.members_to_learn
+        return [tensor for name,tensor in zip(['Delta_n', 'optic_axis'], self.get_trainable_tensors()) if name in trainable_names]
+
+    def compute_loss(self, ret_image_current, azim_image_current, volume=None):
+        '''Returns the total loss, the data term and the (weighted) regularization term.
+            The regularizers are applied to volume, or to get_forward_volume() if not provided.'''
+        volume = self.get_forward_volume() if volume is None else volume
+        data_term = self.data_term(self, ret_image_current, azim_image_current)
+        regularization_term = torch.zeros([], device=data_term.device)
+        for regularizer,weight in self.regularizers:
+            regularization_term = regularization_term + weight * regularizer(volume)
+        if self.admm_z is not None:
+            # Augmented Lagrangian of the splitting Delta_n = z
+            rho = self.training_params['admm_rho'] * sum(weight for _,weight in self.proximal_terms)
+            regularization_term = regularization_term + rho / 2 * ((volume.Delta_n - self.admm_z + self.admm_u)**2).mean()
+        return data_term + regularization_term, data_term, regularization_term
+
+    def get_delta_n_step_sizes(self):
+        '''Step applied by the optimizer to each trainable Delta_n per unit of gradient: lr / curvature with the
+            preconditioner, or lr / (sqrt(second moment) + eps) with Adam, which defines the metric of the proximal steps'''
+        Delta_n = self.get_trainable_tensors()[0]
+        lr = self.get_lr()
+        if self.training_params['preconditioner'] is not None:
+            return lr / self.get_geometry_curvature()[0].type(Delta_n.dtype)
+        state = self.optimizer.state.get(Delta_n, {})
+        if 'exp_avg_sq' not in state:
+            return torch.full_like(Delta_n, lr)
+        group = [group for group in self.optimizer.param_groups if any(p is Delta_n for p in group['params'])][0]
+        beta2 = group['betas'][1]
+        second_moment = state['exp_avg_sq'] / (1 - beta2 ** float(state['step']))
+        return group['lr'] / (second_moment.sqrt() + group['eps'])
+
+    def apply_proximal_operators(self, delta_n, thresholds):
+        '''Applies the proximal_terms in sequence to a dense Delta_n [n_voxels], with thresholds per unit weight.
+            With several terms this approximates the proximal operator of their sum, as TV followed by L1
+            (which is exact in 1D), so the sparsity terms should be the last ones.'''
+        volume_shape = self.optical_info['volume_shape']
+        delta_n = delta_n.view(volume_shape)
+        thresholds = torch.as_tensor(thresholds, dtype=delta_n.dtype, device=delta_n.device)
+        thresholds = thresholds.view(volume_shape) if thresholds.numel() > 1 else thresholds.expand(delta_n.shape)
+        for prox,weight in self.proximal_terms:
+            delta_n = prox(delta_n, weight * thresholds)
+        return delta_n.reshape(-1)
+
+    def apply_proximal_terms(self):
+        '''Applies the non-smooth proximal_terms to Delta_n after an optimizer step.
+            gradient: proximal gradient step, the penalties are weight * mean(h), so the threshold of each voxel is
+                        its step size (get_delta_n_step_sizes) divided by the number of voxels.
+            admm: every admm_interval steps, z = prox(Delta_n + u) and u = u + Delta_n - z, the optimizer minimizes
+                        the smooth loss plus the augmented term rho/2 mean((Delta_n - z + u)^2), see compute_loss.'''
+        if len(self.proximal_terms) == 0:
+            return
+        Delta_n = self.get_trainable_tensors()[0]
+        with torch.no_grad():
+            if self.training_params['proximal_mode'] == 'gradient':
+                n_voxels = int(np.prod(self.optical_info['volume_shape']))
+                steps = self.get_delta_n_step_sizes() / n_voxels
+                if self.active_voxels is None:
+                    Delta_n.copy_(self.apply_proximal_operators(Delta_n, steps))
+                else:
+                    # The operators work on the dense volume, the voxels outside the rays don't move
+                    dense_delta_n = self.volume_estimation.Delta_n.detach().clone()
+                    dense_delta_n[self.active_voxels] = Delta_n
+                    dense_steps = torch.zeros_like(dense_delta_n)
+                    dense_steps[self.active_voxels] = steps
+                    Delta_n.copy_(self.apply_proximal_operators(dense_delta_n, dense_steps)[self.active_voxels])
+            elif (self.ep + 1) % self.training_params['admm_interval'] == 0:
+                # The dense Delta_n, volume_estimation is updated after this
+                dense_delta_n = self.get_forward_volume().Delta_n.detach()
+                rho = self.training_params['admm_rho'] * sum(weight for _,weight in self.proximal_terms)
+                self.admm_z = self.apply_proximal_operators(dense_delta_n + self.admm_u, 1 / rho)
+                self.admm_u = self.admm_u + dense_delta_n - self.admm_z
+
+    def compute_lenslet_sampling_weights(self, sampling='uniform'):
+        '''Probability of sampling each lenslet in the stochastic mode, ordered as in get_rays_of_lenslets'''
+        n_micro_lenses = self.optical_info['n_micro_lenses']
+        pixels_per_ml = self.optical_info['pixels_per_ml']
+        if sampling == 'uniform':
+            weights = torch.ones(n_micro_lenses**2)
+        elif sampling == 'retardance':
+            # Total retardance behind each lenslet, lenslet (ii,jj) covers the pixels [jj*p:(jj+1)*p, ii*p:(ii+1)*p]
+            ret_per_lenslet = self.ret_image_measured.abs().reshape(n_micro_lenses, pixels_per_ml, n_micro_lenses, pixels_per_ml).sum((1,3))
+            weights = ret_per_lenslet.t().reshape(-1).cpu().double()
+            # Keep a small probability for the lenslets without retardance
+            weights = weights + 1e-3 * weights.mean() + 1e-12
+        else:
+            raise NotImplementedError
+        return weights / weights.sum()
+
+    def sample_lenslets(self):
+        '''Random minibatch_lenslets lenslets, and their importance weights 1 / (n_samples * probability), so that
+            the weighted sum of any quantity over the sampled lenslets is an unbiased estimate of its sum over all of them.
+            Uniform samples are drawn without replacement, where each lenslet is included with probability
+            n_samples / n_lenslets. Otherwise they're drawn with replacement, and repeated lenslets add their weights.
+            Returns:
+                lenslets ([n_lenslets_sampled]): flat indices, as in get_rays_of_lenslets.
+                weights ([n_lenslets_sampled])'''
+        probabilities = self.lenslet_sampling_weights
+        n_samples = min(self.training_params['minibatch_lenslets'], len(probabilities))
+        if self.training_params['minibatch_sampling'] == 'uniform':
+            lenslets = torch.multinomial(probabilities, n_samples, replacement=False)
+            counts = torch.ones(n_samples, dtype=probabilities.dtype)
+        else:
+            lenslets, counts = torch.multinomial(probabilities, n_samples, replacement=True).unique(return_counts=True)
+        return lenslets, counts / (n_samples * probabilities[lenslets])
+
+    def lenslet_pixel_weights(self, lenslets, weights):
+        '''Image [pixels_per_mla,pixels_per_mla] with the weight of each lenslet on its pixels, zero elsewhere.
+            Lenslet l covers the pixels of the block row l % n_micro_lenses and column l // n_micro_lenses.'''
+        n_micro_lenses = self.optical_info['n_micro_lenses']
+        pixels_per_ml = self.optical_info['pixels_per_ml']
+        lenslet_weights = torch.zeros(n_micro_lenses**2, dtype=self.ret_image_measured.dtype)
+        lenslet_weights[lenslets] = weights.type(lenslet_weights.dtype)
+        lenslet_weights = lenslet_weights.reshape(n_micro_lenses, n_micro_lenses).t()
+        pixel_weights = lenslet_weights.repeat_interleave(pixels_per_ml, dim=0).repeat_interleave(pixels_per_ml, dim=1)
+        return pixel_weights.to(self.device)
+
+    def forward_minibatch(self, volume=None):
+        '''Forward projects only the rays behind a random subset of lenslets. The other pixels of the returned images
+            take the measured values, and pixel_weights is updated so the data terms are unbiased estimates
+            of the full-image data terms, with the sampled pixels weighted by the importance of their lenslet.'''
+        volume = self.get_forward_volume() if volume is None else volume
+        lenslets, weights = self.sample_lenslets()
+        self.pixel_weights = self.lenslet_pixel_weights(lenslets, weights)
+        ray_subset = self.rays.get_rays_of_lenslets(lenslets)
+        retardance, azimuth, pixel_indices = self.rays.ret_and_azim_of_rays_torch(volume, ray_subset)
+        pixel_indices = (pixel_indices[0].to(self.device), pixel_indices[1].to(self.device))
+        ret_image_current = self.ret_image_measured.index_put(pixel_indices, retardance.type(self.ret_image_measured.dtype))
+        azim_image_current = self.azim_image_measured.index_put(pixel_indices, azimuth.type(self.azim_image_measured.dtype))
+        return ret_image_current, azim_image_current
+
+    def start_block(self):
+        '''Selects the axial slab optimized in the next block_iterations steps, cycling through the volume.
+            The Jones Matrices of the rays before and after the slab are cached (slab_cache), so the forward projection
+            only recomputes the steps inside it, and the voxels outside the slab are kept fixed.
+            The optimizer state is reset, as each slab is a different sub-problem.'''
+        volume_shape = self.optical_info['volume_shape']
+        thickness = self.training_params['block_slab_thickness']
+        n_slabs = int(np.ceil(volume_shape[0] / thickness))
+        n_slab = (self.ep // self.training_params['block_iterations']) % n_slabs
+        z_range = [n_slab * thickness, min((n_slab + 1) * thickness, volume_shape[0])]
+        with torch.no_grad():
+            self.slab_cache = self.rays.precompute_slab_JM_torch(self.get_forward_volume(), z_range)
+        # Axial plane of every trainable voxel
+        voxels = torch.arange(int(np.prod(volume_shape)), device=self.device) if self.active_voxels is None else self.active_voxels
+        voxels_z = voxels // (volume_shape[1] * volume_shape[2])
+        self.slab_frozen_voxels = (voxels_z < z_range[0]) | (voxels_z >= z_range[1])
+        self.slab_frozen_values = [tensor.detach().clone() for tensor in self.get_trainable_tensors()]
+        self.optimizer.state.clear()
+
+    def restore_frozen_voxels(self):
+        '''Resets the voxels outside the current slab, which the optimizer might have moved through its momentum'''
+        if self.slab_cache is None:
+            return
+        with torch.no_grad():
+            for tensor,values in zip(self.get_trainable_tensors(), self.slab_frozen_values):
+                tensor[...,self.slab_frozen_voxels] = values[...,self.slab_frozen_voxels]
+
+    def one_iteration(self):
+        '''Forward projects the current estimate, and applies a gradient update to it.
+            If minibatch_lenslets is set, only a random subset of lenslets is projected.
+            If block_slab_thickness is set, only the rays steps inside the current slab are recomputed.'''
+        if self.training_params['block_slab_thickness'] is not None and self.ep % self.training_params['block_iterations'] == 0:
+            self.start_block()
+        if self.training_params['optimizer'] == 'gauss_newton':
+            L, data_term, regularization_term, ret_image_current, azim_image_current = self.gauss_newton_iteration()
+        else:
+            # The closure can be evaluated several times by the L-BFGS line search, we keep its first evaluation
+            evaluations = []
+            def closure():
+                # Reset gradients so we can compute them again
+                self.optimizer.zero_grad()
+                # Forward project
+                volume = self.get_forward_volume()
+                if self.slab_cache is not None:
+                    material_JM = self.rays.calc_material_JM_of_slab_torch(volume, self.slab_cache)
+                    ret_image, azim_image = self.rays.ret_and_azim_images_mla_torch(volume, material_JM=material_JM)
+                elif self.training_params['minibatch_lenslets'] is None:
+                    ret_image, azim_image = self.rays.ray_trace_through_volume(volume)
+                else:
+                    ret_image, azim_image = self.forward_minibatch(volume)
+                loss_terms = self.compute_loss(ret_image, azim_image, volume)
+                # Calculate update of the volume (Compute gradients of the L with respect to the volume)
+                loss_terms[0].backward()
+                evaluations.append(loss_terms + (ret_image, azim_image))
+                return loss_terms[0]
+            # Apply gradient updates to the volume
+            self.optimizer.step(closure)
+            L, data_term, regularization_term, ret_image_current, azim_image_current = evaluations[0]
+        self.apply_proximal_terms()
+        self.retract_optic_axis()
+        self.restore_frozen_voxels()
+        self.update_volume_estimation()
+
+        # Store the losses and the last images for the callbacks
+        self.losses.append(L.item())
+        self.data_term_losses.append(data_term.item())
+        self.regularization_term_losses.append(regularization_term.item())
+        self.ret_image_current = ret_image_current.detach()
+        self.azim_image_current = azim_image_current.detach()
+
+    def compute_residual(self, trainable_tensors):
+        '''Residual vector of the data term, for the given (Delta_n, optic_axis) trainable tensors'''
+        ret_image, azim_image = self.rays.ray_trace_through_volume(self.get_forward_volume(trainable_tensors))
+        return self.residual_term(self, ret_image, azim_image)
+
+    def gauss_newton_iteration(self):
+        '''Matrix-free Levenberg-Marquardt step: solves (H + damping D) step = -gradient with preconditioned
+            conjugate gradients, where H = 2 J^T J is the Gauss-Newton approximation of the Hessian of the data term,
+            J the Jacobian of compute_residual, and D the diagonal geometry curvature (get_geometry_curvature).
+            The products with J and J^T are forward-mode (jvp) and reverse-mode (vjp) derivatives through the
+            complex Jones matrices of the rays, so J is never stored. The gradient also includes the regularizers.
+            The step is only applied if it decreases the loss, and the damping is adapted accordingly.
+            Returns the loss terms and the images before the step.'''
+        if self.delta_n_curvature is None:
+            self.compute_geometry_curvature()
+        trainable_names = self.volume_estimation.members_to_learn
+        learned = [name in trainable_names for name in ['Delta_n', 'optic_axis']]
+        parameters = self.get_optimized_tensors()
+        all_tensors = [tensor.detach() for tensor in self.get_trainable_tensors()]
+
+        def full_tensors(tensors):
+            tensors = iter(tensors)
+            return [next(tensors) if is_learned else fixed for is_learned,fixed in zip(learned, all_tensors)]
+        def residual_function(*tensors):
+            return self.compute_residual(full_tensors(tensors))
+
+        # Loss and gradient at the current estimate
+        for parameter in parameters:
+            parameter.grad = None
+        volume = self.get_forward_volume()
+        ret_image_current, azim_image_current = self.rays.ray_trace_through_volume(volume)
+        L, data_term, regularization_term = self.compute_loss(ret_image_current, azim_image_current, volume)
+        gradient = torch.autograd.grad(L, parameters)
+
+        # Diagonal scaling, the optic axis curvature is shared by its components
+        curvature = [c.unsqueeze(0) if n == 1 else c for n,c in enumerate(self.get_geometry_curvature()) if learned[n]]
+        curvature = [c.expand_as(p).type(p.dtype) for c,p in zip(curvature, parameters)]
+        current = [p.detach() for p in parameters]
+        _, residual_vjp = torch.func.vjp(residual_function, *current)
+        damping = self.gauss_newton_damping
+        def system_product(v):
+            _, Jv = torch.func.jvp(residual_function, tuple(current), tuple(v))
+            JtJv = residual_vjp(Jv)
+            return [2 * a.detach() + damping * c * b for a,b,c in zip(JtJv, v, curvature)]
+
+        step = conjugate_gradients(system_product, [-g.detach() for g in gradient],
+                                    [(1 + damping) * c for c in curvature], self.training_params['cg_iterations'])
+        # Accept the step only if it decreases the loss
+        with torch.no_grad():
+            trial = [p + s for p,s in zip(current, step)]
+            trial_volume = self.get_forward_volume(full_tensors(trial))
+            L_trial = self.compute_loss(*self.rays.ray_trace_through_volume(trial_volume), trial_volume)[0]
+            if L_trial < L:
+                for p,t in zip(parameters, trial):
+                    p.copy_(t)
+                self.gauss_newton_damping = max(damping / 3, 1e-6)
+            else:
+                self.gauss_newton_damping = min(damping * 4, 1e6)
+        return L.detach(), data_term.detach(), regularization_term.detach(), ret_image_current, azim_image_current
+
+    def get_checkpoint_state(self):
+        '''Returns detached copies of everything needed to continue the reconstruction: the volume estimate,
+            the trainable tensors, the optimizer state, the loss history and the random number generators states.
+            It's taken on the optimizer thread, so it can be written to disk from another one (see checkpoint.py).'''
+        clone = lambda tensor: None if tensor is None else tensor.detach().clone()
+        return {'ep' : self.ep,
+                'Delta_n' : clone(self.volume_estimation.Delta_n),
+                'optic_axis' : clone(self.volume_estimation.optic_axis),
+                'trainable_tensors' : [clone(tensor) for tensor in self.get_trainable_tensors()],
+                'optimizer' : None if self.optimizer is None else copy.deepcopy(self.optimizer.state_dict()),
+                'gauss_newton_damping' : self.gauss_newton_damping,
+                'admm' : [clone(self.admm_z), clone(self.admm_u)],
+                'losses' : list(self.losses),
+                'data_term_losses' : list(self.data_term_losses),
+                'regularization_term_losses' : list(self.regularization_term_losses),
+                'rng' : {'torch' : torch.get_rng_state(),
+                         'cuda' : torch.cuda.get_rng_state_all() if torch.cuda.is_available() else None,
+                         'numpy' : np.random.get_state()}}
+
+    def load_checkpoint_state(self, state):
+        '''Restores a state from get_checkpoint_state, the next reconstruct call continues from state['ep'].
+            The Reconstructor must have been created with the same training_params.'''
+        with torch.no_grad():
+            self.volume_estimation.Delta_n.copy_(state['Delta_n'])
+            self.volume_estimation.optic_axis.copy_(state['optic_axis'])
+            for tensor,values in zip(self.get_trainable_tensors(), state['trainable_tensors']):
+                tensor.copy_(values)
+            if self.admm_z is not None:
+                self.admm_z.copy_(state['admm'][0])
+                self.admm_u.copy_(state['admm'][1])
+        self.ep = state['ep']
+        self.gauss_newton_damping = state['gauss_newton_damping']
+        self.losses = list(state['losses'])
+        self.data_term_losses = list(state['data_term_losses'])
+        self.regularization_term_losses = list(state['regularization_term_losses'])
+        # Resuming in the middle of a block, the slab is selected again before its optimizer state is restored
+        if self.training_params['block_slab_thickness'] is not None and self.ep % self.training_params['block_iterations'] != 0:
+            self.start_block()
+        if self.optimizer is not None and state['optimizer'] is not None:
+            self.optimizer.load_state_dict(state['optimizer'])
+        torch.set_rng_state(state['rng']['torch'])
+        if state['rng']['cuda'] is not None and torch.cuda.is_available():
+            torch.cuda.set_rng_state_all(state['rng']['cuda'])
+        np.random.set_state(state['rng']['numpy'])
+
+    def reconstruct(self, n_epochs=None, use_tqdm=True):
+        '''Runs n_epochs iterations (training_params['n_epochs'] by default), and returns the volume estimate.
+            It can be called again to continue the optimization.'''
+        n_epochs = self.training_params['n_epochs'] if n_epochs is None else n_epochs
+        epochs = range(self.ep, self.ep + n_epochs)
+        for ep in (tqdm(epochs, "Minimizing") if use_tqdm else epochs):
+            self.one_iteration()
+            for callback in self.callbacks:
+                callback(self, ep)
+            self.ep = ep + 1
+        return self.volume_estimation
+
+
+def conjugate_gradients(matrix_product, b, diagonal, n_iterations):
+    '''Solves A x = b with preconditioned conjugate gradients, starting from zero,
+        where x and b are lists of tensors, A is given by matrix_product(x) and approximated by diagonal'''
+    dot = lambda u,v: sum((a*c).sum() for a,c in zip(u,v))
+    x = [torch.zeros_like(v) for v in b]
+    r = [v.clone() for v in b]
+    z = [v / d for v,d in zip(r, diagonal)]
+    p = [v.clone() for v in z]
+    rz = dot(r, z)
+    for _ in range(n_iterations):
+        Ap = matrix_product(p)
+        pAp = dot(p, Ap)
+        if pAp <= 0:
+            break
+        alpha = rz / pAp
+        x = [a + alpha * c for a,c in zip(x, p)]
+        r = [a - alpha * c for a,c in zip(r, Ap)]
+        z = [v / d for v,d in zip(r, diagonal)]
+        rz_new = dot(r, z)
+        if rz_new.abs() < 1e-20:
+            break
+        p = [a + (rz_new / rz) * c for a,c in zip(z, p)]
+        rz = rz_new
+    return x
+
+
+############ Coarse-to-fine reconstruction
+def coarse_optical_info(optical_info, axial_factor):
+    '''Copy of optical_info with axial voxels axial_factor times larger, and volume_shape[0] reduced accordingly.
+        The lateral voxel size is defined by the micro-lens pitch, so the lateral shape is kept.
+        If volume_shape[0] is not a multiple of axial_factor, the coarse planes cover a slightly deeper volume,
+        centered on the same depth as the ray geometry, see upsample_volume.'''
+    coarse_info = copy.deepcopy(optical_info)
+    if axial_factor == 1:
+        return coarse_info
+    # Same voxel size computation as in OpticalElement
+    lateral_voxel_size_um = optical_info['pixels_per_ml'] * optical_info['camera_pix_pitch'] / optical_info['M_obj']
+    axial_voxel_size_um = lateral_voxel_size_um if optical_info['cube_voxels'] else optical_info['axial_voxel_size_um']
+    coarse_info['cube_voxels'] = False
+    coarse_info['axial_voxel_size_um'] = axial_voxel_size_um * axial_factor
+    coarse_info['volume_shape'] = [int(np.ceil(optical_info['volume_shape'][0] / axial_factor)),] + list(optical_info['volume_shape'][1:])
+    return coarse_info
+
+def default_axial_factors(n_planes):
+    '''Axial factors 4, 2 and 1, without the coarse levels of a single plane or with as many planes as the next level'''
+    n_coarse_planes = lambda factor: int(np.ceil(n_planes / factor))
+    return [factor for factor in [4, 2] if 1 < n_coarse_planes(factor) < n_coarse_planes(factor // 2)] + [1]
+
+def upsample_volume(volume_in : BirefringentVolume, optical_info):
+    '''Copies Delta_n and optic_axis of a volume into the volume_shape of optical_info, to use a coarse reconstruction
+        as the initialization of a finer one (see coarse_optical_info). Both volumes are centered on the same depth,
+        as their ray geometries, and each fine plane takes the coarse plane that contains its center.'''
+    coarse_shape = list(volume_in.optical_info['volume_shape'])
+    fine_shape = list(optical_info['volume_shape'])
+    assert coarse_shape[1:] == fine_shape[1:], f'Cannot upsample a volume shaped {coarse_shape} into {fine_shape}'
+    coarse_dz = volume_in.optical_info['voxel_size_um'][0]
+    fine_dz = optical_info['voxel_size_um'][0]
+    fine_centers = (np.arange(fine_shape[0]) + 0.5 - fine_shape[0] / 2) * fine_dz
+    planes = np.floor(fine_centers / coarse_dz + coarse_shape[0] / 2).astype(int).clip(0, coarse_shape[0] - 1)
+    planes = torch.from_numpy(planes)
+    with torch.no_grad():
+        Delta_n = volume_in.get_delta_n().detach().reshape(coarse_shape)
+        optic_axis = volume_in.get_optic_axis().detach().reshape([3] + coarse_shape)
+        Delta_n = Delta_n[planes.to(Delta_n.device)]
+        optic_axis = optic_axis[:, planes.to(optic_axis.device)]
+    volume_out = BirefringentVolume(backend=BackEnds.PYTORCH, optical_info=optical_info,
+                                    Delta_n=Delta_n.cpu(), optic_axis=optic_axis.cpu())
+    volume_out.members_to_learn += volume_in.members_to_learn
+    return volume_out
+
+def reconstruct_coarse_to_fine(ret_image_measured, azim_image_measured, optical_info, axial_factors=None, n_epochs_per_level=None,
+                                reconstructor_args=None, geometry_dir=None, device='cpu'):
+    '''Multi-resolution reconstruction: reconstructs first with coarser axial voxels, which have cheaper geometries
+        (fewer voxels per ray), and uses the upsampled result as the initial guess of the next level.
+        Args:
+            optical_info (dict): optical_info of the finest level.
+            axial_factors (list): axial downsampling factor of each level, from coarse to fine,
+                                    defaults to default_axial_factors(volume_shape[0]).
+            n_epochs_per_level (list): iterations of each level, defaults to training_params['n_epochs'] for all of them.
+            reconstructor_args (dict): extra arguments for each Reconstructor (training_params, data_term, regularizers, callbacks).
+            geometry_dir (str): optional directory where the ray geometry of each level is stored/loaded.
+        Returns:
+            reconstructors (list): the Reconstructor of each level, the last one holds the final volume_estimation.'''
+    axial_factors = default_axial_factors(optical_info['volume_shape'][0]) if axial_factors is None else axial_factors
+    reconstructor_args = {} if reconstructor_args is None else reconstructor_args
+    reconstructors = []
+    volume_estimation = None
+    for level,axial_factor in enumerate(axial_factors):
+        level_info = coarse_optical_info(optical_info, axial_factor)
+        rays = BirefringentRaytraceLFM(backend=BackEnds.PYTORCH, optical_info=level_info)
+        geometry_file = None
+        if geometry_dir is not None:
+            shape = level_info['volume_shape']
+            geometry_file = os.path.join(geometry_dir, f'geometry_{shape[0]}x{shape[1]}x{shape[2]}_axial{axial_factor}.h5')
+        loaded_rays = rays.compute_rays_geometry(geometry_file)
+        rays = loaded_rays.to(device)
+
+        if volume_estimation is not None:
+            volume_estimation = upsample_volume(volume_estimation, rays.optical_info)
+        reconstructor = Reconstructor(rays, ret_image_measured, azim_image_measured, volume_estimation=volume_estimation, **reconstructor_args)
+        n_epochs = None if n_epochs_per_level is None else n_epochs_per_level[level]
+        volume_estimation = reconstructor.reconstruct(n_epochs)
+        reconstructors.append(reconstructor)
+    return reconstructors
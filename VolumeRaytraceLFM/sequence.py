@@ -0,0 +1,91 @@
+'''Time-lapse reconstruction: the frames of a sequence share the ray-tracer and its geometry, and each frame
+    is reconstructed starting from the estimate of the previous one, so fewer iterations are needed per frame.
+    The next frame is loaded while the current one is reconstructed, and the volumes are appended to a single file.'''
+import os
+from concurrent.futures import ThreadPoolExecutor
+import h5py
+import numpy as np
+import torch
+from VolumeRaytraceLFM.abstract_classes import BackEnds
+from VolumeRaytraceLFM.birefringence_implementations import BirefringentVolume, BirefringentRaytraceLFM
+from VolumeRaytraceLFM.reconstruction import Reconstructor
+from VolumeRaytraceLFM.telemetry import BackgroundWorker
+from VolumeRaytraceLFM.checkpoint import append_to_dataset
+
+
+def create_sequence_file(h5_file_path, optical_info, description="Temporary description"):
+    '''Creates an empty volume sequence file, with the optical_info stored as in BirefringentVolume.save_as_file.
+        The volumes are appended by append_sequence_frame to:
+            data/delta_n [n_frames,nz,ny,nx]
+            data/optic_axis [n_frames,3,nz,ny,nx]'''
+    with h5py.File(h5_file_path, "w") as f:
+        oc_grp = f.create_group('optical_info')
+        oc_grp.create_dataset('description', [1], data=description)
+        oc_grp.create_dataset('volume_shape', [3], data=optical_info['volume_shape'])
+        oc_grp.create_dataset('voxel_size_um', [3], data=optical_info['voxel_size_um'])
+        f.create_group('data')
+
+def append_sequence_frame(h5_file_path, Delta_n, optic_axis):
+    '''Appends a volume, Delta_n [nz,ny,nx] and optic_axis [3,nz,ny,nx] arrays, to a sequence file'''
+    with h5py.File(h5_file_path, "a") as f:
+        append_to_dataset(f, 'data/delta_n', Delta_n[np.newaxis].astype(np.float32), compression='gzip')
+        append_to_dataset(f, 'data/optic_axis', optic_axis[np.newaxis].astype(np.float32), compression='gzip')
+
+def load_sequence_frame(h5_file_path, n_frame, backend=BackEnds.NUMPY, optical_info=None):
+    '''Loads the volume of a frame from a sequence file'''
+    with h5py.File(h5_file_path, "r") as f:
+        delta_n = f['data/delta_n'][n_frame].astype(np.float64)
+        optic_axis = f['data/optic_axis'][n_frame].astype(np.float64)
+    return BirefringentVolume(backend=backend, optical_info=optical_info, Delta_n=delta_n, optic_axis=optic_axis)
+
+def reconstruct_sequence(rays : BirefringentRaytraceLFM, frames, h5_file_path, n_epochs_first=None, n_epochs_per_frame=None,
+                            reconstructor_args=None, callbacks=None):
+    '''Reconstructs a sequence of frames, warm starting each frame from the previous estimate.
+        Args:
+            rays (BirefringentRaytraceLFM): ray-tracer with the geometry computed, shared by all the frames.
+            frames (iterable): pairs of (retardance, azimuth) measured images. If it loads them from disk
+                                (a generator for example), the next frame is loaded while the current one is reconstructed.
+            h5_file_path (str): sequence file where the volume of every frame is appended, see create_sequence_file.
+            n_epochs_first (int): iterations of the first frame, defaults to training_params['n_epochs'].
+            n_epochs_per_frame (int): iterations of the following frames, defaults to a fifth of n_epochs_first.
+            reconstructor_args (dict): extra arguments for the Reconstructor (training_params, data_term, regularizers...).
+            callbacks (list): functions(reconstructor, n_frame) called after each frame is reconstructed.
+        Returns:
+            reconstructor (Reconstructor): holds the estimate of the last frame.
+            frame_losses (list): final loss of every frame.'''
+    callbacks = [] if callbacks is None else callbacks
+    reconstructor_args = {} if reconstructor_args is None else reconstructor_args
+    frames = iter(frames)
+    end_of_sequence = object()
+    create_sequence_file(h5_file_path, rays.optical_info)
+    reconstructor = None
+    frame_losses = []
+    with ThreadPoolExecutor(max_workers=1, thread_name_prefix='frame-loader') as loader, \
+            BackgroundWorker(max_pending=2, name='sequence-writer') as writer:
+        next_frame = loader.submit(next, frames, end_of_sequence)
+        n_frame = 0
+        while True:
+            frame = next_frame.result()
+            if frame is end_of_sequence:
+                break
+            # Load the next frame while this one is reconstructed
+            next_frame = loader.submit(next, frames, end_of_sequence)
+            ret_image_measured, azim_image_measured = frame
+            if reconstructor is None:
+                reconstructor = Reconstructor(rays, ret_image_measured, azim_image_measured, **reconstructor_args)
+                n_epochs_first = reconstructor.training_params['n_epochs'] if n_epochs_first is None else n_epochs_first
+                n_epochs_per_frame = max(1, n_epochs_first // 5) if n_epochs_per_frame is None else n_epochs_per_frame
+                n_epochs = n_epochs_first
+            else:
+                # Warm start, the estimate and the optimizer state of the previous frame are kept
+                reconstructor.set_measurements(ret_image_measured, azim_image_measured)
+                n_epochs = n_epochs_per_frame
+            reconstructor.reconstruct(n_epochs=n_epochs, use_tqdm=False)
+            frame_losses.append(reconstructor.losses[-1])
+            volume = reconstructor.volume_estimation
+            writer.submit(append_sequence_frame, h5_file_path, volume.get_delta_n().detach().cpu().numpy().copy(),
+                            volume.get_optic_axis().detach().cpu().numpy().copy(), block=True)
+            for callback in callbacks:
+                callback(reconstructor, n_frame)
+            n_frame += 1
+    return reconstructor, frame_losses
@@ -0,0 +1,171 @@
+'''Hyperparameter sweeps of reconstructions: the settings (training_params entries and the data_term) are taken
+    from a grid or a random search space, and the reconstructions run on a pool of processes sharing the ray geometry.
+    With successive halving, only the best runs continue after each round.'''
+import os
+import csv
+import time
+import itertools
+import tempfile
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import torch
+from VolumeRaytraceLFM.birefringence_implementations import BirefringentRaytraceLFM
+from VolumeRaytraceLFM.reconstruction import Reconstructor, vector_data_term
+
+
+############ Search spaces
+def grid_search_space(space):
+    '''All the combinations of the values in space, a dict {name : list of values}'''
+    names = list(space.keys())
+    return [dict(zip(names, values)) for values in itertools.product(*[space[name] for name in names])]
+
+def random_search_space(space, n_samples, seed=0):
+    '''n_samples random settings from space, a dict {name : values}, where values can be:
+        a list: sampled uniformly from its elements.
+        a tuple (low, high): uniform in [low, high).
+        a tuple (low, high, 'log'): log-uniform in [low, high), for learning rates and weights.'''
+    rng = np.random.default_rng(seed)
+    def sample(name, values):
+        if isinstance(values, list):
+            return values[rng.integers(len(values))]
+        if isinstance(values, tuple) and len(values) == 3 and values[2] == 'log':
+            return float(np.exp(rng.uniform(np.log(values[0]), np.log(values[1]))))
+        if isinstance(values, tuple) and len(values) == 2:
+            return float(rng.uniform(values[0], values[1]))
+        raise ValueError(f"Invalid search space for {name}: {values!r}, expected a list, (low, high) or (low, high, 'log')")
+    return [{name : sample(name, values) for name,values in space.items()} for _ in range(n_samples)]
+
+
+############ Scores
+def image_error(reconstructor):
+    '''Vector error between the current and measured images, comparable between runs with different
+        data terms and regularization weights'''
+    with torch.no_grad():
+        return vector_data_term(reconstructor, reconstructor.ret_image_current, reconstructor.azim_image_current).item()
+
+
+############ Workers
+# Ray-tracer and measurements of each worker process, loaded once by init_sweep_worker
+SWEEP_WORKER = {}
+
+def init_sweep_worker(geometry_file, ret_image_measured, azim_image_measured, n_threads, default_dtype):
+    '''Initializer of the worker processes: limits the threads used by torch and loads the shared geometry'''
+    torch.set_num_threads(n_threads)
+    torch.set_default_dtype(default_dtype)
+    SWEEP_WORKER['rays'] = BirefringentRaytraceLFM.load_geometry(geometry_file)
+    SWEEP_WORKER['ret_image_measured'] = ret_image_measured
+    SWEEP_WORKER['azim_image_measured'] = azim_image_measured
+
+def run_sweep_trial(trial):
+    '''Runs a reconstruction with the settings of trial['config'] until trial['n_epochs'],
+        starting from trial['state'] (see Reconstructor.get_checkpoint_state) if it's not None.
+        Returns the score, the last loss and the state to continue from.'''
+    training_params = dict(trial['config'])
+    data_term = training_params.pop('data_term', 'vector')
+    # Every setting starts from the same random initial guess
+    np.random.seed(trial['seed'])
+    torch.manual_seed(trial['seed'])
+    reconstructor = Reconstructor(SWEEP_WORKER['rays'], SWEEP_WORKER['ret_image_measured'], SWEEP_WORKER['azim_image_measured'],
+                                    training_params=training_params, data_term=data_term)
+    if trial['state'] is not None:
+        reconstructor.load_checkpoint_state(trial['state'])
+    start_time = time.time()
+    reconstructor.reconstruct(n_epochs=trial['n_epochs'] - reconstructor.ep, use_tqdm=False)
+    return {'config_id' : trial['config_id'],
+            'ep' : reconstructor.ep,
+            'score' : trial['score'](reconstructor),
+            'loss' : reconstructor.losses[-1],
+            'time' : time.time() - start_time,
+            'state' : reconstructor.get_checkpoint_state()}
+
+
+############ Sweep
+def run_sweep(rays : BirefringentRaytraceLFM, ret_image_measured, azim_image_measured, configs, n_epochs,
+                n_workers=2, threads_per_worker=None, halving_eta=3, min_epochs=None, score=image_error,
+                seed=0, geometry_file=None, summary_file=None):
+    '''Reconstructs with every setting in configs, in parallel processes.
+        Args:
+            rays (BirefringentRaytraceLFM): ray-tracer with the geometry computed, shared by all the runs.
+            configs (list): dicts with training_params entries and optionally data_term, see grid_search_space.
+            n_epochs (int): iterations of the runs that reach the end.
+            n_workers (int): processes in the pool.
+            threads_per_worker (int): torch threads of each process, defaults to splitting the cpus between them.
+            halving_eta (int): successive halving, the runs are stopped at ..., n_epochs/halving_eta^2, n_epochs/halving_eta
+                                and only the best 1/halving_eta of them continue. None runs all of them to n_epochs.
+            min_epochs (int): minimum iterations of the first round, defaults to n_epochs / halving_eta^2.
+            score (function): function(reconstructor) to minimize, it must be defined at module level to reach the workers.
+            seed (int): random seed of the initial guesses.
+            geometry_file (str): where the geometry is stored for the workers, a temporary file by default.
+            summary_file (str): optional csv file where the summary table is saved.
+        Returns:
+            summary (list): a dict per setting with its config, last epoch, score, loss and time, the best first.
+            best_state: state of the best run, for Reconstructor.load_checkpoint_state.'''
+    if threads_per_worker is None:
+        threads_per_worker = max(1, (os.cpu_count() or 1) // n_workers)
+    if halving_eta is None:
+        rounds = [n_epochs]
+    else:
+        min_epochs = max(1, n_epochs // halving_eta**2) if min_epochs is None else min_epochs
+        rounds = [n_epochs]
+        while rounds[0] // halving_eta >= min_epochs:
+            rounds.insert(0, rounds[0] // halving_eta)
+
+    results = {config_id : {'config' : config, 'ep' : 0, 'score' : None, 'loss' : None, 'time' : 0, 'state' : None}
+                for config_id,config in enumerate(configs)}
+    with tempfile.TemporaryDirectory() as temp_dir:
+        # The workers memory-map the MLA geometry, instead of computing it
+        if geometry_file is None:
+            geometry_file = os.path.join(temp_dir, 'geometry.h5')
+        rays.precompute_MLA_volume_geometry()
+        rays.save_geometry(geometry_file)
+        initargs = (geometry_file, ret_image_measured.detach().cpu(), azim_image_measured.detach().cpu(),
+                    threads_per_worker, torch.get_default_dtype())
+        with ProcessPoolExecutor(max_workers=n_workers, mp_context=multiprocessing.get_context('spawn'),
+                                    initializer=init_sweep_worker, initargs=initargs) as pool:
+            survivors = list(results.keys())
+            for n_round,round_epochs in enumerate(rounds):
+                trials = [{'config_id' : config_id, 'config' : results[config_id]['config'], 'n_epochs' : round_epochs,
+                            'state' : results[config_id]['state'], 'seed' : seed, 'score' : score} for config_id in survivors]
+                for result in pool.map(run_sweep_trial, trials):
+                    entry = results[result['config_id']]
+                    entry.update({key : result[key] for key in ['ep', 'score', 'loss', 'state']})
+                    entry['time'] += result['time']
+                if n_round < len(rounds) - 1:
+                    survivors = sorted(survivors, key=lambda config_id: results[config_id]['score'])
+                    survivors = survivors[:max(1, int(np.ceil(len(survivors) / halving_eta)))]
+                    # Only the runs that continue keep their states
+                    for config_id in results.keys() - set(survivors):
+                        results[config_id]['state'] = None
+
+    # The runs that went further first, then by score
+    ranking = sorted(results.values(), key=lambda entry: (-entry['ep'], entry['score']))
+    best_state = ranking[0]['state']
+    summary = [{key : value for key,value in entry.items() if key != 'state'} for entry in ranking]
+    if summary_file is not None:
+        save_summary_table(summary, summary_file)
+    return summary, best_state
+
+def summary_rows(summary):
+    '''Flattens the configs of a sweep summary into columns'''
+    names = list(dict.fromkeys(name for entry in summary for name in entry['config'].keys()))
+    header = names + ['ep', 'score', 'loss', 'time']
+    rows = [[entry['config'].get(name, '') for name in names] + [entry[key] for key in ['ep', 'score', 'loss', 'time']]
+            for entry in summary]
+    return header, rows
+
+def format_summary_table(summary):
+    '''Sweep summary as an aligned text table'''
+    header, rows = summary_rows(summary)
+    as_text = lambda value: f'{value:.4g}' if isinstance(value, float) else str(value)
+    cells = [header] + [[as_text(value) for value in row] for row in rows]
+    widths = [max(len(row[n]) for row in cells) for n in range(len(header))]
+    return '\n'.join('  '.join(cell.rjust(width) for cell,width in zip(row, widths)) for row in cells)
+
+def save_summary_table(summary, filename):
+    '''Sweep summary as a csv file'''
+    header, rows = summary_rows(summary)
+    with open(filename, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(header)
+        writer.writerows(rows)
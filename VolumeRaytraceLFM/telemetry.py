@@ -0,0 +1,129 @@
+'''Non-blocking telemetry of reconstructions: snapshots of the losses, images and volume projections
+    are handed to a background thread, which renders and writes them, so the optimizer never waits
+    for matplotlib or the disk'''
+import queue
+import threading
+import numpy as np
+import torch
+from VolumeRaytraceLFM.optic_config import volume_2_projections
+
+
+class BackgroundWorker:
+    '''Runs the submitted jobs in order on a daemon thread.
+        The jobs are kept in a bounded queue, when it's full, submit drops the job instead of waiting,
+        unless block is set. An exception raised by a job is re-raised by the next submit or close.'''
+    def __init__(self, max_pending=2, name='background-worker'):
+        self.jobs = queue.Queue(maxsize=max_pending)
+        self.n_dropped = 0
+        self.error = None
+        self.thread = threading.Thread(target=self.run, name=name, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while True:
+            job = self.jobs.get()
+            try:
+                if job is None:
+                    return
+                function, args = job
+                if self.error is None:
+                    function(*args)
+            except Exception as error:
+                self.error = error
+            finally:
+                self.jobs.task_done()
+
+    def raise_error(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def submit(self, function, *args, block=False):
+        '''Queues function(*args). Returns False if the job was dropped because the queue was full'''
+        self.raise_error()
+        assert self.thread.is_alive(), 'The worker was closed'
+        try:
+            self.jobs.put((function, args), block=block)
+        except queue.Full:
+            self.n_dropped += 1
+            return False
+        return True
+
+    def flush(self):
+        '''Waits until all the queued jobs are done'''
+        self.jobs.join()
+        self.raise_error()
+
+    def close(self):
+        '''Runs the queued jobs and stops the thread'''
+        if self.thread.is_alive():
+            self.jobs.put(None)
+            self.thread.join()
+        self.raise_error()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class TelemetryCallback:
+    '''Reconstructor callback that takes a detached snapshot every interval epochs, and passes it to
+        the renderers on a background thread. The snapshot is a dict with:
+            ep, losses, data_term_losses, regularization_term_losses (lists),
+            ret_image, azim_image, Delta_n_mip (numpy arrays), Delta_n (cpu tensor, [nz,ny,nx])
+        The reference (ground truth) is converted once, with the projection of its Delta_n, so it's not
+        recomputed at every snapshot. Snapshots are dropped if the renderers fall behind.
+        For example, with plotting_tools.save_iteration_update:
+            telemetry = TelemetryCallback([lambda snapshot, reference: save_iteration_update(snapshot, reference, f'ep_{snapshot["ep"]}.pdf')],
+                                          reference={'Delta_n' : Delta_n_GT, 'ret_image' : ret_image_measured, 'azim_image' : azim_image_measured})
+            Reconstructor(..., callbacks=[telemetry]).reconstruct()
+            telemetry.close()'''
+    def __init__(self, renderers, interval=10, reference=None, max_pending=2):
+        '''Args:
+            renderers (list): functions(snapshot, reference) called on the telemetry thread.
+            interval (int): epochs between snapshots.
+            reference (dict): optional Delta_n volume and ret_image, azim_image measured images.
+            max_pending (int): snapshots waiting to be rendered before new ones are dropped.'''
+        self.renderers = list(renderers)
+        self.interval = interval
+        self.reference = {}
+        if reference is not None:
+            self.reference = {key : self.to_numpy(value) for key,value in reference.items() if key != 'Delta_n'}
+            if 'Delta_n' in reference:
+                self.reference['Delta_n_mip'] = self.projections(torch.as_tensor(reference['Delta_n']))
+        self.worker = BackgroundWorker(max_pending=max_pending, name='telemetry')
+
+    @staticmethod
+    def to_numpy(value):
+        return value.detach().cpu().numpy().copy() if torch.is_tensor(value) else np.array(value)
+
+    @staticmethod
+    def projections(Delta_n):
+        '''Projections of a [nz,ny,nx] volume, as plotted for the reconstructions'''
+        return volume_2_projections(Delta_n.unsqueeze(0))[0,0].numpy()
+
+    def take_snapshot(self, reconstructor, ep):
+        '''Copies what the renderers need, this is the only work done on the optimizer thread'''
+        return {'ep' : ep,
+                'losses' : list(reconstructor.losses),
+                'data_term_losses' : list(reconstructor.data_term_losses),
+                'regularization_term_losses' : list(reconstructor.regularization_term_losses),
+                'ret_image' : self.to_numpy(reconstructor.ret_image_current),
+                'azim_image' : self.to_numpy(reconstructor.azim_image_current),
+                'Delta_n' : reconstructor.volume_estimation.get_delta_n().detach().to('cpu', copy=True)}
+
+    def render(self, snapshot):
+        snapshot['Delta_n_mip'] = self.projections(snapshot['Delta_n'])
+        for renderer in self.renderers:
+            renderer(snapshot, self.reference)
+
+    def __call__(self, reconstructor, ep):
+        if ep % self.interval != 0:
+            return
+        self.worker.submit(self.render, self.take_snapshot(reconstructor, ep))
+
+    def close(self):
+        '''Waits for the pending snapshots to be rendered'''
+        self.worker.close()
@@ -0,0 +1,388 @@
+'''Ray-tracing and reconstruction of volumes larger than the memory, or than a single optimization, by tiles of lenslets.
+    The images behind a tile of lenslets only depend on the voxels in front of it, plus a halo of voxel_span_per_ml
+    voxels reached by the tilted rays. All the tiles share one ray geometry, computed as for the whole MLA, so the
+    tiles give the same images as ray-tracing the whole volume at once, with only a tile of the volume in memory.
+    For reconstructions, overlapping tiles are reconstructed in parallel processes and blended into a single volume.'''
+import os
+import copy
+import tempfile
+import multiprocessing
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import h5py
+import numpy as np
+import torch
+from VolumeRaytraceLFM.abstract_classes import BackEnds, RayTraceLFM, memmap_hdf5_dataset
+from VolumeRaytraceLFM.birefringence_implementations import BirefringentVolume, BirefringentRaytraceLFM
+from VolumeRaytraceLFM.reconstruction import Reconstructor
+
+
+############ Volumes on disk
+def block_regions(start, shape, volume_shape):
+    '''Lateral slices of the part of a block [start:start+shape] inside a volume [ny,nx], in the volume (source)
+        and in the block (target). Returns (None, None) if the block is outside the volume.'''
+    source = tuple(slice(max(s, 0), min(s + n, size)) for s,n,size in zip(start, shape, volume_shape))
+    if any(r.stop <= r.start for r in source):
+        return None, None
+    target = tuple(slice(r.start - s, r.stop - s) for r,s in zip(source, start))
+    return source, target
+
+class OutOfCoreVolume:
+    '''Birefringent volume stored on disk and read by lateral blocks. The data can be any arrays that support
+        slicing, such as memory-mapped arrays or the datasets of a file from BirefringentVolume.save_as_file.
+        For example:
+            with OutOfCoreVolume.from_file('large_volume.h5') as volume:
+                ret_image, azim_image = ray_trace_out_of_core(volume, optical_info, 5, 'ret.npy', 'azim.npy')'''
+    def __init__(self, delta_n, optic_axis, h5_file=None):
+        '''Args:
+            delta_n ([nz,ny,nx]), optic_axis ([3,nz,ny,nx]): arrays or HDF5 datasets.
+            h5_file (h5py.File): file the datasets belong to, closed by close().'''
+        assert list(optic_axis.shape) == [3] + list(delta_n.shape), \
+            f'Expected an optic_axis shaped {[3] + list(delta_n.shape)}, got {list(optic_axis.shape)}'
+        self.delta_n = delta_n
+        self.optic_axis = optic_axis
+        self.h5_file = h5_file
+        self.shape = list(delta_n.shape)
+
+    @staticmethod
+    def from_file(h5_file_path):
+        '''Opens a volume saved with the dense layout of BirefringentVolume.save_as_file. Contiguous uncompressed
+            datasets are memory-mapped, chunked ones are read and decompressed by h5py only where the blocks are.'''
+        h5_file = h5py.File(h5_file_path, 'r')
+        assert h5_file['data'].attrs.get('layout', 'dense') == 'dense', f'{h5_file_path} is not stored as a dense volume'
+        data = []
+        for name in ['delta_n', 'optic_axis']:
+            dataset = h5_file['data/' + name]
+            array = memmap_hdf5_dataset(h5_file_path, dataset)
+            data.append(dataset if array is None else array)
+        return OutOfCoreVolume(*data, h5_file=h5_file)
+
+    def read_block(self, start, shape, dtype=np.float32):
+        '''Reads the voxels [:, start[0]:start[0]+shape[0], start[1]:start[1]+shape[1]] of the volume.
+            The voxels outside the volume are empty, with the optic axis [1,1,1] as in BirefringentVolume.init_from_file.
+            Returns:
+                delta_n ([nz,shape[0],shape[1]]), optic_axis ([3,nz,shape[0],shape[1]])'''
+        nz = self.shape[0]
+        delta_n = np.zeros([nz] + list(shape), dtype=dtype)
+        optic_axis = np.full([3, nz] + list(shape), np.sqrt(3), dtype=dtype)
+        source, target = block_regions(start, shape, self.shape[1:])
+        if source is not None:
+            delta_n[(slice(None),) + target] = self.delta_n[(slice(None),) + source]
+            optic_axis[(slice(None), slice(None)) + target] = self.optic_axis[(slice(None), slice(None)) + source]
+        return delta_n, optic_axis
+
+    def close(self):
+        if self.h5_file is not None:
+            self.h5_file.close()
+            self.h5_file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+############ Tiles of lenslets
+def lenslet_corner(n_lenslet, n_micro_lenses, n_voxels_per_ml, volume_size):
+    '''Lateral index of the first voxel in front of a lenslet, with the MLA centered in the volume
+        as in BirefringentRaytraceLFM.precompute_MLA_volume_geometry'''
+    return n_voxels_per_ml * (n_lenslet - n_micro_lenses // 2) + volume_size // 2 - (n_voxels_per_ml * n_micro_lenses) // 2
+
+def get_tile_halo(optical_info):
+    '''Voxels reached by the rays of a lenslet around the voxels in front of it, the voxel_span_per_ml of the ray-tracer'''
+    n_voxels_z = optical_info['volume_shape'][0]
+    volume_ctr_um = np.array([n_voxels_z / 2, 0, 0]) * optical_info['voxel_size_um']
+    _, _, ray_diff = RayTraceLFM.rays_through_vol(optical_info['pixels_per_ml'], optical_info['na_obj'],
+                                                    optical_info['n_medium'], volume_ctr_um)
+    return int(RayTraceLFM.calc_voxel_span_per_ml(ray_diff, n_voxels_z))
+
+def tile_starts(n_micro_lenses, tile_lenslets, overlap=0):
+    '''First lenslet of each tile along one dimension, tiles overlap by overlap lenslets,
+        and the last tile is moved back to end at the last lenslet'''
+    starts = list(range(0, n_micro_lenses - tile_lenslets + 1, tile_lenslets - overlap))
+    if starts[-1] + tile_lenslets < n_micro_lenses:
+        starts.append(n_micro_lenses - tile_lenslets)
+    return starts
+
+def create_tile_raytracer(optical_info, tile_lenslets, geometry_file=None):
+    '''Ray-tracer of a tile of tile_lenslets x tile_lenslets lenslets, shared by all the tiles of the MLA in optical_info.
+        Its workspace is the volume in front of the tile, with a halo of get_tile_halo voxels on each side.
+        Args:
+            optical_info (dict): of the whole MLA.
+            tile_lenslets (int): lenslets per side of a tile, with the same parity as n_micro_lenses
+                                    so the rays are centered on the voxels alike.
+            geometry_file (str): optional file where the geometry is saved, or loaded from if it exists.'''
+    n_micro_lenses = optical_info['n_micro_lenses']
+    n_voxels_per_ml = optical_info['n_voxels_per_ml']
+    tile_lenslets = min(tile_lenslets, n_micro_lenses)
+    assert (n_micro_lenses - tile_lenslets) * n_voxels_per_ml % 2 == 0, \
+        f'Tiles of {tile_lenslets} lenslets do not align with the voxels of {n_micro_lenses} lenslets, use tiles of {tile_lenslets + 1} lenslets'
+    if geometry_file is not None and os.path.exists(geometry_file):
+        return BirefringentRaytraceLFM.load_geometry(geometry_file)
+
+    halo = get_tile_halo(optical_info)
+    tile_size = tile_lenslets * n_voxels_per_ml + 2 * halo
+    tile_info = copy.deepcopy(optical_info)
+    tile_info['volume_shape'] = [optical_info['volume_shape'][0], tile_size, tile_size]
+    rays = BirefringentRaytraceLFM(backend=BackEnds.PYTORCH, optical_info=tile_info)
+    # The rays of a lenslet are computed as for the whole MLA, which defines where they're clipped and how
+    # they're centered on the voxels, then moved to the coordinates of a tile
+    rays.compute_rays_geometry()
+    shift = (n_micro_lenses - tile_lenslets) * n_voxels_per_ml // 2
+    rays.ray_vol_colli_indices = [[(z, y - shift, x - shift) for z,y,x in vox] for vox in rays.ray_vol_colli_indices]
+    tile_info['n_micro_lenses'] = tile_lenslets
+    lateral_indices = [index for vox in rays.ray_vol_colli_indices for _,y,x in vox for index in [y, x]]
+    assert lenslet_corner(0, tile_lenslets, n_voxels_per_ml, tile_size) + min(lateral_indices) >= 0 and \
+        lenslet_corner(tile_lenslets - 1, tile_lenslets, n_voxels_per_ml, tile_size) + max(lateral_indices) < tile_size, \
+        'The rays of the tile reach beyond its halo'
+    rays.precompute_MLA_volume_geometry()
+    if geometry_file is not None:
+        rays.save_geometry(geometry_file)
+    return rays
+
+def tile_volume_start(rays, optical_info, tile_start):
+    '''Lateral index, in the whole volume, of the first voxel of the workspace of a tile ray-tracer
+        (see create_tile_raytracer) whose first lenslet is tile_start [row,col]'''
+    n_micro_lenses = optical_info['n_micro_lenses']
+    n_voxels_per_ml = optical_info['n_voxels_per_ml']
+    tile_lenslets = rays.optical_info['n_micro_lenses']
+    tile_size = rays.optical_info['volume_shape'][1]
+    shift = (n_micro_lenses - tile_lenslets) * n_voxels_per_ml // 2
+    return [lenslet_corner(start, n_micro_lenses, n_voxels_per_ml, volume_size) - lenslet_corner(0, tile_lenslets, n_voxels_per_ml, tile_size) + shift
+            for start,volume_size in zip(tile_start, optical_info['volume_shape'][1:])]
+
+def tile_image_region(rays, tile_start):
+    '''Region of the MLA images behind a tile. The lenslets in front of the volume rows are image columns,
+        see precompute_MLA_volume_geometry.'''
+    tile_pixels = rays.optical_info['n_micro_lenses'] * rays.optical_info['pixels_per_ml']
+    pixels_per_ml = rays.optical_info['pixels_per_ml']
+    return (slice(tile_start[1] * pixels_per_ml, tile_start[1] * pixels_per_ml + tile_pixels),
+            slice(tile_start[0] * pixels_per_ml, tile_start[0] * pixels_per_ml + tile_pixels))
+
+
+############ Out-of-core ray-tracing
+def ray_trace_out_of_core(volume : OutOfCoreVolume, optical_info, tile_lenslets, retardance_path, azimuth_path,
+                            rays=None, geometry_file=None, device='cpu', prefetch=1):
+    '''Ray-traces a volume on disk through the MLA, a tile of lenslets at a time. Only the voxels of a tile
+        and its halo are in memory, the next tiles are read by a background thread, and the images are written
+        to memory-mapped npy files.
+        Args:
+            volume (OutOfCoreVolume): it doesn't need to fit the MLA, the voxels outside it are empty.
+            optical_info (dict): of the whole MLA, with the volume_shape of the volume.
+            tile_lenslets (int): lenslets per side of the tiles, see create_tile_raytracer.
+            retardance_path, azimuth_path (str): npy files where the images [pixels_per_mla,pixels_per_mla] are written.
+            rays (BirefringentRaytraceLFM): tile ray-tracer from create_tile_raytracer, created if not provided.
+            geometry_file (str): optional file of the tile geometry, see create_tile_raytracer.
+            device: where the tiles are ray-traced.
+            prefetch (int): tiles read ahead.
+        Returns:
+            retardance, azimuth (np.memmap): the images.'''
+    assert list(optical_info['volume_shape']) == volume.shape, \
+        f"The volume_shape {optical_info['volume_shape']} of optical_info doesn't match the volume {volume.shape}"
+    if rays is None:
+        rays = create_tile_raytracer(optical_info, tile_lenslets, geometry_file)
+    rays = rays.to(device)
+    tile_lenslets = rays.optical_info['n_micro_lenses']
+    tile_shape = rays.optical_info['volume_shape'][1:]
+    pixels_per_mla = optical_info['n_micro_lenses'] * optical_info['pixels_per_ml']
+    retardance = np.lib.format.open_memmap(retardance_path, mode='w+', dtype=np.float32, shape=(pixels_per_mla, pixels_per_mla))
+    azimuth = np.lib.format.open_memmap(azimuth_path, mode='w+', dtype=np.float32, shape=(pixels_per_mla, pixels_per_mla))
+
+    starts = tile_starts(optical_info['n_micro_lenses'], tile_lenslets)
+    tiles = [(start_y, start_x) for start_y in starts for start_x in starts]
+    dtype = torch.empty(0).numpy().dtype
+    read_tile = lambda tile: volume.read_block(tile_volume_start(rays, optical_info, tile), tile_shape, dtype)
+    with ThreadPoolExecutor(max_workers=1, thread_name_prefix='tile-reader') as reader:
+        pending = deque(reader.submit(read_tile, tile) for tile in tiles[:prefetch + 1])
+        for n_tile,tile in enumerate(tiles):
+            delta_n, optic_axis = pending.popleft().result()
+            if n_tile + prefetch + 1 < len(tiles):
+                pending.append(reader.submit(read_tile, tiles[n_tile + prefetch + 1]))
+            tile_volume = BirefringentVolume(backend=BackEnds.PYTORCH, optical_info=rays.optical_info,
+                                                Delta_n=delta_n, optic_axis=optic_axis).to(device)
+            with torch.no_grad():
+                ret_image, azim_image = rays.ray_trace_through_volume(tile_volume)
+            region = tile_image_region(rays, tile)
+            retardance[region] = ret_image.cpu().numpy()
+            azimuth[region] = azim_image.cpu().numpy()
+    retardance.flush()
+    azimuth.flush()
+    return retardance, azimuth
+
+
+############ Tiled reconstruction
+# Tile ray-tracer of each worker process, loaded once by init_tile_worker
+TILE_WORKER = {}
+
+def init_tile_worker(geometry_file, n_threads, default_dtype):
+    '''Initializer of the worker processes: limits the threads used by torch and memory-maps the tile geometry'''
+    torch.set_num_threads(n_threads)
+    torch.set_default_dtype(default_dtype)
+    TILE_WORKER['rays'] = BirefringentRaytraceLFM.load_geometry(geometry_file)
+
+def run_tile_reconstruction(task):
+    '''Reconstructs a tile from its measured images, starting from task['delta_n'] and task['optic_axis']
+        if they're not None, or from a random initial guess.
+        Returns the volume of the tile workspace and the last loss.'''
+    rays = TILE_WORKER['rays']
+    np.random.seed(task['seed'])
+    torch.manual_seed(task['seed'])
+    if task['delta_n'] is not None:
+        volume_estimation = BirefringentVolume(backend=BackEnds.PYTORCH, optical_info=rays.optical_info,
+                                                Delta_n=task['delta_n'], optic_axis=task['optic_axis'])
+    else:
+        # Unlike Reconstructor.init_volume_estimation the halo is not masked out, it's reached by the rays of the tile
+        training_params = Reconstructor.get_training_params_template()
+        training_params.update(task['reconstructor_args'].get('training_params', None) or {})
+        volume_estimation = BirefringentVolume(backend=BackEnds.PYTORCH, optical_info=rays.optical_info,
+                                                volume_creation_args={'init_mode' : 'random'})
+        with torch.no_grad():
+            volume_estimation.Delta_n *= training_params['init_delta_n_scale']
+    volume_estimation.members_to_learn += ['Delta_n', 'optic_axis']
+    reconstructor = Reconstructor(rays, torch.from_numpy(task['ret_image']), torch.from_numpy(task['azim_image']),
+                                    volume_estimation=volume_estimation, **task['reconstructor_args'])
+    volume = reconstructor.reconstruct(n_epochs=task['n_epochs'], use_tqdm=False)
+    return {'tile' : task['tile'],
+            'delta_n' : volume.get_delta_n().detach().cpu().numpy(),
+            'optic_axis' : volume.get_optic_axis().detach().cpu().numpy(),
+            'loss' : reconstructor.losses[-1]}
+
+def tile_blending_weights(tile_shape, halo):
+    '''Lateral weights [ny,nx] of the voxels of a tile workspace when blending the tiles: one in front of the lenslets,
+        decreasing linearly across the halo, where the voxels are only reached by a few rays'''
+    profile = lambda n: np.minimum(1, np.minimum(np.arange(n) + 1, n - np.arange(n)) / (halo + 1))
+    return np.outer(profile(tile_shape[0]), profile(tile_shape[1]))
+
+def blend_tile(accumulators, start, delta_n, optic_axis, weights):
+    '''Adds a tile workspace, whose first voxel is start [row,col] in the volume, to the weighted sums of accumulators,
+        and counts the tiles covering each voxel. The weighted sums of the squared delta_n give the disagreement
+        of the overlapping tiles, see tile_disagreement.
+        As a and -a are the same optic axis, the axes of the tile are flipped to agree with what's already blended.'''
+    source, target = block_regions(start, weights.shape, accumulators['weights'].shape)
+    if source is None:
+        return
+    weights = weights[target]
+    delta_n = delta_n[(slice(None),) + target]
+    optic_axis = optic_axis[(slice(None), slice(None)) + target]
+    optic_axis_sum = accumulators['optic_axis'][(slice(None), slice(None)) + source]
+    optic_axis = np.where((optic_axis * optic_axis_sum).sum(0) < 0, -optic_axis, optic_axis)
+    accumulators['weights'][source] += weights
+    accumulators['n_tiles'][source] += 1
+    accumulators['delta_n'][(slice(None),) + source] += weights * delta_n
+    accumulators['delta_n_squares'][(slice(None),) + source] += weights * delta_n ** 2
+    accumulators['optic_axis'][(slice(None), slice(None)) + source] = optic_axis_sum + weights * optic_axis
+
+def tile_disagreement(accumulators):
+    '''Weighted variance of the delta_n of the tiles at the voxels covered by more than one tile,
+        averaged with the weights of these voxels: zero if the overlapping tiles agree on their halos'''
+    overlap = accumulators['n_tiles'] > 1
+    if not overlap.any():
+        return 0.0
+    weights = accumulators['weights'][overlap]
+    squared_deviations = 0.0
+    for z in range(accumulators['delta_n'].shape[0]):
+        delta_n_sum = accumulators['delta_n'][z][overlap]
+        squared_deviations += np.maximum(accumulators['delta_n_squares'][z][overlap] - delta_n_sum ** 2 / weights, 0).sum()
+    return float(squared_deviations / (weights.sum() * accumulators['delta_n'].shape[0]))
+
+def reconstruct_tiled(optical_info, ret_image_measured, azim_image_measured, tile_lenslets, output_dir,
+                        overlap=1, n_epochs=None, n_epochs_per_pass=None, n_global_passes=2, n_workers=2,
+                        threads_per_worker=None, reconstructor_args=None, seed=0, geometry_file=None):
+    '''Reconstructs a volume behind an MLA too large for a single optimization, by overlapping tiles of lenslets.
+        Every tile is reconstructed from the images behind it, with the voxels in front of it and a halo reached by its
+        rays, in a pool of processes sharing the memory-mapped tile geometry. The tiles are blended with weights
+        that decrease across the halos. Then, each global pass reconstructs the tiles again, starting from the blended
+        volume, so the halos agree with the voxels reconstructed by the neighboring tiles, and blends them again.
+        Args:
+            optical_info (dict): of the whole MLA and volume, the volume doesn't need to fit the MLA.
+            ret_image_measured, azim_image_measured (arrays): measured images [pixels_per_mla,pixels_per_mla],
+                                                                they can be memory-mapped.
+            tile_lenslets (int): lenslets per side of the tiles, see create_tile_raytracer.
+            output_dir (str): where the volume is written: delta_n.npy [nz,ny,nx] and optic_axis.npy [3,nz,ny,nx].
+            overlap (int): lenslets shared by neighboring tiles.
+            n_epochs (int): iterations of the first reconstruction of every tile, defaults to training_params['n_epochs'].
+            n_epochs_per_pass (int): iterations of every tile in the global passes, defaults to a fifth of n_epochs.
+            n_global_passes (int): passes after the first reconstruction of the tiles.
+            n_workers (int): processes in the pool.
+            threads_per_worker (int): torch threads of each process, defaults to splitting the cpus between them.
+            reconstructor_args (dict): extra arguments for the Reconstructor of every tile (training_params, data_term...),
+                                        they must be picklable, so data terms and regularizers are given by name.
+            seed (int): random seed of the initial guesses, each tile adds its index.
+            geometry_file (str): optional file of the tile geometry, see create_tile_raytracer.
+        Returns:
+            volume (OutOfCoreVolume): the blended volume, memory-mapped from output_dir.
+            pass_losses (list): mean of the last loss of the tiles, for each pass.
+            pass_disagreements (list): disagreement of the overlapping tiles, for each pass, see tile_disagreement.'''
+    reconstructor_args = {} if reconstructor_args is None else reconstructor_args
+    training_params = reconstructor_args.get('training_params', None) or {}
+    n_epochs = training_params.get('n_epochs', Reconstructor.get_training_params_template()['n_epochs']) if n_epochs is None else n_epochs
+    n_epochs_per_pass = max(1, n_epochs // 5) if n_epochs_per_pass is None else n_epochs_per_pass
+    if threads_per_worker is None:
+        threads_per_worker = max(1, (os.cpu_count() or 1) // n_workers)
+    os.makedirs(output_dir, exist_ok=True)
+    volume_shape = list(optical_info['volume_shape'])
+    dtype = torch.empty(0).numpy().dtype
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        if geometry_file is None:
+            geometry_file = os.path.join(temp_dir, 'tile_geometry.h5')
+        rays = create_tile_raytracer(optical_info, tile_lenslets, geometry_file)
+        tile_lenslets = rays.optical_info['n_micro_lenses']
+        tile_shape = rays.optical_info['volume_shape'][1:]
+        weights = tile_blending_weights(tile_shape, get_tile_halo(optical_info)).astype(dtype)
+        starts = tile_starts(optical_info['n_micro_lenses'], tile_lenslets, overlap)
+        tiles = [(start_y, start_x) for start_y in starts for start_x in starts]
+
+        delta_n = np.lib.format.open_memmap(os.path.join(output_dir, 'delta_n.npy'), mode='w+', dtype=dtype, shape=tuple(volume_shape))
+        optic_axis = np.lib.format.open_memmap(os.path.join(output_dir, 'optic_axis.npy'), mode='w+', dtype=dtype, shape=tuple([3] + volume_shape))
+        volume = OutOfCoreVolume(delta_n, optic_axis)
+        accumulators = {'delta_n' : np.lib.format.open_memmap(os.path.join(temp_dir, 'delta_n_sum.npy'), mode='w+', dtype=dtype, shape=tuple(volume_shape)),
+                        'optic_axis' : np.lib.format.open_memmap(os.path.join(temp_dir, 'optic_axis_sum.npy'), mode='w+', dtype=dtype, shape=tuple([3] + volume_shape)),
+                        'delta_n_squares' : np.lib.format.open_memmap(os.path.join(temp_dir, 'delta_n_squares.npy'), mode='w+', dtype=dtype, shape=tuple(volume_shape)),
+                        'weights' : np.lib.format.open_memmap(os.path.join(temp_dir, 'weights.npy'), mode='w+', dtype=dtype, shape=tuple(volume_shape[1:])),
+                        'n_tiles' : np.lib.format.open_memmap(os.path.join(temp_dir, 'n_tiles.npy'), mode='w+', dtype=dtype, shape=tuple(volume_shape[1:]))}
+
+        pass_losses = []
+        pass_disagreements = []
+        initargs = (geometry_file, threads_per_worker, torch.get_default_dtype())
+        with ProcessPoolExecutor(max_workers=n_workers, mp_context=multiprocessing.get_context('spawn'),
+                                    initializer=init_tile_worker, initargs=initargs) as pool:
+            for n_pass in range(n_global_passes + 1):
+                def create_task(n_tile, tile):
+                    region = tile_image_region(rays, tile)
+                    task = {'tile' : tile, 'seed' : seed + n_tile, 'reconstructor_args' : reconstructor_args,
+                            'n_epochs' : n_epochs if n_pass == 0 else n_epochs_per_pass,
+                            'ret_image' : np.array(ret_image_measured[region], dtype=dtype),
+                            'azim_image' : np.array(azim_image_measured[region], dtype=dtype),
+                            'delta_n' : None, 'optic_axis' : None}
+                    if n_pass > 0:
+                        task['delta_n'], task['optic_axis'] = volume.read_block(tile_volume_start(rays, optical_info, tile), tile_shape, dtype)
+                    return task
+                # The tasks are submitted as the workers finish, so only a few tiles are in memory
+                pending = deque(pool.submit(run_tile_reconstruction, create_task(n_tile, tile))
+                                    for n_tile,tile in enumerate(tiles[:2 * n_workers]))
+                for accumulator in accumulators.values():
+                    accumulator[...] = 0
+                losses = []
+                for n_tile in range(len(tiles)):
+                    result = pending.popleft().result()
+                    if n_tile + 2 * n_workers < len(tiles):
+                        pending.append(pool.submit(run_tile_reconstruction,
+                                                    create_task(n_tile + 2 * n_workers, tiles[n_tile + 2 * n_workers])))
+                    blend_tile(accumulators, tile_volume_start(rays, optical_info, result['tile']),
+                                result['delta_n'], result['optic_axis'], weights)
+                    losses.append(result['loss'])
+                pass_losses.append(float(np.mean(losses)))
+                pass_disagreements.append(tile_disagreement(accumulators))
+
+                # Weighted average, one plane at a time. The voxels outside every tile are empty
+                covered = accumulators['weights'] > 0
+                for z in range(volume_shape[0]):
+                    delta_n[z] = np.where(covered, accumulators['delta_n'][z] / np.where(covered, accumulators['weights'], 1), 0)
+                    norm = np.linalg.norm(accumulators['optic_axis'][:,z], axis=0)
+                    optic_axis[:,z] = np.where(norm > 0, accumulators['optic_axis'][:,z] / np.where(norm > 0, norm, 1), 1 / np.sqrt(3))
+                delta_n.flush()
+                optic_axis.flush()
+        del accumulators
+    return volume, pass_losses, pass_disagreements
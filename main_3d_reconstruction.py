@@ -9,8 +9,11 @@ from tqdm import tqdm
 import matplotlib.pyplot as plt
 from VolumeRaytraceLFM.abstract_classes import BackEnds
 from VolumeRaytraceLFM.birefringence_implementations import BirefringentVolume, BirefringentRaytraceLFM
-from plotting_tools import plot_birefringence_lines, plot_birefringence_colorized, plot_iteration_update
+from plotting_tools import plot_birefringence_lines, plot_birefringence_colorized, plot_iteration_update, save_iteration_update
 from VolumeRaytraceLFM.optic_config import volume_2_projections
+from VolumeRaytraceLFM.reconstruction import Reconstructor
+from VolumeRaytraceLFM.telemetry import TelemetryCallback
+from VolumeRaytraceLFM.checkpoint import CheckpointCallback, resume_from_checkpoint
 # from N_regularization import N
 
 # Select backend: requires pytorch to calculate gradients
@@ -30,6 +33,7 @@ training_params = {
     'azimuth_weight' : .5,                   # Azimuth loss weight
     'regularization_weight' : 1.0,          # Regularization weight
     'lr' : 1e-3,                            # Learning rate
+    'init_delta_n_scale' : 0.0001,          # Scale of the random initial guess
     'output_posfix' : '15ml_bundleX_E_vector_unit_reg'     # Output file name posfix
 }
 
@@ -125,193 +129,47 @@ with torch.no_grad():
 
 
 ############# 
-# Let's create an optimizer
-# Initial guess:
+# Let's create a reconstructor
+# Initial guess: a random volume scaled by init_delta_n_scale, masked outside the FOV of the microscope.
 # Important is that the range of random voxels should be close to the expected birefringence
-volume_estimation = BirefringentVolume(backend=backend, optical_info=optical_info, \
-                                volume_creation_args = {'init_mode' : 'random'})
-
-# Let's rescale the random to initialize the volume
-volume_estimation.Delta_n.requires_grad = False
-volume_estimation.optic_axis.requires_grad = False
-volume_estimation.Delta_n *= 0.0001
-# And mask out volume that is outside FOV of the microscope
-mask = rays.get_volume_reachable_region()
-volume_estimation.Delta_n[mask.view(-1)==0] = 0
-volume_estimation.Delta_n.requires_grad = True
-volume_estimation.optic_axis.requires_grad = True
-
-# Indicate to this object that we are going to optimize Delta_n and optic_axis
-volume_estimation.members_to_learn.append('Delta_n')
-volume_estimation.members_to_learn.append('optic_axis')
-volume_estimation = volume_estimation.to(device)
-
-trainable_parameters = volume_estimation.get_trainable_variables()
-
-
-#############
-# Create regularization network
-# reg_net = N()
-
-# for name, param in reg_net.named_parameters():
-#     trainable_parameters.append(param)
-# #############
-
-# Create optimizer and loss function
-print(f'Creating an optimizer')
-optimizer = torch.optim.Adam(trainable_parameters, lr=training_params['lr'])
-# loss_function = torch.nn.L1Loss()
-
-# To test differentiability let's define a loss function L = |ret_image_torch|, and minimize it
-losses = []
-data_term_losses = []
-regularization_term_losses = []
-plt.ion()
-figure = plt.figure(figsize=(18,9))
 plt.rcParams['image.origin'] = 'lower'
 
-
-# Create weight mask for the azimuth
-# as the azimuth is irrelevant when the retardance is low, lets scale error with a mask
-azimuth_damp_mask = (ret_image_measured / ret_image_measured.max()).detach()
-
-# with torch.autograd.set_detect_anomaly(True):
-# Vector difference GT
-co_gt, ca_gt = ret_image_measured*torch.cos(azim_image_measured), ret_image_measured*torch.sin(azim_image_measured)
-for ep in tqdm(range(training_params['n_epochs']), "Minimizing"):
-    # Reset gradients so we can compute them again
-    optimizer.zero_grad()
-
-    # Forward project
-    ret_image_current, azim_image_current = rays.ray_trace_through_volume(volume_estimation)
-    # Vector difference
-    co_pred, ca_pred = ret_image_current*torch.cos(azim_image_current), ret_image_current*torch.sin(azim_image_current)
-    data_term = ((co_gt-co_pred)**2 + (ca_gt-ca_pred)**2).mean()
-    # data_term = (ret_image_measured - ret_image_current).abs().mean() + \
-    #     training_params['azimuth_weight'] * torch.cos(azim_image_measured - azim_image_current).abs().mean()
-        # L1 for angles
-        #(2 * (1 - torch.cos(azim_image_measured - azim_image_current)) * azimuth_damp_mask).mean()
-
-    # L1 or sparsity 
-    # regularization_term = volume_estimation.Delta_n.abs().mean()
-    # L2 or sparsity 
-    # regularization_term = (volume_estimation.Delta_n**2).mean()
-    # Unit length regularizer
-    regularization_term  = (1-(volume_estimation.optic_axis[0,...]**2+volume_estimation.optic_axis[1,...]**2+volume_estimation.optic_axis[2,...]**2)).abs().mean()
-    # Total variation regularization would be computing the 3D spatial derivative of the volume and apply an L1 norm to it.
-
-    # Learned regularization
-    # N(volume_estimation.Delt_n)
-    # N(volume_estimation.Delt_n * optic_axis)
-    # N(spatial gradients volume_estimation.Delt_n)
-    # reg_input = torch.cat((volume_estimation.get_delta_n().unsqueeze(0), volume_estimation.get_optic_axis()), 0).unsqueeze(0)
-    # regularization_term = reg_net(reg_input)
-
-    L = data_term + training_params['regularization_weight'] * regularization_term
-
-    # Calculate update of the my_volume (Compute gradients of the L with respect to my_volume)
-    L.backward()
-
-
-    # Multiply update by mask
-    # volume_estimation.Delta_n.requires_grad = False
-    # volume_estimation.optic_axis.requires_grad = False
-    # # And mask out volume that is outside FOV of the microscope
-    # volume_estimation.Delta_n.grad[torch.isnan(volume_estimation.Delta_n.grad)] = 0
-    # volume_estimation.optic_axis.grad[torch.isnan(volume_estimation.optic_axis.grad)] = 0
-    # volume_estimation.Delta_n.requires_grad = True
-    # volume_estimation.optic_axis.requires_grad = True
-
-    # Apply gradient updates to the volume
-    optimizer.step()
-
-    # print(f'Ep:{ep} loss: {L.item()}')
-    losses.append(L.item())
-    data_term_losses.append(data_term.item())
-    regularization_term_losses.append(regularization_term.item())
-
-    azim_image_out = azim_image_current.detach()
-    azim_image_out[azimuth_damp_mask==0] = 0
-
-    if ep%10==0:
-        plt.clf()
-        plot_iteration_update(
-            volume_2_projections(Delta_n_GT.unsqueeze(0))[0,0].detach().cpu().numpy(),
-            ret_image_measured.detach().cpu().numpy(),
-            azim_image_measured.detach().cpu().numpy(),
-            # plot_birefringence_colorized(ret_image_measured.detach().cpu().numpy(), azim_image_measured.detach().cpu().numpy())
-            volume_2_projections(volume_estimation.get_delta_n().unsqueeze(0))[0,0].detach().cpu().numpy(),
-            ret_image_current.detach().cpu().numpy(),
-            np.rad2deg(azim_image_current.detach().cpu().numpy()),
-            # plot_birefringence_colorized(ret_image_current.detach().cpu().numpy(), azim_image_out.detach().cpu().numpy()),
-            losses,
-            data_term_losses,
-            regularization_term_losses
-            )
-        # plt.clf()
-        # plt.subplot(2,4,1)
-        # plt.imshow(ret_image_measured.detach().cpu().numpy())
-        # plt.colorbar()
-        # plt.title('Initial Retardance')
-        # plt.subplot(2,4,2)
-        # # plt.imshow(azim_image_measured.detach().cpu().numpy())
-        # plot_birefringence_colorized(ret_image_measured.detach().cpu().numpy(), azim_image_measured.detach().cpu().numpy())
-        # plt.colorbar()
-        # plt.title('Initial Azimuth')
-        # plt.subplot(2,4,3)
-        # plt.imshow(volume_2_projections((Delta_n_GT.abs()).unsqueeze(0), proj_type=torch.sum, scaling_factors=[1,1,1])[0,0] \
-        #                                 .detach().cpu().numpy())
-        # plt.colorbar()
-        # plt.title('Initial volume MIP')
-
-        # plt.subplot(2,4,5)
-        # plt.imshow(ret_image_current.detach().cpu().numpy())
-        # plt.colorbar()
-        # plt.title('Final Retardance')
-        # plt.subplot(2,4,6)
-        # # plt.imshow(np.rad2deg(azim_image_out.detach().cpu().numpy()))
-        # plot_birefringence_colorized(ret_image_current.detach().cpu().numpy(), azim_image_out.detach().cpu().numpy())
-        # plt.colorbar()
-        # plt.title('Final Azimuth')
-        # plt.subplot(2,4,7)
-        # plt.imshow(volume_2_projections((volume_estimation.get_delta_n().abs()).unsqueeze(0), proj_type=torch.sum, scaling_factors=[1,1,1])[0,0] \
-        #                                 .detach().cpu().numpy())
-        # plt.colorbar()
-        # plt.title('Final Volume MIP')
-
-        # # Plot losses
-        # plt.subplot(3,4,4)
-        # plt.plot(list(range(len(losses))), data_term_losses)
-        # plt.gca().yaxis.set_label_position("right")
-        # plt.gca().yaxis.tick_right()
-        # # plt.xlabel('Epoch')
-        # plt.ylabel('DataTerm loss')
-        # plt.gca().xaxis.set_visible(False)
-
-        # plt.subplot(3,4,8)
-        # plt.plot(list(range(len(losses))), regularization_term_losses)
-        # plt.gca().yaxis.set_label_position("right")
-        # plt.gca().yaxis.tick_right()
-        # # plt.xlabel('Epoch')
-        # plt.ylabel('Reg loss')
-        # plt.gca().xaxis.set_visible(False)
-
-        # plt.subplot(3,4,12)
-        # plt.plot(list(range(len(losses))),losses)
-        # plt.gca().yaxis.set_label_position("right")
-        # plt.gca().yaxis.tick_right()
-        # plt.xlabel('Epoch')
-        # plt.ylabel('Total Loss')
-
-        figure.canvas.draw()
-        figure.canvas.flush_events()
-        time.sleep(0.1)
-        plt.savefig(f"{output_dir}/Optimization_ep_{'{:02d}'.format(ep)}.pdf")
-        time.sleep(0.1)
-
-    if ep%100==0:
-        volume_estimation.save_as_file(f"{output_dir}/volume_ep_{'{:02d}'.format(ep)}.h5")
+# Every 10 epochs a snapshot of the reconstruction is plotted and saved by a background thread,
+#   the ground truth projections are computed once
+telemetry = TelemetryCallback(
+    [lambda snapshot, reference: save_iteration_update(snapshot, reference, f"{output_dir}/Optimization_ep_{'{:02d}'.format(snapshot['ep'])}.pdf")],
+    interval=10,
+    reference={'Delta_n' : Delta_n_GT, 'ret_image' : ret_image_measured, 'azim_image' : azim_image_measured})
+
+# Every 100 epochs the volume, optimizer state and losses are appended to a single file by a background thread
+checkpoints = CheckpointCallback(f'{output_dir}/checkpoints.h5', interval=100)
+
+# The data term and regularizers can be strings from DATA_TERMS and REGULARIZERS, or functions
+# Non-smooth sparsity and total variation penalties are applied with proximal steps, for example:
+#   proximal_terms=[('TV', 0.1), ('L1', 1.0)]
+reconstructor = Reconstructor(rays, ret_image_measured, azim_image_measured,
+                                training_params=training_params,
+                                data_term='vector',
+                                regularizers=[('unit', training_params['regularization_weight'])],
+                                proximal_terms=[],
+                                callbacks=[telemetry, checkpoints])
+# Continue from the latest checkpoint of a previous run, if any
+start_ep = resume_from_checkpoint(reconstructor, f'{output_dir}/checkpoints.h5')
+volume_estimation = reconstructor.reconstruct(n_epochs=training_params['n_epochs'] - start_ep)
+
+telemetry.close()
+checkpoints.close()
 
 # Display
+figure = plt.figure(figsize=(18,9))
+plot_iteration_update(
+    telemetry.reference['Delta_n_mip'], telemetry.reference['ret_image'], telemetry.reference['azim_image'],
+    telemetry.projections(volume_estimation.get_delta_n().detach().cpu()),
+    reconstructor.ret_image_current.cpu().numpy(),
+    np.rad2deg(reconstructor.azim_image_current.cpu().numpy()),
+    reconstructor.losses,
+    reconstructor.data_term_losses,
+    reconstructor.regularization_term_losses,
+    fig=figure)
 plt.savefig(f"{output_dir}/Optimization_final.pdf")
 plt.show()
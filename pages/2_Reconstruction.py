@@ -19,6 +19,7 @@ import matplotlib.pyplot as plt
 from VolumeRaytraceLFM.abstract_classes import BackEnds
 from VolumeRaytraceLFM.birefringence_implementations import BirefringentVolume, BirefringentRaytraceLFM
 from VolumeRaytraceLFM.optic_config import volume_2_projections
+from VolumeRaytraceLFM.reconstruction import Reconstructor
 from plotting_tools import plot_iteration_update
 
 st.header("Choose our parameters")
@@ -191,91 +192,41 @@ if st.button("Reconstruct!"):
 
 
     ############# 
-    # Let's create an optimizer
-    # Initial guess
-    volume_estimation = BirefringentVolume(backend=backend, optical_info=optical_info, \
-                                    volume_creation_args = {'init_mode' : 'random'})
-
-    # Let's rescale the random to initialize the volume
-    volume_estimation.Delta_n.requires_grad = False
-    volume_estimation.optic_axis.requires_grad = False
-    volume_estimation.Delta_n *= 0.0001
-    # And mask out volume that is outside FOV of the microscope
-    mask = rays.get_volume_reachable_region()
-    volume_estimation.Delta_n[mask.view(-1)==0] = 0
-    volume_estimation.Delta_n.requires_grad = True
-    volume_estimation.optic_axis.requires_grad = True
-
-    # Indicate to this object that we are going to optimize Delta_n and optic_axis
-    volume_estimation.members_to_learn.append('Delta_n')
-    volume_estimation.members_to_learn.append('optic_axis')
-    volume_estimation = volume_estimation.to(device)
-
-    trainable_parameters = volume_estimation.get_trainable_variables()
-
-    # Create an optimizer
-    optimizer = torch.optim.Adam(trainable_parameters, lr=training_params['lr'])
-    
-    # To test differentiability let's define a loss function L = |ret_image_torch|, and minimize it
-    losses = []
-    data_term_losses = []
-    regularization_term_losses = []
-    
-    # Create weight mask for the azimuth
-    # as the azimuth is irrelevant when the retardance is low, lets scale error with a mask
-    azimuth_damp_mask = (ret_image_measured / ret_image_measured.max()).detach()
-
-
-    # width = st.sidebar.slider("Plot width", 1, 25, 15)
-    # height = st.sidebar.slider("Plot height", 1, 25, 8)
-    co_gt, ca_gt = ret_image_measured*torch.cos(azim_image_measured), ret_image_measured*torch.sin(azim_image_measured)
-
+    # Let's create a reconstructor, with a random initial guess masked outside the FOV of the microscope
     my_plot = st.empty() # set up a place holder for the plot
     
     st.write("Working on these ", n_epochs, "iterations...")
     my_bar = st.progress(0)
-    for ep in tqdm(range(training_params['n_epochs']), "Minimizing"):
-        optimizer.zero_grad()
-        
-        # Forward projection
-        ret_image_current, azim_image_current = rays.ray_trace_through_volume(volume_estimation)
 
-        # Vector difference
-        co_pred, ca_pred = ret_image_current*torch.cos(azim_image_current), ret_image_current*torch.sin(azim_image_current)
-        data_term = ((co_gt-co_pred)**2 + (ca_gt-ca_pred)**2).mean()
-        regularization_term  = (1-(volume_estimation.optic_axis[0,...]**2+volume_estimation.optic_axis[1,...]**2+volume_estimation.optic_axis[2,...]**2)).abs().mean()
-        L = data_term + training_params['regularization_weight'] * regularization_term
-        # Calculate update of the my_volume (Compute gradients of the L with respect to my_volume)
-        L.backward()
-        
-        # Apply gradient updates to the volume
-        optimizer.step()
-
-        # print(f'Ep:{ep} loss: {L.item()}')
-        losses.append(L.item())
-        data_term_losses.append(data_term.item())
-        regularization_term_losses.append(regularization_term.item())
-
-        azim_image_out = azim_image_current.detach()
-        azim_image_out[azimuth_damp_mask==0] = 0
+    # The ground truth doesn't change, project it once
+    Delta_n_GT_projections = volume_2_projections(Delta_n_GT.unsqueeze(0))[0,0].detach().cpu().numpy()
 
+    def update_streamlit(reconstructor, ep):
+        '''Callback called after every iteration of the reconstruction'''
         percent_complete = int(ep / training_params['n_epochs'] * 100)
         my_bar.progress(percent_complete + 1)
 
         if ep%2==0:
             fig = plot_iteration_update(
-                volume_2_projections(Delta_n_GT.unsqueeze(0))[0,0].detach().cpu().numpy(),
+                Delta_n_GT_projections,
                 ret_image_measured.detach().cpu().numpy(),
                 azim_image_measured.detach().cpu().numpy(),
-                volume_2_projections(volume_estimation.get_delta_n().unsqueeze(0))[0,0].detach().cpu().numpy(),
-                ret_image_current.detach().cpu().numpy(),
-                np.rad2deg(azim_image_current.detach().cpu().numpy()),
-                losses,
-                data_term_losses,
-                regularization_term_losses,
+                volume_2_projections(reconstructor.volume_estimation.get_delta_n().unsqueeze(0))[0,0].detach().cpu().numpy(),
+                reconstructor.ret_image_current.cpu().numpy(),
+                np.rad2deg(reconstructor.azim_image_current.cpu().numpy()),
+                reconstructor.losses,
+                reconstructor.data_term_losses,
+                reconstructor.regularization_term_losses,
                 streamlit_purpose=True
                 )
             
             my_plot.pyplot(fig)
 
+    reconstructor = Reconstructor(rays, ret_image_measured, azim_image_measured,
+                                    training_params=training_params,
+                                    data_term='vector',
+                                    regularizers=[('unit', training_params['regularization_weight'])],
+                                    callbacks=[update_streamlit])
+    reconstructor.reconstruct()
+
     st.success("Done reconstructing! How does it look?", icon="✅")
\ No newline at end of file
@@ -331,64 +331,57 @@ def plot_iteration_update(
                 vol_meas, ret_meas, azim_meas,
                 vol_current, ret_current, azim_current,
                 losses, data_term_losses, regularization_term_losses,
-                streamlit_purpose=False
+                streamlit_purpose=False, fig=None
                 ):
+    '''Plots the measurements, the current predictions and the losses of a reconstruction.
+        The plots are drawn into fig, or the current pyplot figure. As no pyplot state is used when fig
+        is provided, a matplotlib.figure.Figure can be rendered from a background thread.'''
     if streamlit_purpose:
         fig = plt.figure(figsize=(18,9))
         plt.rcParams['image.origin'] = 'lower'
-    
+    elif fig is None:
+        fig = plt.gcf()
+
+    def plot_image(position, image, title, **kwargs):
+        ax = fig.add_subplot(*position)
+        fig.colorbar(ax.imshow(image), ax=ax)
+        ax.set_title(title, **kwargs)
+
+    def plot_loss(position, loss, ylabel):
+        ax = fig.add_subplot(*position)
+        ax.plot(list(range(len(losses))), loss)
+        ax.yaxis.set_label_position("right")
+        ax.yaxis.tick_right()
+        ax.set_ylabel(ylabel)
+        return ax
+
     # Plot measurements
-    plt.subplot(2,4,1)
-    plt.imshow(vol_meas)
-    plt.colorbar()
-    plt.title('Ground truth volume (MIP)', weight='bold')
-    plt.subplot(2,4,2)
-    plt.imshow(ret_meas)
-    plt.colorbar()
-    plt.title('Measured retardance')
-    plt.subplot(2,4,3)
-    plt.imshow(azim_meas)
-    plt.colorbar()
-    plt.title('Measured orientation')
-    
-    
+    plot_image((2,4,1), vol_meas, 'Ground truth volume (MIP)', weight='bold')
+    plot_image((2,4,2), ret_meas, 'Measured retardance')
+    plot_image((2,4,3), azim_meas, 'Measured orientation')
+
     # Plot predictions
-    plt.subplot(2,4,5)
-    plt.imshow(vol_current)
-    plt.colorbar()
-    plt.title('Predicted volume (MIP)', weight='bold')
-    plt.subplot(2,4,6)
-    plt.imshow(ret_current)
-    plt.colorbar()
-    plt.title('Retardance of predicted volume')
-    plt.subplot(2,4,7)
-    plt.imshow(azim_current)
-    plt.colorbar()
-    plt.title('Orientation of predicted volume')
+    plot_image((2,4,5), vol_current, 'Predicted volume (MIP)', weight='bold')
+    plot_image((2,4,6), ret_current, 'Retardance of predicted volume')
+    plot_image((2,4,7), azim_current, 'Orientation of predicted volume')
 
     # Plot losses
-    plt.subplot(3,4,4)
-    plt.plot(list(range(len(losses))), data_term_losses)
-    plt.gca().yaxis.set_label_position("right")
-    plt.gca().yaxis.tick_right()
-    plt.ylabel('Data term loss')
-    plt.gca().xaxis.set_visible(False)
-
-    plt.subplot(3,4,8)
-    plt.plot(list(range(len(losses))), regularization_term_losses)
-    plt.gca().yaxis.set_label_position("right")
-    plt.gca().yaxis.tick_right()
-    plt.ylabel('Regularization term loss')
-    plt.gca().xaxis.set_visible(False)
-
-    plt.subplot(3,4,12)
-    plt.plot(list(range(len(losses))),losses)
-    plt.gca().yaxis.set_label_position("right")
-    plt.gca().yaxis.tick_right()
-    plt.xlabel('Epoch')
-    plt.ylabel('Total loss')
-    
+    plot_loss((3,4,4), data_term_losses, 'Data term loss').xaxis.set_visible(False)
+    plot_loss((3,4,8), regularization_term_losses, 'Regularization term loss').xaxis.set_visible(False)
+    plot_loss((3,4,12), losses, 'Total loss').set_xlabel('Epoch')
+
     if streamlit_purpose:
         return fig
     else:
-        return None
\ No newline at end of file
+        return None
+
+def save_iteration_update(snapshot, reference, filename):
+    '''Renders a telemetry snapshot of a reconstruction (see VolumeRaytraceLFM.telemetry.TelemetryCallback)
+        into a file, without pyplot, so it can run on the telemetry thread'''
+    fig = matplotlib.figure.Figure(figsize=(18,9))
+    plot_iteration_update(
+        reference['Delta_n_mip'], reference['ret_image'], reference['azim_image'],
+        snapshot['Delta_n_mip'], snapshot['ret_image'], np.rad2deg(snapshot['azim_image']),
+        snapshot['losses'], snapshot['data_term_losses'], snapshot['regularization_term_losses'],
+        fig=fig)
+    fig.savefig(filename)
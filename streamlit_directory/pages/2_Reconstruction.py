@@ -16,6 +16,7 @@ from tqdm import tqdm
 from waveblocks.utils.misc_utils import *
 from VolumeRaytraceLFM.abstract_classes import BackEnds
 from VolumeRaytraceLFM.birefringence_implementations import BirefringentVolume, BirefringentRaytraceLFM
+from VolumeRaytraceLFM.reconstruction import Reconstructor
 
 st.header("Choose our parameters")
 
@@ -139,11 +140,12 @@ if st.button("Reconstruct!"):
     my_volume.members_to_learn.append('optic_axis')
     my_volume = my_volume.to(device)
 
-    optimizer = torch.optim.Adam(my_volume.get_trainable_variables(), lr=training_params['lr'])
+    # L1 on the retardance, and the cosine distance on the azimuth
     loss_function = torch.nn.L1Loss()
+    def data_term(reconstructor, ret_image_current, azim_image_current):
+        return loss_function(reconstructor.ret_image_measured, ret_image_current) + \
+            training_params['azimuth_weight'] * (2 * (1 - torch.cos(reconstructor.azim_image_measured - azim_image_current))).mean()
 
-    # To test differentiability let's define a loss function L = |ret_image_torch|, and minimize it
-    losses = []
     plt.ion()
     figure = plt.figure(figsize=(18,6))
     plt.rcParams['image.origin'] = 'lower'
@@ -152,24 +154,14 @@ if st.button("Reconstruct!"):
     my_bar = st.progress(0)
     width = st.sidebar.slider("Plot width", 1, 25, 15)
     height = st.sidebar.slider("Plot height", 1, 25, 8)
-    co_gt, ca_gt = ret_image_measured*torch.cos(azim_image_measured), ret_image_measured*torch.sin(azim_image_measured)
 
     my_plot = st.empty() # set up a place holder for the plot
 
-    for ep in tqdm(range(training_params['n_epochs']), "Minimizing"):
-        optimizer.zero_grad()
-        ret_image_current, azim_image_current = rays.ray_trace_through_volume(my_volume)
-
-        azim_diff = azim_comp_measured - torch.arctan2(torch.sin(azim_image_current), torch.cos(azim_image_current))
-        L = loss_function(ret_image_measured, ret_image_current) + \
-            training_params['azimuth_weight'] * (2 * (1 - torch.cos(azim_image_measured - azim_image_current))).mean()
-
-        # Calculate update of the my_volume (Compute gradients of the L with respect to my_volume)
-        L.backward()
-        # Apply gradient updates to the volume
-        optimizer.step()
-        # print(f'Ep:{ep} loss: {L.item()}')
-        losses.append(L.item())
+    def update_streamlit(reconstructor, ep):
+        '''Callback called after every iteration of the reconstruction'''
+        losses = reconstructor.losses
+        ret_image_current = reconstructor.ret_image_current
+        azim_image_current = reconstructor.azim_image_current
 
         percent_complete = int(ep / training_params['n_epochs'] * 100)
         my_bar.progress(percent_complete + 1)
@@ -202,7 +194,7 @@ if st.button("Reconstruct!"):
             plt.colorbar()
             plt.title('Final Azimuth')
             plt.subplot(2,4,7)
-            plt.imshow(volume_2_projections(my_volume.get_delta_n().unsqueeze(0))[0,0] \
+            plt.imshow(volume_2_projections(reconstructor.volume_estimation.get_delta_n().unsqueeze(0))[0,0] \
                                             .detach().cpu().numpy())
             plt.colorbar()
             plt.title('Final Volume MIP')
@@ -213,14 +205,17 @@ if st.button("Reconstruct!"):
             plt.xlabel('Epoch')
             plt.ylabel('Loss')
 
-            # figure.canvas.draw()
-            # figure.canvas.flush_events()
-            # time.sleep(0.1)
-            # plt.savefig(f"{output_dir}/Optimization_ep_{'{:02d}'.format(ep)}.pdf")
-            # time.sleep(0.1)
             my_plot.pyplot(fig)
             # st.image(fig)
 
+    reconstructor = Reconstructor(rays, ret_image_measured, azim_image_measured,
+                                    volume_estimation=my_volume,
+                                    training_params=training_params,
+                                    data_term=data_term,
+                                    regularizers=[],
+                                    callbacks=[update_streamlit])
+    reconstructor.reconstruct()
+
 
     # st.pyplot(fig)
     # Display
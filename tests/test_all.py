@@ -503,6 +503,341 @@ def test_torch_auto_differentiation(global_data, volume_init_mode):
 
 
 
+def test_polarizer_analyzer_stack(global_data):
+    '''Computing the material Jones matrices once for a stack of LC-PolScope settings should match
+        computing the forward projection once per setting'''
+    torch.set_grad_enabled(False)
+    # Gather global data
+    local_data = copy.deepcopy(global_data)
+    optical_info = local_data['optical_info']
+    optical_info['volume_shape'] = [7,7,7]
+    optical_info['n_micro_lenses'] = 3
+    optical_info['pixels_per_ml'] = 17
+
+    BF_raytrace_torch = BirefringentRaytraceLFM(backend=BackEnds.PYTORCH, optical_info=optical_info)
+    BF_raytrace_torch.compute_rays_geometry()
+    volume_torch = BirefringentVolume(backend=BackEnds.PYTORCH, optical_info=optical_info, volume_creation_args={'init_mode' : 'ellipsoid'})
+
+    polarizers = np.stack([JonesMatrixGenerators.universal_compensator_modes(setting=n, swing=0.03) for n in range(5)])
+    analyzer = JonesMatrixGenerators.polscope_analyzer()
+    ret_stack, azim_stack = BF_raytrace_torch.ray_trace_through_volume(volume_torch, polarizers=polarizers, analyzers=analyzer)
+    assert ret_stack.shape == (5, 51, 51) and azim_stack.shape == (5, 51, 51)
+
+    # Reusing the material Jones matrices gives the same effective Jones matrices
+    material_JM = BF_raytrace_torch.calc_material_JM_of_ray_torch(volume_torch, all_rays_at_once=True)
+    effective_JM_stack = BF_raytrace_torch.calc_cummulative_JM_of_ray_torch(volume_torch, material_JM=material_JM,
+                                                                        polarizers=polarizers, analyzers=analyzer)
+    for setting in range(5):
+        # Change the polarizer of the ray-tracer and volume, the cached conversion should be refreshed
+        optical_info['polarizer'] = polarizers[setting]
+        optical_info['analyzer'] = analyzer
+        effective_JM = BF_raytrace_torch.calc_cummulative_JM_of_ray_torch(volume_torch, all_rays_at_once=True)
+        ret_image, azim_image = BF_raytrace_torch.ray_trace_through_volume(volume_torch)
+        assert torch.allclose(effective_JM_stack[setting], effective_JM, atol=1e-6), f'Effective Jones matrix mismatch for setting {setting}'
+        assert torch.allclose(ret_stack[setting], ret_image, atol=1e-5), f'Retardance mismatch for setting {setting}'
+        # The azimuth of these non-unitary Jones matrices is ill-conditioned, so it's not compared here
+
+
+def test_multi_wavelength_batch(global_data):
+    '''Simulating a vector of wavelengths at once should match one forward projection per wavelength'''
+    torch.set_grad_enabled(False)
+    # Gather global data
+    local_data = copy.deepcopy(global_data)
+    optical_info = local_data['optical_info']
+    optical_info['volume_shape'] = [7,7,7]
+    optical_info['n_micro_lenses'] = 3
+    optical_info['pixels_per_ml'] = 17
+
+    BF_raytrace_torch = BirefringentRaytraceLFM(backend=BackEnds.PYTORCH, optical_info=optical_info)
+    BF_raytrace_torch.compute_rays_geometry()
+    volume_torch = BirefringentVolume(backend=BackEnds.PYTORCH, optical_info=optical_info, volume_creation_args={'init_mode' : 'ellipsoid'})
+
+    wavelengths = [0.450, 0.550, 0.650]
+    dispersion = [1.1, 1.0, 0.95]
+    ret_batch, azim_batch = BF_raytrace_torch.ray_trace_through_volume(volume_torch, wavelengths=wavelengths, dispersion=dispersion)
+    assert ret_batch.shape == (3, 51, 51) and azim_batch.shape == (3, 51, 51)
+
+    # Polarizer stacks and wavelengths can be combined
+    polarizers = np.stack([JonesMatrixGenerators.universal_compensator_modes(setting=n, swing=0.03) for n in range(5)])
+    material_JM = BF_raytrace_torch.calc_material_JM_of_ray_torch(volume_torch, all_rays_at_once=True, wavelengths=wavelengths)
+    ret_stack, _ = BF_raytrace_torch.ret_and_azim_images_mla_torch(volume_torch, material_JM=material_JM, polarizers=polarizers)
+    assert ret_stack.shape == (5, 3, 51, 51)
+
+    # A dispersion alone is applied at the wavelength of optical_info
+    ret_dispersion, _ = BF_raytrace_torch.ray_trace_through_volume(volume_torch, dispersion=dispersion[:1])
+    assert ret_dispersion.shape == (1, 51, 51)
+    delta_n = volume_torch.Delta_n.clone()
+    volume_torch.Delta_n.copy_(delta_n * dispersion[0])
+    ret_image, _ = BF_raytrace_torch.ray_trace_through_volume(volume_torch)
+    volume_torch.Delta_n.copy_(delta_n)
+    assert torch.allclose(ret_dispersion[0], ret_image, atol=1e-5)
+
+    for n_wavelength, wavelength in enumerate(wavelengths):
+        # optical_info is shared by the ray-tracer and the volume
+        optical_info['wavelength'] = wavelength
+        volume_torch.Delta_n.copy_(delta_n * dispersion[n_wavelength])
+        ret_image, azim_image = BF_raytrace_torch.ray_trace_through_volume(volume_torch)
+        volume_torch.Delta_n.copy_(delta_n)
+        assert torch.allclose(ret_batch[n_wavelength], ret_image, atol=1e-5), f'Retardance mismatch for wavelength {wavelength}'
+        check_azimuth_images(azim_batch[n_wavelength].numpy(), azim_image.numpy())
+
+
+def test_volume_shifts_batch(global_data):
+    '''Projecting a list of shifted versions of a volume with index offsets should match
+        shifting the volume and projecting each of them'''
+    torch.set_grad_enabled(False)
+    # Gather global data
+    local_data = copy.deepcopy(global_data)
+    optical_info = local_data['optical_info']
+    optical_info['volume_shape'] = [7,9,9]
+    optical_info['n_micro_lenses'] = 3
+    optical_info['pixels_per_ml'] = 17
+
+    BF_raytrace_torch = BirefringentRaytraceLFM(backend=BackEnds.PYTORCH, optical_info=optical_info)
+    BF_raytrace_torch.compute_rays_geometry()
+    volume_torch = BirefringentVolume(backend=BackEnds.PYTORCH, optical_info=optical_info, volume_creation_args={'init_mode' : 'random'})
+
+    shifts = [[0,0,0], [-2,0,0], [1,0,0], [1,-1,2]]
+    ret_stack, azim_stack = BF_raytrace_torch.ray_trace_through_volume_shifts(volume_torch, shifts)
+    assert ret_stack.shape == (4, 51, 51)
+    # Only axial shifts
+    ret_axial, _ = BF_raytrace_torch.ray_trace_through_volume_shifts(volume_torch, [-2, 1])
+    assert torch.allclose(ret_axial, ret_stack[1:3])
+
+    delta_n = volume_torch.get_delta_n().clone()
+    optic_axis = volume_torch.get_optic_axis().clone()
+    for n_shift, shift in enumerate(shifts):
+        # Shift the volume filling with zeros
+        shifted_delta_n = torch.zeros_like(delta_n)
+        shifted_optic_axis = torch.zeros_like(optic_axis)
+        src = [slice(max(0, -s), min(n, n - s)) for s,n in zip(shift, optical_info['volume_shape'])]
+        dst = [slice(max(0, s), min(n, n + s)) for s,n in zip(shift, optical_info['volume_shape'])]
+        shifted_delta_n[dst[0],dst[1],dst[2]] = delta_n[src[0],src[1],src[2]]
+        shifted_optic_axis[:,dst[0],dst[1],dst[2]] = optic_axis[:,src[0],src[1],src[2]]
+        shifted_volume = BirefringentVolume(backend=BackEnds.PYTORCH, optical_info=optical_info,
+                                            Delta_n=shifted_delta_n, optic_axis=shifted_optic_axis)
+        ret_image, azim_image = BF_raytrace_torch.ray_trace_through_volume(shifted_volume)
+        assert torch.allclose(ret_stack[n_shift], ret_image, atol=1e-5), f'Retardance mismatch for shift {shift}'
+        assert torch.allclose(azim_stack[n_shift], azim_image, atol=1e-5), f'Azimuth mismatch for shift {shift}'
+
+
+@pytest.mark.parametrize('z_range', [[0,2], [3,4], [5,7], [0,7]])
+def test_slab_jones_matrices(global_data, z_range):
+    '''The cached Jones Matrices before and after an axial slab, combined with the ones of the slab,
+        should match the material Jones Matrices of the whole volume, and only depend on the slab voxels'''
+    torch.set_grad_enabled(False)
+    # Gather global data
+    local_data = copy.deepcopy(global_data)
+    optical_info = local_data['optical_info']
+    optical_info['volume_shape'] = [7,9,9]
+    optical_info['n_micro_lenses'] = 3
+    optical_info['pixels_per_ml'] = 17
+
+    BF_raytrace_torch = BirefringentRaytraceLFM(backend=BackEnds.PYTORCH, optical_info=optical_info)
+    BF_raytrace_torch.compute_rays_geometry()
+    BF_raytrace_torch.precompute_MLA_volume_geometry()
+    volume_torch = BirefringentVolume(backend=BackEnds.PYTORCH, optical_info=optical_info, volume_creation_args={'init_mode' : 'random'})
+    volume_torch.Delta_n *= 0.05
+
+    material_JM = BF_raytrace_torch.calc_material_JM_of_ray_torch(volume_torch, all_rays_at_once=True)
+    slab_cache = BF_raytrace_torch.precompute_slab_JM_torch(volume_torch, z_range)
+    slab_JM = BF_raytrace_torch.calc_material_JM_of_slab_torch(volume_torch, slab_cache)
+    assert torch.allclose(slab_JM, material_JM, atol=1e-5), f'Jones Matrices mismatch for slab {z_range}'
+
+    # Changing the voxels outside the slab doesn't change the result
+    outside_slab = torch.ones(optical_info['volume_shape'], dtype=torch.bool)
+    outside_slab[z_range[0]:z_range[1]] = False
+    volume_torch.Delta_n[outside_slab.view(-1)] = 0
+    assert torch.equal(BF_raytrace_torch.calc_material_JM_of_slab_torch(volume_torch, slab_cache), slab_JM)
+
+
+@pytest.mark.parametrize('dtype', [np.float32, np.float16])
+def test_volume_file_format(global_data, tmp_path, dtype):
+    '''Volumes are stored chunked and compressed in the requested dtype,
+        and regions of interest are loaded into the center of the workspace'''
+    local_data = copy.deepcopy(global_data)
+    optical_info = local_data['optical_info']
+    optical_info['volume_shape'] = [5,9,9]
+    volume = BirefringentVolume(backend=BackEnds.PYTORCH, optical_info=optical_info, volume_creation_args={'init_mode' : 'random'})
+    filename = str(tmp_path / 'volume.h5')
+    volume.save_as_file(filename, optical_all=True, dtype=dtype, chunk_shape=[2,4,4])
+    with h5py.File(filename, 'r') as f:
+        assert f['data/delta_n'].dtype == dtype and f['data/delta_n'].chunks == (2,4,4)
+        assert f['data/optic_axis'].chunks == (3,2,4,4) and f['data/delta_n'].compression == 'gzip'
+        assert list(f['optical_info/volume_shape']) == [5,9,9]
+        assert f['optical_info/polarizer'].shape == (2,2)
+        stored_delta_n = f['data/delta_n'][()]
+
+    # The NUMPY back-end keeps the stored type
+    loaded = BirefringentVolume.init_from_file(filename, BackEnds.NUMPY, optical_info)
+    assert loaded.get_delta_n().dtype == np.promote_types(dtype, np.float32)
+    assert np.array_equal(loaded.get_delta_n(), stored_delta_n)
+    loaded_torch = BirefringentVolume.init_from_file(filename, BackEnds.PYTORCH, optical_info)
+    assert loaded_torch.Delta_n.dtype == torch.get_default_dtype()
+    tolerance = 1e-3 if dtype == np.float16 else 1e-6
+    assert torch.allclose(loaded_torch.get_delta_n().detach(), volume.get_delta_n().detach(), atol=tolerance)
+    assert torch.allclose(loaded_torch.get_optic_axis().detach(), volume.get_optic_axis().detach(), atol=tolerance)
+
+    # A region of interest is placed in the center of a larger workspace
+    roi_info = copy.deepcopy(optical_info)
+    roi_info['volume_shape'] = [3,7,7]
+    roi = BirefringentVolume.init_from_file(filename, BackEnds.NUMPY, roi_info, roi=[[1,4], [2,7], slice(1,8)])
+    assert roi.get_delta_n().shape == (3,7,7)
+    assert np.array_equal(roi.get_delta_n()[:,1:6,:], stored_delta_n[1:4,2:7,1:8])
+    assert not roi.get_delta_n()[:,[0,6],:].any()
+    assert np.all(roi.get_optic_axis()[:,:,0,:] == np.sqrt(3) / np.linalg.norm([np.sqrt(3)] * 3))
+    # Without a region of interest the stored volume doesn't fit
+    with pytest.raises(AssertionError):
+        BirefringentVolume.init_from_file(filename, BackEnds.NUMPY, roi_info)
+
+
+@pytest.mark.parametrize('backend', [BackEnds.NUMPY, BackEnds.PYTORCH])
+def test_sparse_volume_file(global_data, tmp_path, backend):
+    '''Mostly empty volumes are stored as a list of their nonzero voxels'''
+    to_numpy = lambda data: data.detach().numpy() if torch.is_tensor(data) else data
+    local_data = copy.deepcopy(global_data)
+    optical_info = local_data['optical_info']
+    optical_info['volume_shape'] = [15,51,51]
+    volume = BirefringentVolume.init_from_file('objects/single_voxel.h5', backend, optical_info)
+    volume.save_as_file(str(tmp_path / 'dense.h5'))
+    volume.save_as_file(str(tmp_path / 'sparse.h5'), layout='coo')
+    assert os.path.getsize(tmp_path / 'sparse.h5') < os.path.getsize(tmp_path / 'dense.h5')
+
+    dense = BirefringentVolume.init_from_file(str(tmp_path / 'dense.h5'), backend, optical_info)
+    sparse = BirefringentVolume.init_from_file(str(tmp_path / 'sparse.h5'), backend, optical_info)
+    assert type(sparse.Delta_n) == type(dense.Delta_n) and sparse.Delta_n.dtype == dense.Delta_n.dtype
+    delta_n = to_numpy(sparse.get_delta_n())
+    assert np.count_nonzero(delta_n) == 1 and np.array_equal(delta_n, to_numpy(dense.get_delta_n()))
+    assert np.array_equal(to_numpy(sparse.get_optic_axis())[:,delta_n != 0], to_numpy(dense.get_optic_axis())[:,delta_n != 0])
+
+    # Regions of interest only keep the voxels inside them
+    roi_info = copy.deepcopy(optical_info)
+    roi_info['volume_shape'] = [15,5,5]
+    z,y,x = np.argwhere(delta_n)[0]
+    roi = BirefringentVolume.init_from_file(str(tmp_path / 'sparse.h5'), backend, roi_info, roi=[[0,15], [y-1,y+4], [x-4,x+1]])
+    roi_delta_n = to_numpy(roi.get_delta_n())
+    assert roi_delta_n[z,1,4] == delta_n[z,y,x] and np.count_nonzero(roi_delta_n) == 1
+    empty = BirefringentVolume.init_from_file(str(tmp_path / 'sparse.h5'), backend, roi_info, roi=[[0,15], [0,5], [0,5]])
+    assert not to_numpy(empty.get_delta_n()).any()
+
+
+@pytest.mark.parametrize('backend', [BackEnds.NUMPY, BackEnds.PYTORCH])
+def test_geometry_file(global_data, tmp_path, backend):
+    '''The geometry is stored as arrays, and the loaded ray-tracer gives the same images'''
+    local_data = copy.deepcopy(global_data)
+    optical_info = local_data['optical_info']
+    optical_info['volume_shape'] = [5,9,9]
+    optical_info['pixels_per_ml'] = 9
+    optical_info['n_micro_lenses'] = 3 if backend == BackEnds.PYTORCH else 1
+    filename = str(tmp_path / 'geometry.h5')
+    rays = BirefringentRaytraceLFM(backend=backend, optical_info=optical_info)
+    rays.compute_rays_geometry()
+    volume = BirefringentVolume(backend=backend, optical_info=optical_info, volume_creation_args={'init_mode' : 'random'})
+    images = rays.ray_trace_through_volume(volume)
+    rays.save_geometry(filename)
+    with h5py.File(filename, 'r') as f:
+        assert f.attrs['geometry_format_version'] == GEOMETRY_FORMAT_VERSION
+        assert ('vox_indices_ml_shifted_all' in f['geometry']) == (backend == BackEnds.PYTORCH)
+
+    loaded_rays = BirefringentRaytraceLFM.load_geometry(filename)
+    assert loaded_rays.backend == backend and loaded_rays.optical_info['volume_shape'] == [5,9,9]
+    assert np.array_equal(loaded_rays.optical_info['polarizer'], optical_info['polarizer'])
+    assert loaded_rays.ray_vol_colli_indices == rays.ray_vol_colli_indices
+    if backend == BackEnds.PYTORCH:
+        assert loaded_rays.MLA_volume_geometry_ready
+        assert loaded_rays.vox_indices_ml_shifted_all == rays.vox_indices_ml_shifted_all
+        assert not loaded_rays.ray_vol_colli_lengths.requires_grad
+    else:
+        assert isinstance(loaded_rays.ray_vol_colli_lengths, np.memmap)
+    loaded_volume = copy.deepcopy(volume)
+    loaded_volume.optical_info = loaded_rays.optical_info
+    for image,loaded_image in zip(images, loaded_rays.ray_trace_through_volume(loaded_volume)):
+        image, loaded_image = (image.detach(), loaded_image.detach()) if backend == BackEnds.PYTORCH else (image, loaded_image)
+        assert np.array_equal(image, loaded_image)
+
+    # compute_rays_geometry loads an existing file
+    assert BirefringentRaytraceLFM(backend=backend, optical_info=optical_info).compute_rays_geometry(filename).ray_vol_colli_indices \
+        == rays.ray_vol_colli_indices
+
+
+@pytest.mark.parametrize('frozen_member', ['Delta_n', 'optic_axis'])
+def test_frozen_member_fast_path(global_data, frozen_member):
+    '''Learning only one of Delta_n and optic_axis reuses the terms of the other one,
+        this should give the same images and gradients as learning both'''
+    torch.set_grad_enabled(True)
+    # Gather global data
+    local_data = copy.deepcopy(global_data)
+    optical_info = local_data['optical_info']
+    optical_info['volume_shape'] = [5,7,7]
+    optical_info['n_micro_lenses'] = 3
+    optical_info['pixels_per_ml'] = 17
+    learned_member = 'optic_axis' if frozen_member == 'Delta_n' else 'Delta_n'
+
+    BF_raytrace_torch = BirefringentRaytraceLFM(backend=BackEnds.PYTORCH, optical_info=optical_info)
+    BF_raytrace_torch.compute_rays_geometry()
+    volume_full = BirefringentVolume(backend=BackEnds.PYTORCH, optical_info=optical_info, volume_creation_args={'init_mode' : 'random'})
+    volume_full.members_to_learn += ['Delta_n', 'optic_axis']
+    volume_frozen = BirefringentVolume(backend=BackEnds.PYTORCH, optical_info=optical_info, volume_creation_args={'init_mode' : 'random'})
+    volume_frozen.members_to_learn.append(learned_member)
+    with torch.no_grad():
+        volume_frozen.Delta_n.copy_(volume_full.Delta_n)
+        volume_frozen.optic_axis.copy_(volume_full.optic_axis)
+
+    for n_iteration in range(3):
+        images = []
+        for volume in [volume_full, volume_frozen]:
+            getattr(volume, learned_member).grad = None
+            ret_image, azim_image = BF_raytrace_torch.ray_trace_through_volume(volume)
+            (ret_image.mean() + azim_image.mean()).backward()
+            images.append((ret_image.detach(), azim_image.detach(), getattr(volume, learned_member).grad))
+        for image_full, image_frozen in zip(*images):
+            assert torch.allclose(image_full, image_frozen, atol=1e-6), f'Mismatch with a frozen {frozen_member}'
+        assert len(BF_raytrace_torch.frozen_terms) > 0, 'The terms of the frozen member were not stored'
+        # Changing the frozen member in-place should invalidate the stored terms
+        with torch.no_grad():
+            for volume in [volume_full, volume_frozen]:
+                getattr(volume, frozen_member).mul_(0.9)
+
+
+@pytest.mark.parametrize('n_frames', [4, 5])
+def test_lc_polscope_frames(global_data, n_frames):
+    '''Simulated LC-PolScope frames with Jones vectors should match the Jones matrices computation,
+        and processing them should give back the retardance and azimuth of the forward model'''
+    torch.set_grad_enabled(False)
+    # Gather global data
+    local_data = copy.deepcopy(global_data)
+    optical_info = local_data['optical_info']
+    optical_info['volume_shape'] = [5,7,7]
+    optical_info['n_micro_lenses'] = 3
+    optical_info['pixels_per_ml'] = 17
+
+    BF_raytrace_torch = BirefringentRaytraceLFM(backend=BackEnds.PYTORCH, optical_info=optical_info)
+    BF_raytrace_torch.compute_rays_geometry()
+
+    # A single plane with a lateral optic axis, every ray behaves as a linear retarder
+    delta_n = np.zeros(optical_info['volume_shape'])
+    delta_n[2,...] = 0.01
+    optic_axis = np.zeros([3,] + optical_info['volume_shape'])
+    optic_axis[1,...] = 0.6
+    optic_axis[2,...] = 0.8
+    volume_torch = BirefringentVolume(backend=BackEnds.PYTORCH, optical_info=optical_info, Delta_n=delta_n, optic_axis=optic_axis)
+
+    frames_vectors = BF_raytrace_torch.lc_polscope_frames(volume_torch, swing=0.03, n_frames=n_frames, method='vectors')
+    frames_matrices = BF_raytrace_torch.lc_polscope_frames(volume_torch, swing=0.03, n_frames=n_frames)
+    assert frames_vectors.shape == (n_frames, 51, 51)
+    assert torch.allclose(frames_vectors, frames_matrices, atol=1e-6), 'Jones vector and Jones matrix frames mismatch'
+
+    ret_image, azim_image = BF_raytrace_torch.ray_trace_through_volume(volume_torch)
+    ret_polscope, azim_polscope = BirefringentRaytraceLFM.ret_and_azim_from_polscope_frames(frames_vectors.double(), swing=0.03)
+    assert torch.allclose(ret_polscope.float(), ret_image, atol=1e-5), 'Retardance mismatch after processing the LC-PolScope frames'
+    has_retardance = ret_image > 1e-3
+    check_azimuth_images(azim_polscope[has_retardance].float().numpy(), azim_image[has_retardance].numpy())
+
+    # The numpy implementation of the processing gives the same results
+    ret_numpy, azim_numpy = BirefringentRaytraceLFM.ret_and_azim_from_polscope_frames(frames_vectors.double().numpy(), swing=0.03)
+    assert np.allclose(ret_numpy, ret_polscope.numpy()) and np.allclose(azim_numpy, azim_polscope.numpy())
+
+
 # @pytest.mark.parametrize('volume_init_mode', [
 #         'random',
 #         'ellipsoid',
@@ -0,0 +1,81 @@
+import pytest
+
+from VolumeRaytraceLFM.birefringence_implementations import *
+from VolumeRaytraceLFM.data_loading import *
+from PIL import Image
+import threading
+import os
+
+
+def create_stack(n_frames=3, n_lenslets=5, pixels_per_ml=4):
+    '''Random stack of frames covering n_lenslets x n_lenslets lenslets, plus a few extra pixels'''
+    size = n_lenslets * pixels_per_ml + 2
+    return np.random.uniform(0, 1, [n_frames, size, size]).astype(np.float32)
+
+def test_metadata_lenslet_grid():
+    '''The optics and the lenslet grid are read from the napari-lf metadata'''
+    metadata = read_lf_metadata(os.path.join(os.path.dirname(__file__), '../objects/experimental/SM_2022_1214_1446_1 spiral LF/Pos0'))
+    optical_info = optical_info_from_metadata(metadata, BirefringentVolume.get_optical_info_template())
+    assert optical_info['pixels_per_ml'] == 16 and optical_info['na_obj'] == 1.2
+    assert np.isclose(optical_info['wavelength'], 0.593)
+
+    crop = lenslet_grid_crop([100, 90], 16, 3)
+    assert crop == (slice(16, 64), slice(16, 64))
+    assert lenslet_grid_crop([100, 90], 16, 3, start_ml=[2,1]) == (slice(32, 80), slice(16, 64))
+    with pytest.raises(AssertionError):
+        lenslet_grid_crop([100, 90], 16, 3, start_ml=[4,0])
+
+@pytest.mark.parametrize('file_format', ['npy', 'h5', 'h5_compressed', 'tif', 'png'])
+def test_birefringence_frames(tmp_path, file_format):
+    '''Frames are cropped to the lenslet grid, and the memory-mapped ones are not copied'''
+    n_frames = 1 if file_format == 'png' else 3
+    stacks = [create_stack(n_frames), create_stack(n_frames)]
+    paths = []
+    for name,stack in zip(['retardance', 'azimuth'], stacks):
+        path = str(tmp_path / f'{name}.{file_format.split("_")[0]}')
+        if file_format == 'npy':
+            np.save(path, stack)
+        elif file_format.startswith('h5'):
+            with h5py.File(path, 'w') as f:
+                f.create_dataset('data', data=stack, **({'chunks' : True, 'compression' : 'gzip'} if file_format == 'h5_compressed' else {}))
+        elif file_format == 'tif':
+            frames = [Image.fromarray(frame) for frame in stack]
+            frames[0].save(path, save_all=True, append_images=frames[1:])
+        else:
+            stack[:] = np.round(stack * 65535) / 65535
+            Image.fromarray((stack[0] * 65535).astype(np.uint16)).save(path)
+        paths.append(path)
+
+    frames = BirefringenceFrames(*paths, pixels_per_ml=4, n_micro_lenses=3, start_ml=[1,2],
+                                    retardance_max=None if file_format != 'png' else 1.0)
+    assert len(frames) == n_frames
+    for n_frame,(ret_image, azim_image) in enumerate(frames):
+        assert ret_image.dtype == torch.float32 and ret_image.shape == (12, 12)
+        expected_ret = stacks[0][n_frame, 4:16, 8:20]
+        if file_format == 'png':
+            expected_ret = expected_ret / expected_ret.max()
+        else:
+            assert np.array_equal(azim_image.numpy(), stacks[1][n_frame, 4:16, 8:20])
+        assert np.allclose(ret_image.numpy(), expected_ret, atol=1e-6)
+    if file_format in ['npy', 'h5']:
+        assert isinstance(frames.retardance, np.memmap)
+        assert np.shares_memory(frames[1][0].numpy(), frames.retardance)
+
+def test_frames_prefetch(tmp_path):
+    '''Iterating reads the next frames in a background thread'''
+    stack = create_stack(n_frames=6)
+    np.save(tmp_path / 'ret.npy', stack)
+    np.save(tmp_path / 'azim.npy', stack)
+    frames = BirefringenceFrames(str(tmp_path / 'ret.npy'), str(tmp_path / 'azim.npy'), pixels_per_ml=4, n_micro_lenses=3,
+                                    retardance_max=0.01, azimuth_max=np.pi, prefetch=2)
+    loaded_frames = []
+    original_load_frame = frames.load_frame
+    def load_frame(n_frame):
+        loaded_frames.append((n_frame, threading.current_thread().name))
+        return original_load_frame(n_frame)
+    frames.load_frame = load_frame
+    for n_frame,(ret_image, azim_image) in enumerate(frames):
+        # The next frames were already requested
+        assert n_frame + 1 <= len(loaded_frames) <= min(n_frame + 3, 6)
+        assert np.isclose(ret_image.max().item(), 0.01) and np.isclose(azim_image.max().item(), np.pi)
+    assert all(name.startswith('frame-loader') for _,name in loaded_frames)
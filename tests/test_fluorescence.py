@@ -0,0 +1,101 @@
+import pytest
+
+from VolumeRaytraceLFM.birefringence_implementations import *
+from VolumeRaytraceLFM.fluorescence_implementations import *
+import copy
+
+
+@pytest.fixture(scope = 'module')
+def global_data():
+    '''Create global optical_info containing all the optics and volume information'''
+    torch.set_default_tensor_type(torch.DoubleTensor)
+
+    optical_info = OpticalElement.get_optical_info_template()
+    optical_info['volume_shape'] = [5, 13, 13]
+    optical_info['axial_voxel_size_um'] = 1.0
+    optical_info['pixels_per_ml'] = 17
+    optical_info['na_obj'] = 1.2
+    optical_info['n_medium'] = 1.52
+    optical_info['wavelength'] = 0.550
+    optical_info['n_micro_lenses'] = 3
+    optical_info['n_voxels_per_ml'] = 1
+
+    return {'optical_info' : optical_info}
+
+def test_forward_projection_matches_ray_sums(global_data):
+    '''The sparse projection should match summing length*intensity along the rays of every micro-lens'''
+    torch.set_grad_enabled(False)
+    optical_info = copy.deepcopy(global_data['optical_info'])
+
+    FL_raytrace = FluorescentRaytraceLFM(backend=BackEnds.PYTORCH, optical_info=optical_info)
+    FL_raytrace.compute_rays_geometry()
+    # The birefringent ray-tracer stores the same MLA geometry as lists, use it as a reference
+    BF_raytrace = BirefringentRaytraceLFM(backend=BackEnds.PYTORCH, optical_info=optical_info)
+    BF_raytrace.compute_rays_geometry()
+    BF_raytrace.precompute_MLA_volume_geometry()
+
+    volume = FL_raytrace.init_volume(init_mode='random')
+    image = FL_raytrace.ray_trace_through_volume(volume)
+
+    image_reference = torch.zeros_like(image)
+    volume_flat = volume.flatten()
+    for n_ray, vox in enumerate(BF_raytrace.vox_indices_ml_shifted_all):
+        i, j = BF_raytrace.ray_valid_indices_all[:, n_ray]
+        lengths = BF_raytrace.ray_vol_colli_lengths[n_ray, :len(vox)]
+        image_reference[i, j] = (lengths * volume_flat[vox]).sum()
+
+    assert torch.allclose(image, image_reference), 'Sparse forward projection mismatch with ray sums'
+
+def test_numpy_torch_and_batches(global_data):
+    '''Numpy and Pytorch back-ends should agree, and a batch should match individual projections'''
+    torch.set_grad_enabled(False)
+    optical_info = copy.deepcopy(global_data['optical_info'])
+
+    FL_raytrace_numpy = FluorescentRaytraceLFM(backend=BackEnds.NUMPY, optical_info=optical_info)
+    FL_raytrace_torch = FluorescentRaytraceLFM(backend=BackEnds.PYTORCH, optical_info=optical_info)
+    FL_raytrace_numpy.compute_rays_geometry()
+    FL_raytrace_torch.compute_rays_geometry()
+
+    volumes = np.random.uniform(0, 1, [3] + optical_info['volume_shape'])
+    images_numpy = FL_raytrace_numpy.ray_trace_through_volume(FL_raytrace_numpy.init_volume(volumes))
+    images_torch = FL_raytrace_torch.ray_trace_through_volume(FL_raytrace_torch.init_volume(volumes))
+
+    assert images_numpy.shape == (3, 51, 51)
+    assert np.allclose(images_numpy, images_torch.numpy()), 'Mismatch between numpy and torch fluorescence images'
+    for n_vol in range(volumes.shape[0]):
+        single_image = FL_raytrace_torch.ray_trace_through_volume(torch.from_numpy(volumes[n_vol]))
+        assert torch.allclose(single_image, images_torch[n_vol]), 'Batched projection mismatch'
+
+@pytest.mark.parametrize('backend', [BackEnds.NUMPY, BackEnds.PYTORCH])
+def test_backprojection_is_adjoint(global_data, backend):
+    '''<A x, y> should be equal to <x, A^T y>'''
+    torch.set_grad_enabled(False)
+    optical_info = copy.deepcopy(global_data['optical_info'])
+
+    FL_raytrace = FluorescentRaytraceLFM(backend=backend, optical_info=optical_info)
+    FL_raytrace.compute_rays_geometry()
+
+    x = FL_raytrace.init_volume(init_mode='random')
+    y = np.random.uniform(0, 1, FL_raytrace.get_image_shape())
+    if backend == BackEnds.PYTORCH:
+        y = torch.from_numpy(y)
+    A_x = FL_raytrace.ray_trace_through_volume(x)
+    A_T_y = FL_raytrace.backproject(y)
+
+    assert np.isclose(float((A_x * y).sum()), float((x * A_T_y).sum())), 'Backprojection is not the adjoint of the forward projection'
+
+def test_fluorescence_auto_differentiation(global_data):
+    torch.set_grad_enabled(True)
+    optical_info = copy.deepcopy(global_data['optical_info'])
+
+    FL_raytrace = FluorescentRaytraceLFM(backend=BackEnds.PYTORCH, optical_info=optical_info)
+    FL_raytrace.compute_rays_geometry()
+
+    volume = FL_raytrace.init_volume(init_mode='random').requires_grad_(True)
+    image = FL_raytrace.ray_trace_through_volume(volume)
+    image.sum().backward()
+
+    # The gradient of the sum of the image is the backprojection of ones
+    with torch.no_grad():
+        expected_grad = FL_raytrace.backproject(torch.ones(FL_raytrace.get_image_shape()))
+    assert torch.allclose(volume.grad, expected_grad), 'Gradients were not propagated to the volume correctly'
@@ -37,6 +37,10 @@ def test_polscope():
         "Universal compensator does not extinguish right circularly polarizerd light in the \
         extinction setting"
     # Note: Universal compensator is not a right circular polarizer in the extinction setting
+    crossed_analyzer = JonesMatrixGenerators.polscope_crossed_analyzer()
+    output_vector = crossed_analyzer @ universal @ JonesVectorGenerators.horizonal()
+    assert np.isclose(np.linalg.norm(output_vector), 0), \
+        "Crossed analyzer does not extinguish the universal compensator in the extinction setting"
     # TODO: test the polscope settings
 
 def main():
@@ -0,0 +1,534 @@
+import pytest
+
+from VolumeRaytraceLFM.birefringence_implementations import *
+from VolumeRaytraceLFM.reconstruction import *
+import copy
+
+
+@pytest.fixture(scope = 'module')
+def global_data():
+    '''Create global optical_info containing all the optics and volume information'''
+    torch.set_default_tensor_type(torch.DoubleTensor)
+
+    optical_info = OpticalElement.get_optical_info_template()
+    optical_info['volume_shape'] = [5, 9, 9]
+    optical_info['axial_voxel_size_um'] = 1.0
+    optical_info['pixels_per_ml'] = 5
+    optical_info['na_obj'] = 1.2
+    optical_info['n_medium'] = 1.52
+    optical_info['wavelength'] = 0.550
+    optical_info['n_micro_lenses'] = 3
+    optical_info['n_voxels_per_ml'] = 1
+
+    return {'optical_info' : optical_info}
+
+def create_measurements(optical_info):
+    '''Ray-tracer and the images of a ground truth volume'''
+    rays = BirefringentRaytraceLFM(backend=BackEnds.PYTORCH, optical_info=optical_info)
+    rays.compute_rays_geometry()
+    volume_GT = BirefringentVolume(backend=BackEnds.PYTORCH, optical_info=optical_info,
+                                    volume_creation_args={'init_mode' : 'ellipsoid', 'init_args' : {'center' : [0.5, 0.5, 0.5], 'radius' : [1.5, 2.5, 2.5], 'delta_n' : -0.01}})
+    with torch.no_grad():
+        ret_image_measured, azim_image_measured = rays.ray_trace_through_volume(volume_GT)
+    return rays, ret_image_measured, azim_image_measured
+
+def create_initial_guess(optical_info):
+    '''Deterministic initial guess: half of the ground truth birefringence, with perturbed optic axes'''
+    generator = torch.Generator().manual_seed(0)
+    volume = BirefringentVolume(backend=BackEnds.PYTORCH, optical_info=optical_info,
+                                volume_creation_args={'init_mode' : 'ellipsoid', 'init_args' : {'center' : [0.5, 0.5, 0.5], 'radius' : [1.5, 2.5, 2.5], 'delta_n' : -0.005}})
+    with torch.no_grad():
+        volume.optic_axis += 0.3 * torch.randn(volume.optic_axis.shape, generator=generator)
+        volume.optic_axis /= volume.optic_axis.norm(dim=0, keepdim=True)
+    volume.members_to_learn += ['Delta_n', 'optic_axis']
+    return volume
+
+def test_reconstruction_decreases_loss(global_data):
+    '''Runs a short headless reconstruction, with the callbacks called every iteration'''
+    torch.set_grad_enabled(True)
+    optical_info = copy.deepcopy(global_data['optical_info'])
+    rays, ret_image_measured, azim_image_measured = create_measurements(optical_info)
+
+    called_epochs = []
+    reconstructor = Reconstructor(rays, ret_image_measured, azim_image_measured,
+                                    training_params={'n_epochs' : 10, 'lr' : 1e-3}, regularizers=[],
+                                    callbacks=[lambda recon, ep: called_epochs.append(ep)])
+    volume_estimation = reconstructor.reconstruct(use_tqdm=False)
+    assert isinstance(volume_estimation, BirefringentVolume)
+    assert called_epochs == list(range(10))
+    assert len(reconstructor.losses) == 10
+    assert reconstructor.losses[-1] < reconstructor.losses[0], 'The loss did not decrease'
+    assert reconstructor.ret_image_current.shape == ret_image_measured.shape
+
+    # Calling it again continues the optimization
+    reconstructor.reconstruct(n_epochs=2, use_tqdm=False)
+    assert called_epochs[-2:] == [10, 11]
+
+@pytest.mark.parametrize('data_term', list(DATA_TERMS.keys()))
+def test_loss_terms(global_data, data_term):
+    '''Named and custom loss terms can be combined'''
+    torch.set_grad_enabled(True)
+    optical_info = copy.deepcopy(global_data['optical_info'])
+    rays, ret_image_measured, azim_image_measured = create_measurements(optical_info)
+
+    custom_regularizer = lambda volume: volume.Delta_n.sum() * 0
+    reconstructor = Reconstructor(rays, ret_image_measured, azim_image_measured, data_term=data_term,
+                                    regularizers=[('L1', 0.5), ('unit', 1.0), (custom_regularizer, 2.0)])
+    volume = reconstructor.volume_estimation
+    with torch.no_grad():
+        ret_image, azim_image = rays.ray_trace_through_volume(volume)
+        L, data_term_value, regularization_term = reconstructor.compute_loss(ret_image, azim_image)
+    assert torch.isclose(data_term_value, DATA_TERMS[data_term](reconstructor, ret_image, azim_image))
+    assert torch.isclose(regularization_term, 0.5 * L1_regularizer(volume) + unit_regularizer(volume))
+    assert torch.isclose(L, data_term_value + regularization_term)
+
+def test_coarse_to_fine(global_data, tmp_path):
+    '''Each level of the pyramid starts from the upsampled volume of the previous one'''
+    torch.set_grad_enabled(True)
+    optical_info = copy.deepcopy(global_data['optical_info'])
+    optical_info['volume_shape'] = [6, 9, 9]
+    rays, ret_image_measured, azim_image_measured = create_measurements(copy.deepcopy(optical_info))
+
+    coarse_info = coarse_optical_info(optical_info, 2)
+    assert coarse_info['volume_shape'] == [3, 9, 9] and coarse_info['cube_voxels'] == False
+
+    reconstructors = reconstruct_coarse_to_fine(ret_image_measured, azim_image_measured, optical_info,
+                                                axial_factors=[2,1], n_epochs_per_level=[3,2],
+                                                reconstructor_args={'regularizers' : []}, geometry_dir=str(tmp_path))
+    assert len(reconstructors) == 2
+    assert len(reconstructors[0].losses) == 3 and len(reconstructors[1].losses) == 2
+    assert reconstructors[0].rays.ray_vol_colli_lengths.shape[1] < reconstructors[1].rays.ray_vol_colli_lengths.shape[1]
+    assert reconstructors[1].volume_estimation.get_delta_n().shape == (6, 9, 9)
+    # The geometry of each level is stored
+    assert len(list(tmp_path.iterdir())) == 2
+
+    # Upsampling repeats the coarse voxels axially
+    coarse_volume = reconstructors[0].volume_estimation
+    fine_volume = upsample_volume(coarse_volume, reconstructors[1].rays.optical_info)
+    assert torch.allclose(fine_volume.get_delta_n()[::2], coarse_volume.get_delta_n())
+    assert torch.allclose(fine_volume.get_delta_n()[1::2], coarse_volume.get_delta_n())
+
+    # With a factor that doesn't divide the planes, the coarse planes are centered on the fine ones
+    optical_info['volume_shape'] = [5, 9, 9]
+    assert default_axial_factors(5) == [4, 2, 1] and default_axial_factors(3) == [2, 1]
+    coarse_info = coarse_optical_info(optical_info, 4)
+    assert coarse_info['volume_shape'] == [2, 9, 9]
+    coarse_volume = BirefringentVolume(backend=BackEnds.PYTORCH, optical_info=coarse_info,
+                                        Delta_n=np.arange(2).reshape(2, 1, 1) * np.ones([2, 9, 9]), optic_axis=np.stack([np.ones([2, 9, 9]), np.zeros([2, 9, 9]), np.zeros([2, 9, 9])]))
+    fine_volume = upsample_volume(coarse_volume, BirefringentVolume(backend=BackEnds.PYTORCH, optical_info=optical_info).optical_info)
+    # Fine planes centered at -2,-1,0,1,2 voxels, in coarse planes spanning [-4,0) and [0,4)
+    assert fine_volume.get_delta_n()[:,4,4].tolist() == [0, 0, 1, 1, 1]
+
+@pytest.mark.parametrize('sampling', ['uniform', 'retardance'])
+def test_minibatch_lenslets(global_data, sampling):
+    '''The stochastic mode only projects the rays of the sampled lenslets'''
+    torch.set_grad_enabled(True)
+    optical_info = copy.deepcopy(global_data['optical_info'])
+    rays, ret_image_measured, azim_image_measured = create_measurements(optical_info)
+    reconstructor = Reconstructor(rays, ret_image_measured, azim_image_measured, regularizers=[],
+                                    training_params={'minibatch_lenslets' : 2, 'minibatch_sampling' : sampling})
+
+    # The rays of a lenslet land in its block of pixels, and match the full projection
+    lenslets = torch.tensor([1, 5])
+    ray_subset = rays.get_rays_of_lenslets(lenslets)
+    retardance, azimuth, pixel_indices = rays.ret_and_azim_of_rays_torch(reconstructor.volume_estimation, ray_subset)
+    pixels_per_ml = optical_info['pixels_per_ml']
+    assert set((pixel_indices[1] // pixels_per_ml * 3 + pixel_indices[0] // pixels_per_ml).tolist()) == {1, 5}
+    with torch.no_grad():
+        ret_image, azim_image = rays.ray_trace_through_volume(reconstructor.volume_estimation)
+    assert torch.allclose(retardance, ret_image[pixel_indices[0], pixel_indices[1]], atol=1e-6)
+    assert torch.allclose(azimuth, azim_image[pixel_indices[0], pixel_indices[1]], atol=1e-5)
+
+    if sampling == 'retardance':
+        # Lenslets are sampled proportionally to their measured retardance
+        weights = reconstructor.lenslet_sampling_weights
+        ret_per_lenslet = []
+        for lenslet in range(9):
+            pixels = rays.ray_valid_indices_all[:, rays.get_rays_of_lenslets([lenslet])]
+            ret_per_lenslet.append(ret_image_measured[pixels[0], pixels[1]].sum().item())
+        ret_per_lenslet = np.array(ret_per_lenslet)
+        assert np.allclose(weights.numpy(), ret_per_lenslet / ret_per_lenslet.sum(), rtol=1e-2)
+
+    # The data term of the sampled pixels is an unbiased estimate of the full data term, whatever the sampling
+    full_data_term = vector_data_term(reconstructor, ret_image, azim_image)
+    probabilities = reconstructor.lenslet_sampling_weights
+    lenslets, weights = reconstructor.sample_lenslets()
+    if sampling == 'uniform':
+        assert len(lenslets) == 2 and torch.allclose(weights, torch.full([2], 4.5, dtype=weights.dtype))
+    # The weights of a lenslet cover its pixels
+    pixel_weights = reconstructor.lenslet_pixel_weights(torch.tensor([1, 5]), torch.ones(2))
+    assert pixel_weights[pixel_indices[0], pixel_indices[1]].eq(1).all() and pixel_weights.sum() == 2 * pixels_per_ml**2
+    expected_data_term = 0
+    for lenslet in range(9):
+        # Single lenslet draws, with their probabilities
+        reconstructor.pixel_weights = reconstructor.lenslet_pixel_weights(torch.tensor([lenslet]), 1 / probabilities[[lenslet]])
+        expected_data_term += probabilities[lenslet] * vector_data_term(reconstructor, ret_image, azim_image)
+    assert torch.isclose(expected_data_term.type(full_data_term.dtype), full_data_term)
+    reconstructor.pixel_weights = None
+
+    reconstructor.reconstruct(n_epochs=3, use_tqdm=False)
+    assert len(reconstructor.losses) == 3 and np.all(np.isfinite(reconstructor.losses))
+    # Only the sampled pixels differ from the measurements
+    n_changed = (reconstructor.ret_image_current != reconstructor.ret_image_measured).sum()
+    assert 0 < n_changed <= 2 * pixels_per_ml**2
+
+def test_geometry_preconditioner(global_data):
+    '''The preconditioner is the sum of squared ray lengths per voxel, and it scales the gradients'''
+    torch.set_grad_enabled(True)
+    optical_info = copy.deepcopy(global_data['optical_info'])
+    rays, ret_image_measured, azim_image_measured = create_measurements(optical_info)
+
+    coverage = rays.compute_voxel_ray_coverage(power=2)
+    coverage_reference = torch.zeros_like(coverage)
+    for n_ray, vox in enumerate(rays.vox_indices_ml_shifted_all):
+        for m, v in enumerate(vox):
+            coverage_reference[v] += rays.ray_vol_colli_lengths[n_ray, m].detach()**2
+    assert torch.allclose(coverage, coverage_reference)
+
+    reconstructor = Reconstructor(rays, ret_image_measured, azim_image_measured, regularizers=[],
+                                    training_params={'preconditioner' : 'geometry'})
+    assert isinstance(reconstructor.optimizer, torch.optim.SGD)
+    # SGD has its own learning rate, for both tensors
+    assert [group['lr'] for group in reconstructor.optimizer.param_groups] == [0.3, 0.3]
+    with pytest.raises(AssertionError):
+        Reconstructor(rays, ret_image_measured, azim_image_measured, training_params={'preconditioner' : 'geometry', 'azimuth_lr_multiplier' : 10})
+    volume = reconstructor.volume_estimation
+    # Compare the preconditioned gradient with the raw one
+    for hook in reconstructor.preconditioner_hooks:
+        hook.remove()
+    ret_image, azim_image = rays.ray_trace_through_volume(volume)
+    L,_,_ = reconstructor.compute_loss(ret_image, azim_image)
+    raw_grad = torch.autograd.grad(L, volume.Delta_n)[0]
+    reconstructor.create_preconditioner()
+    ret_image, azim_image = rays.ray_trace_through_volume(volume)
+    L,_,_ = reconstructor.compute_loss(ret_image, azim_image)
+    L.backward()
+    curvature = reconstructor.delta_n_curvature
+    damping = reconstructor.training_params['preconditioner_damping'] * curvature[coverage > 0].mean()
+    assert torch.allclose(volume.Delta_n.grad, raw_grad / (curvature + damping))
+
+    reconstructor.reconstruct(n_epochs=10, use_tqdm=False)
+    assert reconstructor.losses[-1] < reconstructor.losses[0], 'The loss did not decrease'
+
+    # From the same initial guess, the preconditioned steps reach half the initial loss in fewer epochs than Adam
+    epochs_to_target = []
+    for training_params in [{'preconditioner' : 'geometry'}, {}]:
+        reconstructor = Reconstructor(rays, ret_image_measured, azim_image_measured, create_initial_guess(optical_info),
+                                        training_params=training_params, regularizers=[])
+        reconstructor.reconstruct(n_epochs=10, use_tqdm=False)
+        losses = np.array(reconstructor.losses)
+        assert (losses < losses[0] / 2).any(), f'{training_params} did not reach the target loss'
+        epochs_to_target.append(np.argmax(losses < losses[0] / 2))
+    assert epochs_to_target[0] < epochs_to_target[1], f'Epochs to reach the target loss (preconditioned, Adam): {epochs_to_target}'
+
+def test_compact_parameters(global_data):
+    '''Only the voxels crossed by the rays are optimized, and the forward projection matches the dense volume'''
+    torch.set_grad_enabled(True)
+    optical_info = copy.deepcopy(global_data['optical_info'])
+    rays, ret_image_measured, azim_image_measured = create_measurements(optical_info)
+
+    mask = rays.get_volume_ray_coverage_mask()
+    assert mask.shape == torch.Size(optical_info['volume_shape'])
+    covered_reference = torch.zeros(mask.numel(), dtype=torch.bool)
+    for n_ray, vox in enumerate(rays.vox_indices_ml_shifted_all):
+        lengths = rays.ray_vol_colli_lengths[n_ray, :len(vox)].detach()
+        covered_reference[torch.tensor(vox)[lengths > 0]] = True
+    assert torch.equal(mask.view(-1), covered_reference)
+
+    reconstructor = Reconstructor(rays, ret_image_measured, azim_image_measured, regularizers=[],
+                                    training_params={'compact_parameters' : True, 'lr' : 1e-3})
+    n_active = int(mask.sum())
+    assert reconstructor.Delta_n_compact.shape == torch.Size([n_active])
+    assert reconstructor.optic_axis_compact.shape == torch.Size([3, n_active])
+
+    with torch.no_grad():
+        images_compact = rays.ray_trace_through_volume(reconstructor.get_forward_volume())
+        images_dense = rays.ray_trace_through_volume(reconstructor.volume_estimation)
+    for image_compact, image_dense in zip(images_compact, images_dense):
+        assert torch.allclose(image_compact, image_dense)
+
+    reconstructor.reconstruct(n_epochs=10, use_tqdm=False)
+    assert reconstructor.losses[-1] < reconstructor.losses[0], 'The loss did not decrease'
+    for state in reconstructor.optimizer.state.values():
+        assert state['exp_avg'].shape[-1] == n_active
+    # The dense volume follows the compact parameters, and is zero outside the rays
+    volume = reconstructor.volume_estimation
+    assert torch.equal(volume.Delta_n[reconstructor.active_voxels], reconstructor.Delta_n_compact.detach())
+    assert (volume.Delta_n[~mask.view(-1)] == 0).all()
+
+@pytest.mark.parametrize('constraint', ['sphere', 'angles'])
+@pytest.mark.parametrize('compact', [False, True])
+def test_optic_axis_constraint(global_data, constraint, compact):
+    '''The optic axes stay on the unit sphere without the unit regularizer'''
+    torch.set_grad_enabled(True)
+    optical_info = copy.deepcopy(global_data['optical_info'])
+    rays, ret_image_measured, azim_image_measured = create_measurements(optical_info)
+
+    optic_axis = torch.nn.functional.normalize(torch.randn(3, 10), dim=0)
+    angles = BirefringentVolume.optic_axis_to_angles(optic_axis)
+    assert torch.allclose(BirefringentVolume.angles_to_optic_axis(angles), optic_axis)
+
+    # Seeded random initial guess: about one in a hundred random starts needs more than 10 epochs to decrease the loss
+    np.random.seed(0)
+    torch.manual_seed(0)
+    reconstructor = Reconstructor(rays, ret_image_measured, azim_image_measured,
+                                    training_params={'optic_axis_constraint' : constraint, 'compact_parameters' : compact, 'lr' : 1e-2})
+    assert reconstructor.regularizers == []
+    reconstructor.reconstruct(n_epochs=10, use_tqdm=False)
+    assert reconstructor.losses[-1] < reconstructor.losses[0], 'The loss did not decrease'
+    optic_axis_norm = reconstructor.volume_estimation.optic_axis.norm(dim=0)
+    assert torch.allclose(optic_axis_norm, torch.ones_like(optic_axis_norm))
+
+def test_conjugate_gradients():
+    '''Preconditioned CG solves a small symmetric positive definite system split in two tensors'''
+    A = torch.randn(6, 6)
+    A = A @ A.t() + 6 * torch.eye(6)
+    b = torch.randn(6)
+    matrix_product = lambda v: list((A @ torch.cat(v)).split([2, 4]))
+    x = conjugate_gradients(matrix_product, list(b.split([2, 4])), list(A.diagonal().split([2, 4])), 20)
+    assert torch.allclose(torch.cat(x), torch.linalg.solve(A, b))
+
+@pytest.mark.parametrize('optimizer', ['lbfgs', 'gauss_newton'])
+def test_second_order_optimizers(global_data, optimizer):
+    '''L-BFGS and Gauss-Newton reduce the stokes data term much faster than the first iterations of Adam'''
+    torch.set_grad_enabled(True)
+    optical_info = copy.deepcopy(global_data['optical_info'])
+    rays, ret_image_measured, azim_image_measured = create_measurements(optical_info)
+
+    reconstructor = Reconstructor(rays, ret_image_measured, azim_image_measured, volume_estimation=create_initial_guess(optical_info),
+                                    data_term='stokes', regularizers=[], training_params={'optimizer' : optimizer, 'lr' : 1})
+    reconstructor.reconstruct(n_epochs=5, use_tqdm=False)
+    adam = Reconstructor(rays, ret_image_measured, azim_image_measured, volume_estimation=create_initial_guess(optical_info),
+                                    data_term='stokes', regularizers=[], training_params={'lr' : 1e-3})
+    adam.reconstruct(n_epochs=5, use_tqdm=False)
+    assert reconstructor.losses[0] == pytest.approx(adam.losses[0])
+    assert all(L_next <= L for L,L_next in zip(reconstructor.losses, reconstructor.losses[1:])), 'The loss increased'
+    assert reconstructor.losses[-1] < 0.5 * adam.losses[-1]
+
+def test_proximal_operators():
+    '''Soft thresholding, and the conv3d total variation operators'''
+    delta_n = torch.tensor([-2.0, -0.5, 0.0, 0.3, 1.5])
+    assert torch.allclose(L1_prox(delta_n, 1.0), torch.tensor([-1.0, 0.0, 0.0, 0.0, 0.5]))
+
+    # The divergence is the negative adjoint of the gradient
+    volume = torch.randn(4, 6, 5)
+    field = torch.randn(3, 4, 6, 5)
+    assert torch.isclose((gradient_3d(volume) * field).sum(), -(volume * divergence_3d(field)).sum())
+
+    # The TV prox of a noisy block minimizes 1/2 |u - f|^2 + threshold TV(u)
+    noisy_block = torch.zeros(6, 8, 8)
+    noisy_block[2:4, 2:6, 2:6] = 1
+    noisy_block += 0.2 * torch.randn_like(noisy_block)
+    threshold = 0.3
+    objective = lambda u: 0.5 * ((u - noisy_block)**2).sum() + threshold * total_variation_3d(u)
+    denoised = TV_prox(noisy_block, threshold, n_iterations=500)
+    assert objective(denoised) < objective(noisy_block)
+    for _ in range(10):
+        assert objective(denoised) <= objective(denoised + 1e-3 * torch.randn_like(denoised))
+    assert torch.equal(TV_prox(noisy_block, torch.zeros_like(noisy_block)), noisy_block)
+
+@pytest.mark.parametrize('proximal_mode', ['gradient', 'admm'])
+def test_proximal_reconstruction(global_data, proximal_mode):
+    '''A sparsity proximal term zeroes more voxels than the smooth reconstruction'''
+    torch.set_grad_enabled(True)
+    optical_info = copy.deepcopy(global_data['optical_info'])
+    rays, ret_image_measured, azim_image_measured = create_measurements(optical_info)
+    initial_zeros = int((create_initial_guess(optical_info).Delta_n == 0).sum())
+
+    reconstructor = Reconstructor(rays, ret_image_measured, azim_image_measured, volume_estimation=create_initial_guess(optical_info),
+                                    data_term='stokes', regularizers=[], proximal_terms=[('TV', 0.1), ('L1', 1.0)],
+                                    training_params={'proximal_mode' : proximal_mode, 'lr' : 1e-3})
+    reconstructor.reconstruct(n_epochs=20, use_tqdm=False)
+    assert reconstructor.data_term_losses[-1] < reconstructor.data_term_losses[0], 'The loss did not decrease'
+    sparse_delta_n = reconstructor.volume_estimation.Delta_n if proximal_mode == 'gradient' else reconstructor.admm_z
+    assert int((sparse_delta_n == 0).sum()) > initial_zeros
+
+def test_block_coordinate_reconstruction(global_data):
+    '''Only the voxels of the current axial slab change in each block, and the loss decreases'''
+    torch.set_grad_enabled(True)
+    optical_info = copy.deepcopy(global_data['optical_info'])
+    rays, ret_image_measured, azim_image_measured = create_measurements(optical_info)
+
+    reconstructor = Reconstructor(rays, ret_image_measured, azim_image_measured, volume_estimation=create_initial_guess(optical_info),
+                                    data_term='stokes', regularizers=[],
+                                    training_params={'block_slab_thickness' : 2, 'block_iterations' : 3, 'lr' : 1e-3})
+    delta_n = reconstructor.volume_estimation.get_delta_n().detach().clone()
+    for n_block in range(3):
+        reconstructor.reconstruct(n_epochs=3, use_tqdm=False)
+        assert reconstructor.slab_cache['z_range'] == [2 * n_block, min(2 * n_block + 2, 5)]
+        new_delta_n = reconstructor.volume_estimation.get_delta_n().detach().clone()
+        changed_planes = torch.nonzero((new_delta_n != delta_n).any(2).any(1))[:,0].tolist()
+        assert set(changed_planes) <= set(range(*reconstructor.slab_cache['z_range']))
+        delta_n = new_delta_n
+    assert reconstructor.losses[-1] < reconstructor.losses[0], 'The loss did not decrease'
+
+    # The images of the last iteration match the full forward projection
+    with torch.no_grad():
+        ret_image, azim_image = rays.ray_trace_through_volume(reconstructor.volume_estimation)
+    reconstructor.reconstruct(n_epochs=1, use_tqdm=False)
+    assert torch.allclose(reconstructor.ret_image_current, ret_image, atol=1e-5)
+
+def test_telemetry_callback(global_data):
+    '''Snapshots are rendered on the telemetry thread, and dropped instead of blocking the optimizer'''
+    from VolumeRaytraceLFM.telemetry import TelemetryCallback
+    import threading
+    torch.set_grad_enabled(True)
+    optical_info = copy.deepcopy(global_data['optical_info'])
+    rays, ret_image_measured, azim_image_measured = create_measurements(optical_info)
+
+    rendered = []
+    release = threading.Event()
+    def renderer(snapshot, reference):
+        release.wait()
+        rendered.append((threading.current_thread().name, snapshot, reference))
+    telemetry = TelemetryCallback([renderer], interval=2, max_pending=1,
+                                  reference={'Delta_n' : torch.zeros(optical_info['volume_shape']), 'ret_image' : ret_image_measured})
+    reconstructor = Reconstructor(rays, ret_image_measured, azim_image_measured,
+                                    training_params={'n_epochs' : 10, 'lr' : 1e-3}, regularizers=[],
+                                    callbacks=[telemetry])
+    # The renderer is blocked, the reconstruction still finishes
+    reconstructor.reconstruct(use_tqdm=False)
+    release.set()
+    telemetry.close()
+    n_rendered = len(rendered)
+    assert 1 <= n_rendered < 5 and telemetry.worker.n_dropped == 5 - n_rendered
+    thread_name, snapshot, reference = rendered[0]
+    assert thread_name == 'telemetry'
+    assert snapshot['ep'] == 0 and snapshot['losses'] == reconstructor.losses[:1]
+    assert snapshot['Delta_n_mip'].shape == reference['Delta_n_mip'].shape
+    assert np.array_equal(reference['ret_image'], ret_image_measured.numpy())
+    # The snapshot is a copy of the volume at that epoch
+    assert not torch.equal(snapshot['Delta_n'], reconstructor.volume_estimation.get_delta_n())
+
+@pytest.mark.parametrize('training_params', [{'minibatch_lenslets' : 3}, {'optimizer' : 'lbfgs'}])
+def test_checkpoint_resume(global_data, tmp_path, training_params):
+    '''A reconstruction resumed from a checkpoint continues exactly as the uninterrupted one'''
+    from VolumeRaytraceLFM.checkpoint import CheckpointCallback, read_checkpoint, resume_from_checkpoint
+    torch.set_grad_enabled(True)
+    optical_info = copy.deepcopy(global_data['optical_info'])
+    rays, ret_image_measured, azim_image_measured = create_measurements(optical_info)
+    training_params = dict(training_params, lr=1e-3)
+    filename = str(tmp_path / 'checkpoints.h5')
+    create_reconstructor = lambda callbacks: Reconstructor(rays, ret_image_measured, azim_image_measured,
+                                                            create_initial_guess(optical_info), training_params=training_params,
+                                                            data_term='stokes', regularizers=[], callbacks=callbacks)
+
+    torch.manual_seed(0)
+    reference = create_reconstructor([])
+    reference.reconstruct(n_epochs=6, use_tqdm=False)
+
+    torch.manual_seed(0)
+    checkpoints = CheckpointCallback(filename, interval=2)
+    interrupted = create_reconstructor([checkpoints])
+    interrupted.reconstruct(n_epochs=4, use_tqdm=False)
+    checkpoints.close()
+    with h5py.File(filename, 'r') as f:
+        assert list(f['epoch']) == [2, 4]
+        assert f['volume/delta_n'].shape == (2,) + tuple(optical_info['volume_shape'])
+        assert f['volume/delta_n'].chunks == (1,) + tuple(optical_info['volume_shape'])
+    assert read_checkpoint(filename, index=0)['losses'] == interrupted.losses[:2]
+
+    # A new reconstructor, with other random number generators states, continues from epoch 4
+    torch.manual_seed(1)
+    np.random.seed(1)
+    resumed = create_reconstructor([])
+    assert resume_from_checkpoint(resumed, filename) == 4
+    resumed.reconstruct(n_epochs=2, use_tqdm=False)
+    assert resumed.losses == reference.losses
+    assert torch.equal(resumed.volume_estimation.Delta_n, reference.volume_estimation.Delta_n)
+    assert torch.equal(resumed.volume_estimation.optic_axis, reference.volume_estimation.optic_axis)
+
+def test_checkpoint_interrupted_write(global_data, tmp_path):
+    '''The entries of a checkpoint interrupted before its epoch was written are replaced by the next checkpoint'''
+    from VolumeRaytraceLFM.checkpoint import write_checkpoint, read_checkpoint, append_to_dataset
+    torch.set_grad_enabled(True)
+    optical_info = copy.deepcopy(global_data['optical_info'])
+    rays, ret_image_measured, azim_image_measured = create_measurements(optical_info)
+    reconstructor = Reconstructor(rays, ret_image_measured, azim_image_measured, create_initial_guess(optical_info), regularizers=[])
+    filename = str(tmp_path / 'checkpoints.h5')
+    volume_shape = list(optical_info['volume_shape'])
+    def checkpoint_state():
+        state = reconstructor.get_checkpoint_state()
+        state['volume_shape'] = volume_shape
+        return state
+
+    reconstructor.reconstruct(n_epochs=1, use_tqdm=False)
+    write_checkpoint(filename, checkpoint_state())
+    # Interrupted after the volume and the state were appended, before the epoch
+    with h5py.File(filename, 'a') as f:
+        append_to_dataset(f, 'volume/delta_n', np.full([1] + volume_shape, -1, dtype=f['volume/delta_n'].dtype))
+        append_to_dataset(f, 'volume/optic_axis', np.full([1, 3] + volume_shape, -1, dtype=f['volume/optic_axis'].dtype))
+        f['state'].resize(2, axis=0)
+    assert read_checkpoint(filename)['ep'] == 1
+
+    reconstructor.reconstruct(n_epochs=1, use_tqdm=False)
+    write_checkpoint(filename, checkpoint_state())
+    with h5py.File(filename, 'r') as f:
+        assert f['volume/delta_n'].shape[0] == f['state'].shape[0] == f['epoch'].shape[0] == 2
+    state = read_checkpoint(filename)
+    assert state['ep'] == 2
+    expected = reconstructor.volume_estimation.get_delta_n().detach().reshape(-1).to(state['Delta_n'].dtype)
+    assert torch.equal(state['Delta_n'], expected)
+
+def test_hyperparameter_sweep(global_data, tmp_path):
+    '''Successive halving continues the best runs, and matches a single process reconstruction'''
+    from VolumeRaytraceLFM.sweep import grid_search_space, random_search_space, run_sweep, format_summary_table
+    torch.set_grad_enabled(True)
+    optical_info = copy.deepcopy(global_data['optical_info'])
+    rays, ret_image_measured, azim_image_measured = create_measurements(optical_info)
+
+    configs = grid_search_space({'lr' : [1e-4, 1e-3], 'data_term' : ['vector', 'stokes']})
+    assert len(configs) == 4 and {'lr' : 1e-3, 'data_term' : 'stokes'} in configs
+    random_configs = random_search_space({'lr' : (1e-4, 1e-2, 'log'), 'azimuth_weight' : (0, 1), 'data_term' : ['vector']}, 5)
+    assert len(random_configs) == 5 and all(1e-4 <= config['lr'] < 1e-2 for config in random_configs)
+    with pytest.raises(ValueError, match='azimuth_weight'):
+        random_search_space({'azimuth_weight' : (0, 1, 'linear')}, 1)
+
+    summary, best_state = run_sweep(rays, ret_image_measured, azim_image_measured, configs, n_epochs=4,
+                                    n_workers=2, threads_per_worker=1, halving_eta=2, min_epochs=1,
+                                    summary_file=str(tmp_path / 'summary.csv'))
+    # Rounds of 1, 2 and 4 epochs, with 4, 2 and 1 runs
+    assert [entry['ep'] for entry in summary] == [4, 2, 1, 1]
+    assert best_state['ep'] == 4 and len(best_state['losses']) == 4
+    assert summary[1]['score'] <= min(summary[2]['score'], summary[3]['score'])
+    assert len(format_summary_table(summary).splitlines()) == 5
+    assert (tmp_path / 'summary.csv').read_text().startswith('lr,data_term,ep,score,loss,time')
+
+    # The resumed rounds match an uninterrupted run
+    best_config = dict(summary[0]['config'])
+    np.random.seed(0)
+    torch.manual_seed(0)
+    reconstructor = Reconstructor(rays, ret_image_measured, azim_image_measured, training_params={'lr' : best_config['lr']},
+                                    data_term=best_config['data_term'])
+    reconstructor.reconstruct(n_epochs=4, use_tqdm=False)
+    assert np.allclose(reconstructor.losses, best_state['losses'])
+
+def test_sequence_reconstruction(global_data, tmp_path):
+    '''Frames are loaded by another thread, warm started from the previous one, and stored in a single file'''
+    from VolumeRaytraceLFM.sequence import reconstruct_sequence, load_sequence_frame
+    import threading
+    torch.set_grad_enabled(True)
+    optical_info = copy.deepcopy(global_data['optical_info'])
+    rays, ret_image_measured, azim_image_measured = create_measurements(optical_info)
+    filename = str(tmp_path / 'sequence.h5')
+
+    loader_threads = []
+    def load_frames():
+        # The retardance slowly changes over time
+        for scale in [1.0, 1.0, 1.02]:
+            loader_threads.append(threading.current_thread().name)
+            yield ret_image_measured * scale, azim_image_measured
+    frame_epochs = []
+    reconstructor, frame_losses = reconstruct_sequence(rays, load_frames(), filename, n_epochs_first=10, n_epochs_per_frame=3,
+                                                        reconstructor_args={'training_params' : {'lr' : 1e-3}, 'regularizers' : []},
+                                                        callbacks=[lambda recon, n_frame: frame_epochs.append(recon.ep)])
+    assert frame_epochs == [10, 13, 16] and len(frame_losses) == 3
+    assert all(name.startswith('frame-loader') for name in loader_threads)
+    # The warm started frames start close to the previous estimate
+    assert reconstructor.losses[10] < reconstructor.losses[0]
+    with h5py.File(filename, 'r') as f:
+        assert f['data/delta_n'].shape == (3,) + tuple(optical_info['volume_shape'])
+        assert f['data/optic_axis'].chunks == (1, 3) + tuple(optical_info['volume_shape'])
+        assert list(f['optical_info/volume_shape']) == optical_info['volume_shape']
+    last_volume = load_sequence_frame(filename, -1, BackEnds.PYTORCH, reconstructor.optical_info)
+    assert torch.allclose(last_volume.get_delta_n(), reconstructor.volume_estimation.get_delta_n().detach(), atol=1e-6)
@@ -0,0 +1,115 @@
+import pytest
+
+from VolumeRaytraceLFM.birefringence_implementations import *
+from VolumeRaytraceLFM.tiling import *
+import copy
+
+
+@pytest.fixture(scope = 'module')
+def mla_optical_info():
+    '''An MLA of 7x7 lenslets in front of a volume that fits it'''
+    optical_info = OpticalElement.get_optical_info_template()
+    optical_info['volume_shape'] = [5, 21, 21]
+    optical_info['voxel_size_um'] = [1.0, 1.0, 1.0]
+    optical_info['pixels_per_ml'] = 9
+    optical_info['na_obj'] = 1.2
+    optical_info['n_medium'] = 1.52
+    optical_info['n_micro_lenses'] = 7
+    optical_info['n_voxels_per_ml'] = 1
+    return optical_info
+
+@pytest.fixture
+def float32_default():
+    '''Sets float32 as the default torch dtype during a test, and restores the previous one'''
+    default_dtype = torch.get_default_dtype()
+    torch.set_default_dtype(torch.float32)
+    yield
+    torch.set_default_dtype(default_dtype)
+
+@pytest.mark.parametrize('tile_lenslets', [1, 3, 5, 7])
+def test_out_of_core_ray_trace(mla_optical_info, tmp_path, tile_lenslets, float32_default):
+    '''Ray-tracing a volume file by tiles gives the same images as ray-tracing the whole volume'''
+    optical_info = copy.deepcopy(mla_optical_info)
+    rays = BirefringentRaytraceLFM(backend=BackEnds.PYTORCH, optical_info=optical_info)
+    rays.compute_rays_geometry()
+    volume = BirefringentVolume(backend=BackEnds.PYTORCH, optical_info=optical_info, volume_creation_args={'init_mode' : 'random'})
+    with torch.no_grad():
+        ret_image, azim_image = rays.ray_trace_through_volume(volume)
+    volume.save_as_file(str(tmp_path / 'volume.h5'), chunk_shape=[5,8,8])
+
+    with OutOfCoreVolume.from_file(str(tmp_path / 'volume.h5')) as volume_on_disk:
+        assert isinstance(volume_on_disk.delta_n, h5py.Dataset)
+        ret_tiles, azim_tiles = ray_trace_out_of_core(volume_on_disk, optical_info, tile_lenslets,
+                                                        str(tmp_path / 'ret.npy'), str(tmp_path / 'azim.npy'),
+                                                        geometry_file=str(tmp_path / 'tile_geometry.h5'))
+    assert isinstance(ret_tiles, np.memmap) and ret_tiles.shape == (63, 63)
+    assert np.allclose(ret_tiles, ret_image.numpy(), atol=1e-5)
+    assert np.allclose(np.load(tmp_path / 'azim.npy'), azim_image.numpy(), atol=1e-5)
+    # The geometry file is shared by later runs
+    assert create_tile_raytracer(optical_info, tile_lenslets, str(tmp_path / 'tile_geometry.h5')).optical_info['n_micro_lenses'] == tile_lenslets
+
+def test_out_of_core_large_volume(mla_optical_info, tmp_path):
+    '''Volumes that don't fit the MLA are ray-traced as if they were surrounded by empty voxels'''
+    optical_info = copy.deepcopy(mla_optical_info)
+    optical_info['volume_shape'] = [5, 9, 31]
+    delta_n = np.random.uniform(0, 0.01, optical_info['volume_shape'])
+    optic_axis = np.random.uniform(-1, 1, [3] + optical_info['volume_shape'])
+    volume_on_disk = OutOfCoreVolume(delta_n, optic_axis)
+    block_delta_n, block_optic_axis = volume_on_disk.read_block([-2, 3], [6, 6], dtype=np.float64)
+    assert np.array_equal(block_delta_n[:,2:,:], delta_n[:,:4,3:9]) and not block_delta_n[:,:2].any()
+    ret_image, azim_image = ray_trace_out_of_core(volume_on_disk, optical_info, 3, str(tmp_path / 'ret.npy'), str(tmp_path / 'azim.npy'))
+
+    # Same as ray-tracing the volume padded to fit the MLA
+    padded_info = copy.deepcopy(mla_optical_info)
+    padded_info['volume_shape'] = [5, 21, 31]
+    padded_delta_n = np.zeros(padded_info['volume_shape'])
+    padded_delta_n[:,6:15] = delta_n
+    padded_optic_axis = np.full([3] + padded_info['volume_shape'], np.sqrt(3))
+    padded_optic_axis[:,:,6:15] = optic_axis
+    rays = BirefringentRaytraceLFM(backend=BackEnds.PYTORCH, optical_info=padded_info)
+    rays.compute_rays_geometry()
+    volume = BirefringentVolume(backend=BackEnds.PYTORCH, optical_info=padded_info, Delta_n=padded_delta_n, optic_axis=padded_optic_axis)
+    with torch.no_grad():
+        expected_ret_image, _ = rays.ray_trace_through_volume(volume)
+    assert np.allclose(ret_image, expected_ret_image.numpy(), atol=1e-5)
+
+    with pytest.raises(AssertionError):
+        create_tile_raytracer(optical_info, 4)
+
+def test_tiled_reconstruction(mla_optical_info, tmp_path):
+    '''Overlapping tiles are reconstructed in parallel and blended into a volume of the whole MLA'''
+    optical_info = copy.deepcopy(mla_optical_info)
+    rays = BirefringentRaytraceLFM(backend=BackEnds.PYTORCH, optical_info=optical_info)
+    rays.compute_rays_geometry()
+    np.random.seed(0)
+    torch.manual_seed(0)
+    volume = BirefringentVolume(backend=BackEnds.PYTORCH, optical_info=optical_info, volume_creation_args={'init_mode' : 'random'})
+    with torch.no_grad():
+        ret_image, azim_image = rays.ray_trace_through_volume(volume)
+    np.save(tmp_path / 'ret.npy', ret_image.numpy())
+
+    weights = tile_blending_weights([7, 7], 2)
+    assert weights[3,3] == 1 and np.isclose(weights[0,3], 1 / 3) and np.array_equal(weights, weights.T)
+    # Two tiles overlapping on a column, with delta_n 1 and 3 there: a variance of 1
+    accumulators = {'delta_n' : np.zeros([1, 2, 3]), 'delta_n_squares' : np.zeros([1, 2, 3]), 'optic_axis' : np.zeros([3, 1, 2, 3]),
+                    'weights' : np.zeros([2, 3]), 'n_tiles' : np.zeros([2, 3])}
+    for start,value in [([0, 0], 1), ([0, 1], 3)]:
+        blend_tile(accumulators, start, np.full([1, 2, 2], value), np.ones([3, 1, 2, 2]), np.ones([2, 2]))
+    assert tile_disagreement(accumulators) == 1
+    volume_estimation, pass_losses, pass_disagreements = reconstruct_tiled(optical_info, np.load(tmp_path / 'ret.npy', mmap_mode='r'), azim_image.numpy(),
+                                                        3, str(tmp_path / 'tiled'), overlap=1, n_epochs=10, n_epochs_per_pass=5,
+                                                        n_global_passes=1, n_workers=2, threads_per_worker=1,
+                                                        reconstructor_args={'training_params' : {'lr' : 1e-2}})
+    assert volume_estimation.shape == [5, 21, 21] and len(pass_losses) == 2 and len(pass_disagreements) == 2
+    assert all(np.isfinite(pass_losses)) and pass_losses[1] < pass_losses[0]
+    # Starting the tiles from the blended volume, where their halos hold the voxels of the neighboring tiles,
+    #   makes the overlapping tiles agree much more than the independent tiles
+    assert pass_disagreements[1] < 0.5 * pass_disagreements[0], f'The global pass did not reconcile the tiles: {pass_disagreements}'
+    delta_n, optic_axis = volume_estimation.read_block([0, 0], [21, 21], dtype=np.float64)
+    assert np.isfinite(delta_n).all() and np.allclose(np.linalg.norm(optic_axis, axis=0), 1, atol=1e-4)
+    # The tiles cover the voxels in front of the MLA and their halos
+    first = tile_volume_start(create_tile_raytracer(optical_info, 3), optical_info, [0, 0])[0]
+    halo = get_tile_halo(optical_info)
+    covered = np.abs(delta_n).sum(0) > 0
+    assert covered[first:first + 7 + 2 * halo, first:first + 7 + 2 * halo].all() and covered.sum() == (7 + 2 * halo) ** 2
+    assert os.path.exists(tmp_path / 'tiled' / 'delta_n.npy')